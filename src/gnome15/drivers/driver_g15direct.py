@@ -28,6 +28,8 @@ import gnome15.g15globals as g15globals
 import gnome15.util.g15scheduler as g15scheduler
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15gconf as g15gconf
+import gnome15.util.g15cairo as g15cairo
+import gnome15.util.g15pixels as g15pixels
 import gnome15.g15uinput as g15uinput
 import gnome15.g15exceptions as g15exceptions
 import sys
@@ -35,9 +37,6 @@ import os
 import gconf
 import gtk
 import logging
-from PIL import ImageMath
-from PIL import Image
-import array
 logger = logging.getLogger(__name__)
 load_error = None
 try :
@@ -306,51 +305,19 @@ class Driver(g15driver.AbstractDriver):
              
         self.lock.acquire()        
         try :           
-            size = self.get_size()
-            
-            # Paint to 565 image provided into an ARGB image surface for PIL's benefit. PIL doesn't support 565?
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
-            
-            # Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            # colours dithered. It would be nice if Cairo could do this :( Any suggestions? 
-            pil_img = Image.frombuffer("RGBA", size, argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            pil_img = pil_img.point(lambda i: i >= 250,'1')
+            width, height = self.get_size()
             
+            # Dither and pack into 1 bit per pixel, left most pixel in the most significant bit 
             invert_control = self.get_control("invert_lcd")
-            if invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-    
-            # Convert image buffer to string
-            buf = ""
-            for x in list(pil_img.getdata()): 
-                buf += chr(x)
+            buf = g15pixels.surface_to_mono(g15cairo.to_argb32_surface(img),
+                                            dither = self.dither,
+                                            invert = invert_control.value != 0)
                 
-            if len(buf) != self.device.lcd_size[0] * self.device.lcd_size[1]:
+            if len(buf) != ( width * height + 7 ) / 8:
                 logger.warning("Invalid buffer size")
-            else:
-                # TODO Replace with C routine
-                arrbuf = array.array('B', self.empty_buf)
-                width, height = self.get_size() 
-                max_byte_offset = 0
-                for x in range(0, width):
-                    for y in range(0, height):
-                        pixel_offset = y * width + x;
-                        byte_offset = pixel_offset / 8;
-                        max_byte_offset =  max(max_byte_offset, byte_offset)
-                        bit_offset = 7-(pixel_offset % 8);
-                        val = ord(buf[x+(y*160)])
-                        pv = arrbuf[byte_offset]
-                        if val > 0:
-                            arrbuf[byte_offset] = pv | 1 << bit_offset
-                        else:
-                            arrbuf[byte_offset] = pv &  ~(1 << bit_offset)
-                buf = arrbuf.tostring()
+            elif self.is_frame_changed(buf):
                 try :
+                    buf += self.empty_buf[len(buf):]
                     logger.debug("Writing buffer of %d bytes", len(buf))
                     pylibg15.write_pixmap(buf)
                 except IOError as e:
@@ -372,9 +339,10 @@ class Driver(g15driver.AbstractDriver):
         self.notify_handles = [] 
                 
         # Create an empty string buffer for use with monochrome LCD
-        self.empty_buf = ""
-        for _ in range(0, 861):
-            self.empty_buf += chr(0)
+        self.empty_buf = chr(0) * 861
+        self.dither = g15pixels.get_dither(g15gconf.get_string_or_default(self.conf_client,
+                                                                          "/apps/gnome15/%s/dither" % self.device.uid,
+                                                                          g15pixels.DITHER_FLOYD_STEINBERG))
         
         # TODO Enable UINPUT if multimedia key support is required?
         self.timeout = 10000
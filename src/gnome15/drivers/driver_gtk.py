@@ -29,6 +29,7 @@ import os
 import gtk.gdk
 import gobject
 import cairo
+from threading import Lock
 
 from PIL import Image
 from PIL import ImageMath
@@ -118,6 +119,8 @@ class Driver(g15driver.AbstractDriver):
         self.device = device
         self.area = None
         self.image = None
+        self._next_image = None
+        self._image_lock = Lock()
         self.buttons = {}
         self.event_box = None
         self.on_close = on_close
@@ -181,15 +184,17 @@ class Driver(g15driver.AbstractDriver):
                  
             if self.bpp == 1:
                 # Paint to 565 image provided into an ARGB image surface for PIL's benefit. PIL doesn't support 565?
-                argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+                argb_surface = self.surface_pool.get(cairo.FORMAT_ARGB32, width, height)
                 argb_context = cairo.Context(argb_surface)
                 argb_context.set_source_surface(image)
+                argb_context.set_operator(cairo.OPERATOR_SOURCE)
                 argb_context.paint()
                 
                 # Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
                 # colours dithered. It would be nice if Cairo could do this :( Any suggestions? 
                 pil_img = Image.frombuffer("RGBA", self.lcd_size, argb_surface.get_data(), "raw", "RGBA", 0, 1)
                 pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
+                self.surface_pool.release(argb_surface)
                 pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
                 pil_img = pil_img.point(lambda i: i >= 250,'1')
                 
@@ -199,14 +204,15 @@ class Driver(g15driver.AbstractDriver):
                     
                 # Create drawable message
                 pil_img = pil_img.convert("RGB")
-                self.image = pil_img           
+                self._set_next_image(pil_img)
             else:
                 # Take a copy of the image to prevent flickering
-                argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+                argb_surface = self.surface_pool.get(cairo.FORMAT_ARGB32, width, height)
                 argb_context = cairo.Context(argb_surface)
                 argb_context.set_source_surface(image)
+                argb_context.set_operator(cairo.OPERATOR_SOURCE)
                 argb_context.paint()
-                self.image = argb_surface
+                self._set_next_image(argb_surface)
             gobject.timeout_add(0, self.redraw)
             
     def process_svg(self, document):  
@@ -217,6 +223,7 @@ class Driver(g15driver.AbstractDriver):
                     element.set("style", style.replace("font-family:Sans","font-family:%s" % g15globals.fixed_size_font_name))
                     
     def redraw(self):
+        self._take_next_image()
         if self.image != None and self.main_window is not None:
             if isinstance(self.image, cairo.Surface):
                 self._draw_surface()
@@ -301,19 +308,61 @@ class Driver(g15driver.AbstractDriver):
             logger.warning("Mode change would cause disconnect when already connected. %s",
                            str(entry))
             
+    def _set_next_image(self, image):
+        """
+        Hand a new frame over to the main thread. If the previous frame was
+        never picked up by the main thread it has not been read, so it can go
+        straight back to the pool.
+        
+        Keyword arguments:
+        image        -- surface or PIL image
+        """
+        self._image_lock.acquire()
+        try:
+            unused_image = self._next_image
+            self._next_image = image
+        finally:
+            self._image_lock.release()
+        self._release_image(unused_image)
+        
+    def _take_next_image(self):
+        """
+        Make the most recent frame the one the main thread draws. The frame it
+        replaces is only returned to the pool here, on the main thread, once
+        nothing can be painting from it any more.
+        """
+        self._image_lock.acquire()
+        try:
+            next_image = self._next_image
+            self._next_image = None
+        finally:
+            self._image_lock.release()
+        if next_image is not None:
+            previous_image = self.image
+            self.image = next_image
+            self._release_image(previous_image)
+            
+    def _release_image(self, image):
+        if isinstance(image, cairo.ImageSurface):
+            self.surface_pool.release(image)
+            
     def _draw_surface(self):
         # Finally paint the Cairo surface on the GTK widget
         zoom = self.get_zoom()
         width = self.lcd_size[0]
         height = self.lcd_size[1]
         if self.area != None and self.area.window != None:
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, zoom * width, zoom * height)
+            surface = self.surface_pool.get(cairo.FORMAT_ARGB32, zoom * width, zoom * height)
             context = cairo.Context(surface)        
             context.set_antialias(self.get_antialias())
             context.scale(zoom, zoom)
             context.set_source_surface(self.image)
+            context.set_operator(cairo.OPERATOR_SOURCE)
             context.paint()
+            previous_surface = self.area.buffer
             self.area.set_surface(surface)
+            if previous_surface is not None and previous_surface is not surface:
+                self.surface_pool.release(previous_surface)
             
     def _draw_pixbuf(self):
         width = self.lcd_size[0]
@@ -17,7 +17,6 @@
 import gnome15.g15locale as g15locale
 _ = g15locale.get_translation("gnome15-drivers").ugettext
 
-from cStringIO import StringIO
 from pyinputevent.uinput import UInputDevice
 from pyinputevent.pyinputevent import InputEvent, SimpleDevice
 from pyinputevent.keytrans import *
@@ -28,6 +27,9 @@ import pyinputevent.scancodes as S
 import gnome15.g15driver as g15driver
 import gnome15.util.g15scheduler as g15scheduler
 import gnome15.util.g15uigconf as g15uigconf
+import gnome15.util.g15gconf as g15gconf
+import gnome15.util.g15cairo as g15cairo
+import gnome15.util.g15pixels as g15pixels
 import gnome15.g15globals as g15globals
 import gnome15.g15uinput as g15uinput
 import gconf
@@ -38,9 +40,6 @@ import cairo
 import re
 import usb
 import fb
-from PIL import Image
-from PIL import ImageMath
-import array
 import dbus
 import gobject
 
@@ -929,6 +928,7 @@ class Driver(g15driver.AbstractDriver):
         self.device_info = None
         self.system_service = None
         self.conf_client = gconf.client_get_default()
+        self.rgb565_supported = True
         
         try:
             self._init_device()
@@ -1020,85 +1020,48 @@ class Driver(g15driver.AbstractDriver):
             return 
         width = img.get_width()
         height = img.get_height()
-        character_width = width / 8
         fixed = self.fb.get_fixed_info()
-        padding = fixed.line_length - character_width
-        file_str = StringIO()
         
         if self.get_model_name() == g15driver.MODEL_G19:
-            try:
-                back_surface = cairo.ImageSurface (4, width, height)
-            except Exception as e:
-                logger.debug("Could not create ImageSurface. Trying earlier API.", exc_info = e)
-                # Earlier version of Cairo
-                back_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, width, height)
-            back_context = cairo.Context (back_surface)
-            back_context.set_source_surface(img, 0, 0)
-            back_context.set_operator (cairo.OPERATOR_SOURCE);
-            back_context.paint()
-                
-            if back_surface.get_format() == cairo.FORMAT_ARGB32:
+            back_surface = None
+            if self.rgb565_supported:
+                try:
+                    back_surface = self.surface_pool.get(4, width, height)
+                except Exception as e:
+                    logger.debug("Could not create ImageSurface. Using g15pixels conversion.", exc_info = e)
+                    self.rgb565_supported = False
+                    
+            if back_surface is not None:
+                back_context = cairo.Context (back_surface)
+                back_context.set_source_surface(img, 0, 0)
+                back_context.set_operator (cairo.OPERATOR_SOURCE);
+                back_context.paint()
+                buf = str(back_surface.get_data())
+                self.surface_pool.release(back_surface)
+            else:
                 """
                 If the creation of the type 4 image failed (i.e. earlier version of Cairo)
-                then we have to convert it ourselves. This is slow. 
-                
-                TODO Replace with C routine 
+                then we have to convert it ourselves. g15pixels does this for the whole
+                frame in one go. 
                 """
-                file_str = StringIO()
-                data = back_surface.get_data()
-                for i in range(0, len(data), 4):
-                    r = ord(data[i + 2])
-                    g = ord(data[i + 1])
-                    b = ord(data[i + 0])
-                    file_str.write(self.rgb_to_uint16(r, g, b))             
-                buf = file_str.getvalue()
-            else:   
-                buf = str(back_surface.get_data())
+                buf = g15pixels.surface_to_rgb565(g15cairo.to_argb32_surface(img))
         else:
-            width, height = self.get_size()
-            arrbuf = array.array('B', self.empty_buf)
-            
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
-            
-            '''
-            Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            colours dithered. It would be nice if Cairo could do this :( Any suggestions?
-            ''' 
-            pil_img = Image.frombuffer("RGBA", (width, height), argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            pil_img = pil_img.point(lambda i: i >= 250,'1')
-            
-            # Invert the screen if required
-            if g15_invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-            
-            # Data is 160x43, 1 byte per pixel. Will have value of 0 or 1.
-            width, height = self.get_size()
-            data = list(pil_img.getdata())
-            fixed = self.fb.get_fixed_info()
-            v = 0
-            b = 1
-            
-            # TODO Replace with C routine
-            for row in range(0, height):
-                for col in range(0, width):
-                    if data[( row * width ) + col]:
-                        v += b
-                    b = b << 1
-                    if b == 256:
-                        # Full byte
-                        b = 1          
-                        i = row * fixed.line_length + col / 8
-                        arrbuf[i] = v   
-                        v = 0 
-            buf = arrbuf.tostring()
+            # Dither and pack into 1 bit per pixel, left most pixel in the least significant bit
+            buf = g15pixels.surface_to_mono(g15cairo.to_argb32_surface(img),
+                                            dither = self.dither,
+                                            invert = g15_invert_control.value != 0,
+                                            bit_order = g15pixels.BIT_ORDER_LSB,
+                                            line_length = fixed.line_length)
                 
-        if self.fb and self.fb.buffer:
-            self.fb.buffer[0:len(buf)] = buf
+        if self.fb and self.fb.buffer and self.is_frame_changed(buf):
+            # Only the scanlines that changed since the last frame are written
+            self.fb.write(buf)
+            
+    def get_frame_statistics(self):
+        stats = g15driver.AbstractDriver.get_frame_statistics(self)
+        if self.fb is not None:
+            stats["bytes_written"] = self.fb.bytes_written
+        return stats
             
     def process_svg(self, document):  
         if self.get_bpp() == 1:
@@ -1192,10 +1155,10 @@ class Driver(g15driver.AbstractDriver):
                 self.fb.dump()
             self.var_info = self.fb.get_var_info()
                     
-            # Create an empty string buffer for use with monochrome LCD
-            self.empty_buf = ""
-            for i in range(0, self.fb.get_fixed_info().smem_len):
-                self.empty_buf += chr(0)
+            # Dithering used for monochrome LCD
+            self.dither = g15pixels.get_dither(g15gconf.get_string_or_default(self.conf_client,
+                                                                              "/apps/gnome15/%s/dither" % self.device.uid,
+                                                                              g15pixels.DITHER_FLOYD_STEINBERG))
             
         # Connect to DBUS        
         system_bus = dbus.SystemBus()
@@ -22,14 +22,15 @@ keyboard
 import gnome15.g15driver as g15driver
 import gnome15.g15globals as g15globals
 import gnome15.util.g15uigconf as g15uigconf
+import gnome15.util.g15gconf as g15gconf
 import gnome15.util.g15scheduler as g15scheduler
+import gnome15.util.g15cairo as g15cairo
+import gnome15.util.g15pixels as g15pixels
 import gtk
 import os.path
 import socket
 import cairo
 import gconf
-from PIL import ImageMath
-from PIL import Image
 from threading import Thread
 from threading import Lock
 import struct
@@ -338,33 +339,16 @@ class Driver(g15driver.AbstractDriver):
              
         self.lock.acquire()        
         try :           
-            size = self.get_size()
-            
-            # Paint to 565 image provided into an ARGB image surface for PIL's benefit. PIL doesn't support 565?
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
-            
-            # Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            # colours dithered. It would be nice if Cairo could do this :( Any suggestions? 
-            pil_img = Image.frombuffer("RGBA", size, argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            pil_img = pil_img.point(lambda i: i >= 250,'1')
-            
+            # Dither to one byte per pixel, 1 for a dark pixel
             invert_control = self.get_control("invert_lcd")
-            if invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-    
-            # Covert image buffer to string
-            buf = ""
-            for x in list(pil_img.getdata()): 
-                buf += chr(x)
+            buf = g15pixels.surface_to_mono(g15cairo.to_argb32_surface(img),
+                                            dither = self.dither,
+                                            invert = invert_control.value != 0,
+                                            bit_order = g15pixels.BIT_ORDER_NONE)
                 
             if len(buf) != self.device.lcd_size[0] * self.device.lcd_size[1]:
                 logger.warning("Invalid buffer size")
-            else:
+            elif self.is_frame_changed(buf):
                 try : 
                     self.send(buf)
                 except IOError as e:
@@ -391,6 +375,11 @@ class Driver(g15driver.AbstractDriver):
         e = self.conf_client.get("/apps/gnome15/%s/g15daemon_port" % self.device.uid)
         if e:
             port = e.get_int()
+            
+        # Dithering used for the LCD
+        self.dither = g15pixels.get_dither(g15gconf.get_string_or_default(self.conf_client,
+                                                                          "/apps/gnome15/%s/dither" % self.device.uid,
+                                                                          g15pixels.DITHER_FLOYD_STEINBERG))
         
         map = {}
             
@@ -19,6 +19,10 @@ from fcntl import ioctl
 import mmap
 import os
 
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
 FBIOGET_VSCREENINFO=0x4600
 FBIOPUT_VSCREENINFO=0x4601
 FBIOGET_FSCREENINFO=0x4602
@@ -83,16 +87,86 @@ class fb_var_screeninfo(Structure):
                 ( "reserved", c_ulong * 5),
                 ]
     
+def get_damage(old, new, line_length):
+    """
+    Compare two frames and return a list of ( start, end ) byte ranges that
+    differ. Frames are compared a scanline at a time, adjacent changed lines
+    are merged, and each range is then trimmed to the first and last bytes
+    that actually changed.
+    
+    Keyword arguments:
+    old            -- previous frame
+    new            -- new frame (must be the same length as old)
+    line_length    -- bytes per scanline
+    """
+    ranges = []
+    length = len(new)
+    for start in range(0, length, line_length):
+        end = min(start + line_length, length)
+        if old[start:end] != new[start:end]:
+            if len(ranges) > 0 and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+    return [ ( _first_difference(old, new, start, end), _last_difference(old, new, start, end) ) for start, end in ranges ]
+
+def _first_difference(old, new, start, end):
+    # Binary search for the first byte that differs, knowing that one does
+    lo, hi = start, end - 1
+    while lo < hi:
+        mid = ( lo + hi ) // 2
+        if old[start:mid + 1] == new[start:mid + 1]:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _last_difference(old, new, start, end):
+    # Binary search for the end of the last byte that differs, knowing that one does
+    lo, hi = start + 1, end
+    while lo < hi:
+        mid = ( lo + hi ) // 2
+        if old[mid:end] == new[mid:end]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
 class fb_device():
     def __init__(self, device_name, mode = os.O_RDWR):
         self.device_file = os.open(device_name, os.O_RDWR)
         self.buffer = None
+        self.last_frame = None
+        self.bytes_written = 0
         self.invalidate()
         
     def invalidate(self):
         if self.buffer != None:
-            self.buffer().close()
+            self.buffer.close()
         self.buffer = mmap.mmap(self.device_file, self.get_screen_size(), mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.line_length = self.get_fixed_info().line_length
+        self.last_frame = None
+        
+    def write(self, data):
+        """
+        Write a frame to the start of the framebuffer. Only the byte ranges
+        that differ from the previous frame written are touched, so a small
+        change results in a small write. Returns the number of bytes written.
+        
+        Keyword arguments:
+        data        -- frame data (a string)
+        """
+        if self.last_frame is None or len(self.last_frame) != len(data) or self.line_length <= 0:
+            self.buffer[0:len(data)] = data
+            written = len(data)
+        else:
+            written = 0
+            for start, end in get_damage(self.last_frame, data, self.line_length):
+                self.buffer[start:end] = data[start:end]
+                written += end - start
+        self.last_frame = data
+        self.bytes_written += written
+        return written
         
     def get_fixed_info(self):
         fixed_info = fb_fix_screeninfo()
@@ -17,6 +17,7 @@
 import dbus.service
 import g15globals
 import g15theme
+import g15screen
 import util.g15scheduler as g15scheduler
 import util.g15gconf as g15gconf
 import util.g15cairo as g15cairo
@@ -24,6 +25,11 @@ import util.g15icontools as g15icontools
 import g15driver
 import g15devices
 import gobject
+import struct
+import cairo
+import mmap
+import os
+import tempfile
 
 
 from cStringIO import StringIO
@@ -40,9 +46,254 @@ CONTROL_ACQUISITION_IF_NAME="org.gnome15.Control"
 SCREEN_IF_NAME="org.gnome15.Screen"
 DEVICE_IF_NAME="org.gnome15.Device"
 
+"""
+Drawing commands that may be sent in a batch to DrawBatch(). Each command is 
+encoded as a single opcode byte followed by its arguments, packed little-endian
+according to the argument signature in DRAW_COMMANDS. The signature letters have 
+the same meaning as D-Bus signatures (d=double, n=int16, b=boolean, s=string, 
+y=bytes). Strings are prefixed by a 16 bit length and bytes by a 32 bit length.
+"""
+DRAW_NEW_SURFACE = 1
+DRAW_SAVE = 2
+DRAW_RESTORE = 3
+DRAW_SURFACE = 4
+DRAW_SET_LINE_WIDTH = 5
+DRAW_LINE = 6
+DRAW_RECTANGLE = 7
+DRAW_CIRCLE = 8
+DRAW_ARC = 9
+DRAW_FOREGROUND = 10
+DRAW_SET_FONT = 11
+DRAW_TEXT = 12
+DRAW_IMAGE = 13
+DRAW_IMAGE_DATA = 14
+DRAW_REDRAW = 15
+
+DRAW_COMMANDS = { DRAW_NEW_SURFACE : ( "NewSurface", "" ),
+                  DRAW_SAVE : ( "Save", "" ),
+                  DRAW_RESTORE : ( "Restore", "" ),
+                  DRAW_SURFACE : ( "DrawSurface", "" ),
+                  DRAW_SET_LINE_WIDTH : ( "SetLineWidth", "d" ),
+                  DRAW_LINE : ( "Line", "dddd" ),
+                  DRAW_RECTANGLE : ( "Rectangle", "ddddb" ),
+                  DRAW_CIRCLE : ( "Circle", "dddb" ),
+                  DRAW_ARC : ( "Arc", "dddddb" ),
+                  DRAW_FOREGROUND : ( "Foreground", "nnnn" ),
+                  DRAW_SET_FONT : ( "SetFont", "dsss" ),
+                  DRAW_TEXT : ( "Text", "sdddds" ),
+                  DRAW_IMAGE : ( "Image", "sdddd" ),
+                  DRAW_IMAGE_DATA : ( "ImageData", "ydd" ),
+                  DRAW_REDRAW : ( "Redraw", "" ) }
+
+_DRAW_STRUCTS = { "d" : struct.Struct("<d"),
+                  "n" : struct.Struct("<h"),
+                  "b" : struct.Struct("<B"),
+                  "s" : struct.Struct("<H"),
+                  "y" : struct.Struct("<I") }
+_OPCODE_STRUCT = struct.Struct("<B")
+
+"""
+Number of frames in a shared frame buffer. The client draws into one frame while
+the other is being displayed
+"""
+SHARED_FRAMES = 2
+
+"""
+Where shared frame buffers are created, if it exists
+"""
+SHARED_FRAME_DIR = "/dev/shm"
+
 # Logging
 import logging
 logger = logging.getLogger(__name__)
+
+def encode_draw_command(opcode, *args):
+    """
+    Encode a single drawing command for DrawBatch()
+    
+    Keyword arguments:
+    opcode        -- one of the DRAW_ constants
+    args          -- arguments, as for the D-Bus method of the same name 
+    """
+    signature = DRAW_COMMANDS[opcode][1]
+    if len(args) != len(signature):
+        raise Exception("Drawing command %d expects %d arguments, got %d" % ( opcode, len(signature), len(args) ))
+    buf = [ _OPCODE_STRUCT.pack(opcode) ]
+    for arg_type, arg in zip(signature, args):
+        if arg_type == "s":
+            arg = arg.encode("utf-8") if isinstance(arg, unicode) else str(arg)
+            buf.append(_DRAW_STRUCTS["s"].pack(len(arg)))
+            buf.append(arg)
+        elif arg_type == "y":
+            arg = str(arg)
+            buf.append(_DRAW_STRUCTS["y"].pack(len(arg)))
+            buf.append(arg)
+        else:
+            buf.append(_DRAW_STRUCTS[arg_type].pack(arg))
+    return "".join(buf)
+
+def decode_draw_batch(data):
+    """
+    Generator that decodes a batch of drawing commands, yielding a tuple of
+    opcode and argument list for each one
+    
+    Keyword arguments:
+    data          -- encoded commands
+    """
+    offset = 0
+    length = len(data)
+    while offset < length:
+        opcode = _OPCODE_STRUCT.unpack_from(data, offset)[0]
+        offset += 1
+        if not opcode in DRAW_COMMANDS:
+            raise Exception("Unknown drawing command %d at offset %d" % ( opcode, offset - 1 ))
+        args = []
+        for arg_type in DRAW_COMMANDS[opcode][1]:
+            arg_struct = _DRAW_STRUCTS[arg_type]
+            val = arg_struct.unpack_from(data, offset)[0]
+            offset += arg_struct.size
+            if arg_type == "s" or arg_type == "y":
+                if offset + val > length:
+                    raise Exception("Truncated drawing command %d" % opcode)
+                arg = data[offset:offset + val]
+                offset += val
+                val = arg.decode("utf-8") if arg_type == "s" else arg
+            elif arg_type == "b":
+                val = val != 0
+            args.append(val)
+        yield opcode, args
+        
+class G15SharedFrame():
+    """
+    Client side helper for drawing into a page's shared frame buffer. Draw into the
+    surface returned by get_surface(), then call present() to show it. Each present()
+    switches to the other frame in the buffer, so get_surface() should be called again
+    for every frame. present() waits until the service has finished with the frame
+    that will be drawn into next.
+    """
+    
+    def __init__(self, page):
+        self._page = page
+        path, self.width, self.height, self.stride, self.frame_size, self.frames = page.GetSharedFrame()
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self._maps, self._surfaces = _map_frames(fd, self.width, self.height, self.stride, self.frame_size, self.frames)
+        finally:
+            os.close(fd)
+        self._seq = 0
+        
+    def get_surface(self):
+        """
+        Get the surface for the next frame
+        """
+        return self._surfaces[self._seq % self.frames]
+    
+    def present(self):
+        """
+        Show the frame that has been drawn on the page
+        """
+        self._surfaces[self._seq % self.frames].flush()
+        self._page.Present(dbus.UInt64(self._seq))
+        self._seq += 1
+        
+    def close(self):
+        self._surfaces = []
+        for m in self._maps:
+            m.close()
+        
+def _get_frame_size(stride, height):
+    """
+    Get the size of one frame in a shared frame buffer. Each frame starts on a 
+    boundary that it may be mapped from
+    """
+    size = stride * height
+    return ( ( size + mmap.ALLOCATIONGRANULARITY - 1 ) // mmap.ALLOCATIONGRANULARITY ) * mmap.ALLOCATIONGRANULARITY
+        
+def _map_frames(fd, width, height, stride, frame_size, frames):
+    """
+    Map each frame of a shared frame buffer and create a cairo surface over it. No
+    pixels are copied, drawing on a surface writes directly into the buffer
+    """
+    maps = []
+    surfaces = []
+    for i in range(frames):
+        frame_map = mmap.mmap(fd, stride * height, offset = i * frame_size)
+        maps.append(frame_map)
+        surfaces.append(cairo.ImageSurface.create_for_data(frame_map, cairo.FORMAT_ARGB32, width, height, stride))
+    return maps, surfaces
+        
+class G15DrawBatch():
+    """
+    Client side helper that collects drawing commands so they may be sent to a
+    page in a single D-Bus call. The methods mirror those of the page interface.
+    """
+    
+    def __init__(self):
+        self._commands = []
+        
+    def new_surface(self):
+        self._commands.append(encode_draw_command(DRAW_NEW_SURFACE))
+        
+    def save(self):
+        self._commands.append(encode_draw_command(DRAW_SAVE))
+        
+    def restore(self):
+        self._commands.append(encode_draw_command(DRAW_RESTORE))
+        
+    def draw_surface(self):
+        self._commands.append(encode_draw_command(DRAW_SURFACE))
+        
+    def set_line_width(self, line_width):
+        self._commands.append(encode_draw_command(DRAW_SET_LINE_WIDTH, line_width))
+        
+    def line(self, x1, y1, x2, y2):
+        self._commands.append(encode_draw_command(DRAW_LINE, x1, y1, x2, y2))
+        
+    def rectangle(self, x, y, width, height, fill = False):
+        self._commands.append(encode_draw_command(DRAW_RECTANGLE, x, y, width, height, fill))
+        
+    def circle(self, x, y, radius, fill = False):
+        self._commands.append(encode_draw_command(DRAW_CIRCLE, x, y, radius, fill))
+        
+    def arc(self, x, y, radius, start_angle, end_angle, fill = False):
+        self._commands.append(encode_draw_command(DRAW_ARC, x, y, radius, start_angle, end_angle, fill))
+        
+    def foreground(self, r, g, b, a = 255):
+        self._commands.append(encode_draw_command(DRAW_FOREGROUND, r, g, b, a))
+        
+    def set_font(self, font_size = 12.0, font_family = "Sans", font_style = "normal", font_weight = "normal"):
+        self._commands.append(encode_draw_command(DRAW_SET_FONT, font_size, font_family, font_style, font_weight))
+        
+    def text(self, text, x, y, width, height, constraints = "left"):
+        self._commands.append(encode_draw_command(DRAW_TEXT, text, x, y, width, height, constraints))
+        
+    def image(self, path, x, y, width = 0, height = 0):
+        self._commands.append(encode_draw_command(DRAW_IMAGE, path, x, y, width, height))
+        
+    def image_data(self, image_data, x, y):
+        self._commands.append(encode_draw_command(DRAW_IMAGE_DATA, image_data, x, y))
+        
+    def redraw(self):
+        self._commands.append(encode_draw_command(DRAW_REDRAW))
+        
+    def get_data(self):
+        """
+        Get all of the commands collected so far, encoded for DrawBatch()
+        """
+        return "".join(self._commands)
+    
+    def clear(self):
+        self._commands = []
+        
+    def send(self, page):
+        """
+        Send all of the commands collected so far to a page, and start a new batch
+        
+        Keyword arguments:
+        page          -- D-Bus proxy (or interface) for the page
+        """
+        page.DrawBatch(dbus.ByteArray(self.get_data()))
+        self.clear()
     
 class AbstractG15DBUSService(dbus.service.Object):
     
@@ -269,6 +520,7 @@ class G15DBUSScreenService(AbstractG15DBUSService):
         if page.id in self._dbus_pages:
             dbus_page = self._dbus_pages[page.id]
             self.PageDeleted(dbus_page._bus_name)
+            dbus_page._removing()
             dbus_page.remove_from_connection()
             del self._dbus_pages[page.id]
         else:
@@ -605,6 +857,11 @@ class G15DBUSPageService(AbstractG15DBUSService):
         self._page = page
         self._timer = None        
         self._page.key_handlers.append(self)
+        self._shared_frame_path = None
+        self._shared_frame_maps = None
+        self._shared_frame_surfaces = None
+        self._shared_frame_owner = None
+        self._shared_frame_seq = None
             
     @dbus.service.method(PAGE_IF_NAME, in_signature='b')
     def SetReceiveActions(self, enabled):
@@ -718,6 +975,68 @@ class G15DBUSPageService(AbstractG15DBUSService):
         file_str.close()
         self._page.image(img_surface, x, y)
     
+    @dbus.service.method(PAGE_IF_NAME, in_signature='ay', byte_arrays = True)
+    def DrawBatch(self, commands):
+        """
+        Run a batch of drawing commands, as encoded by encode_draw_command() 
+        or G15DrawBatch. Each command has the same effect as the method of 
+        the same name.
+        """
+        for opcode, args in decode_draw_batch(str(commands)):
+            getattr(self, DRAW_COMMANDS[opcode][0])(*args)
+    
+    @dbus.service.method(PAGE_IF_NAME, in_signature='', out_signature='suuuuu', sender_keyword = 'sender')
+    def GetSharedFrame(self, sender = None):
+        """
+        Get a buffer that may be used to send frames without copying pixels over
+        D-Bus. The client maps the file at the returned path and draws ARGB32 pixels
+        of the returned width, height and stride into one of the frames in it, then
+        calls Present() with a sequence number. Frame (sequence % number of frames) 
+        is shown. G15SharedFrame does all of this for you. The buffer is removed
+        when the page is deleted, or when the client that asked for it goes away.
+        
+        Returns path, width, height, stride, frame size and number of frames
+        """
+        width, height = self._screen.driver.get_size()
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width)
+        frame_size = _get_frame_size(stride, height)
+        if self._shared_frame_path is None:
+            fd, path = tempfile.mkstemp(prefix = "gnome15-frame-", dir = SHARED_FRAME_DIR if os.path.isdir(SHARED_FRAME_DIR) else None)
+            try:
+                os.ftruncate(fd, frame_size * SHARED_FRAMES)
+                self._shared_frame_maps, self._shared_frame_surfaces = _map_frames(fd, width, height, stride, frame_size, SHARED_FRAMES)
+            except:
+                os.unlink(path)
+                raise
+            finally:
+                os.close(fd)
+            self._shared_frame_path = path
+            self._shared_frame_seq = None
+            logger.info("Created shared frame buffer %s for page %s", path, self._page.id)
+        self._shared_frame_owner = sender
+        return ( self._shared_frame_path, width, height, stride, frame_size, SHARED_FRAMES )
+    
+    @dbus.service.method(PAGE_IF_NAME, in_signature='t', async_callbacks = ('reply_handler', 'error_handler'))
+    def Present(self, seq, reply_handler, error_handler):
+        """
+        Show a frame from the shared frame buffer (see GetSharedFrame()). Sequence
+        numbers must increase with every frame. The reply is not sent until nothing
+        is being painted from the other frames in the buffer, so once it arrives the
+        client may draw into the next frame without tearing the one being shown.
+        """
+        if self._shared_frame_surfaces is None:
+            error_handler(Exception("No shared frame buffer, call GetSharedFrame() first"))
+            return
+        if self._shared_frame_seq is not None and seq <= self._shared_frame_seq:
+            error_handler(Exception("Frame %d is not newer than the last frame presented (%d)" % ( seq, self._shared_frame_seq )))
+            return
+        self._shared_frame_seq = seq
+        surface = self._shared_frame_surfaces[seq % len(self._shared_frame_surfaces)]
+        surface.mark_dirty()
+        self._page.buffer = surface
+        self._screen.redraw(self._page)
+        g15screen.run_on_redraw(self._frame_released, reply_handler)
+    
     @dbus.service.method(PAGE_IF_NAME, in_signature='')
     def CancelTimer(self):
         self._timer.cancel()
@@ -776,6 +1095,43 @@ class G15DBUSPageService(AbstractG15DBUSService):
     def action_performed(self, binding):
         if self.IsVisible():
             AbstractG15DBUSService.action_performed(self, binding)
+            
+    """
+    Private
+    """
+    def _frame_released(self, reply_handler):
+        """
+        Called on the redraw queue after a frame has been presented. Any paint of 
+        the previous frame has finished once the draw lock is free, after which the 
+        page only paints from the new frame. 
+        """
+        self._screen.draw_lock.acquire()
+        self._screen.draw_lock.release()
+        gobject.idle_add(reply_handler)
+        
+    def _removing(self):
+        self._release_shared_frame()
+            
+    def _release_shared_frame(self):
+        if self._shared_frame_path is not None:
+            # The memory must not be unmapped while the page is painted from it
+            self._screen.draw_lock.acquire()
+            try:
+                if self._page.buffer in self._shared_frame_surfaces:
+                    self._page.buffer = None
+                self._shared_frame_surfaces = None
+                for frame_map in self._shared_frame_maps:
+                    frame_map.close()
+                self._shared_frame_maps = None
+            finally:
+                self._screen.draw_lock.release()
+            try:
+                os.unlink(self._shared_frame_path)
+            except OSError as e:
+                logger.debug("Could not remove shared frame buffer %s", self._shared_frame_path, exc_info = e)
+            logger.info("Removed shared frame buffer %s for page %s", self._shared_frame_path, self._page.id)
+            self._shared_frame_path = None
+            self._shared_frame_owner = None
 
 class G15DBUSService(AbstractG15DBUSService):
     
@@ -829,6 +1185,8 @@ class G15DBUSService(AbstractG15DBUSService):
         for dbus_device in self._dbus_devices:
             self._silently_remove_from_connector(dbus_device)
         for screen in self._dbus_screens:
+            for dbus_page in self._dbus_screens[screen]._dbus_pages.values():
+                dbus_page._release_shared_frame()
             self._silently_remove_from_connector(self._dbus_screens[screen])    
         self._silently_remove_from_connector(self)
         
@@ -980,6 +1338,11 @@ class G15DBUSService(AbstractG15DBUSService):
     """
     def _name_owner_changed(self, name, old_owner, new_owner):
         for screen in self._dbus_screens.values():
+            if old_owner and not new_owner:
+                for dbus_page in screen._dbus_pages.values():
+                    if dbus_page._shared_frame_owner == name:
+                        logger.info("Client %s of shared frame buffer for page %s has gone", name, dbus_page._page.id)
+                        dbus_page._release_shared_frame()
             if name in screen._clients and old_owner and not new_owner:
                 logger.info("Cleaning up DBUS client %s", name)
                 client = screen._clients[name]
@@ -175,6 +175,7 @@ CAIRO_IMAGE_FORMAT=4
 FX_QUEUE = "ControlEffects"
 
 import util.g15scheduler as g15scheduler
+import util.g15surfacepool as g15surfacepool
 import time
 import colorsys
 from threading import Lock
@@ -500,6 +501,9 @@ class AbstractDriver(object):
         self.connecting = False
         self.all_off_on_disconnect = True
         self.allow_multiple = True
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.surface_pool = g15surfacepool.SurfacePool()
         self._reset_state()
         
     def has_memory_bank(self):
@@ -603,6 +607,7 @@ class AbstractDriver(object):
             raise Exception("Already connected")
         logger.info("Connecting driver %s", self.get_name())
         self.connecting = True
+        self.invalidate_frame()
         try:
             self._on_connect()
         finally:
@@ -682,6 +687,40 @@ class AbstractDriver(object):
         raise NotImplementedError( "Not implemented" )
     
     
+    def is_frame_changed(self, buf):
+        """
+        Compare a fully converted frame with the last one written to the device.
+        Drivers should call this from paint() just before the device write, and
+        skip the write if False is returned. The frames sent and skipped counters
+        are updated accordingly.
+        
+        Keyword arguments:
+        buf            -- converted frame data (a string)
+        """
+        if buf == self._last_frame:
+            self.frames_skipped += 1
+            return False
+        self._last_frame = buf
+        self.frames_sent += 1
+        return True
+    
+    def invalidate_frame(self):
+        """
+        Forget the last frame written, so the next one will always be sent to
+        the device
+        """
+        self._last_frame = None
+        
+    def get_frame_statistics(self):
+        """
+        Get a dictionary of counters for frames sent to the device, frames
+        skipped because they were unchanged and surfaces allocated while
+        converting frames
+        """
+        return { "frames_sent" : self.frames_sent,
+                 "frames_skipped" : self.frames_skipped,
+                 "surfaces_allocated" : self.surface_pool.allocations }
+    
     def update_control(self, control):
         """
         Synchronize a control with the keyboard. For example, if the control was for the
@@ -789,6 +828,7 @@ class AbstractDriver(object):
         self.control_update_listeners = []
         self.acquired_controls = {}
         self.initial_acquired_control_values = {}
+        self.invalidate_frame()
 
 def rgb_to_hex(rgb):
     return '#%02x%02x%02x' % rgb
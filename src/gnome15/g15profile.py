@@ -42,6 +42,8 @@ import logging
 import re
 import zipfile
 from cStringIO import StringIO
+from threading import RLock
+from collections import deque
  
 logger = logging.getLogger(__name__)
 active_profile = None
@@ -55,7 +57,8 @@ to be informed when macro profiles change
 profile_listeners = []
 
 wm = pyinotify.WatchManager()
-mask = pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_ATTRIB  # watched events
+mask = pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_ATTRIB | \
+       pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM # watched events
 
 # Create macro profiles directory
 conf_dir = os.path.join(g15globals.user_config_dir, "macro_profiles")
@@ -74,7 +77,15 @@ class EventHandler(pyinotify.ProcessEvent):
             id_no = path.split(".")[0]
             return ( id_no, device_uid )
     
+    def _invalidate(self, event):
+        if event.dir:
+            profile_cache.invalidate()
+        elif event.pathname.endswith(".macros"):
+            profile_cache.invalidate(event.pathname)
+    
     def _notify(self, event):
+        # The cache must be up to date before listeners look at profiles
+        self._invalidate(event)
         ids = self._get_profile_ids(event)
         if ids:
             for profile_listener in profile_listeners:
@@ -91,12 +102,270 @@ class EventHandler(pyinotify.ProcessEvent):
 
     def process_IN_DELETE(self, event):
         self._notify(event)
+        
+    def process_IN_MOVED_TO(self, event):
+        # Profiles are saved by renaming a temporary file, listeners are told about
+        # the IN_ATTRIB event that follows
+        self._invalidate(event)
+        
+    def process_IN_MOVED_FROM(self, event):
+        self._invalidate(event)
+        
+class ProfileCache():
+    """
+    Process wide cache of loaded profiles, so profiles are only read and
+    parsed again when their files change. Loaded profiles are keyed by device
+    and file, and stamped with the file's modification time (and size and
+    mode). The list of profile files in each profile directory is cached too.
+    The inotify EventHandler invalidates entries and lists as files change,
+    so looking up a cached profile never touches the disk.
+    
+    Profile objects returned from the cache are shared, so any changes made
+    to them should be saved. The generation attribute is incremented whenever
+    the cache is invalidated.
+    """
+    
+    def __init__(self):
+        self.loads = 0
+        self._lock = RLock()
+        self.generation = 0
+        self._profiles = {}
+        self._listings = {}
+        self._listed = set()
+        
+    def get(self, device, profile_id, path):
+        """
+        Get a profile, loading it only if it is not cached. None will be 
+        returned if the file does not exist.
+        
+        Keyword arguments:
+        device        -- device associated with profile
+        profile_id    -- ID of profile
+        path          -- path of profile file
+        """
+        key = ( device.uid, path )
+        self._lock.acquire()
+        try:
+            entry = self._profiles.get(key)
+            if entry is not None:
+                return entry[1]
+            generation = self.generation
+        finally:
+            self._lock.release()
+            
+        stamp = _get_stamp(path)
+        if stamp is None:
+            return None
+        profile = G15Profile(device, profile_id, file_path = path)
+        self._lock.acquire()
+        try:
+            self.loads += 1
+            # Do not cache if the file changed while it was being loaded
+            if generation == self.generation:
+                self._profiles[key] = ( stamp, profile )
+        finally:
+            self._lock.release()
+        return profile
+    
+    def get_profile_files(self, device):
+        """
+        Get a list of ( profile ID, path ) tuples for all profile files
+        in all profile directories for a device.
+        
+        Keyword arguments:
+        device        -- device associated with profiles
+        """
+        return self._get_listing(device)[0]
+    
+    def find(self, device, profile_id):
+        """
+        Get the path of the file for a profile ID, or None if there is no 
+        such profile for the device.
+        
+        Keyword arguments:
+        device        -- device associated with profile
+        profile_id    -- ID of profile
+        """
+        return self._get_listing(device)[1].get(profile_id)
+    
+    def _get_listing(self, device):
+        self._lock.acquire()
+        try:
+            listing = self._listings.get(device.uid)
+            if listing is not None:
+                return listing
+            generation = self.generation
+        finally:
+            self._lock.release()
+            
+        files = []
+        paths = {}
+        for profile_dir in get_all_profile_dirs(device):
+            if os.path.exists(profile_dir):
+                for profile in os.listdir(profile_dir):
+                    if not profile.startswith(".") and profile.endswith(".macros"):
+                        profile_id = ".".join(profile.split(".")[:-1])
+                        path = os.path.abspath("%s/%s" % ( profile_dir, profile ))
+                        files.append(( profile_id, path ))
+                        # The first directory a profile is found in wins
+                        paths.setdefault(profile_id, path)
+                        
+        listing = ( files, paths )
+        self._lock.acquire()
+        try:
+            if generation == self.generation:
+                self._listings[device.uid] = listing
+                self._listed.update([ path for profile_id, path in files ])
+        finally:
+            self._lock.release()
+        return listing
+        
+    def invalidate(self, path = None):
+        """
+        Invalidate the cache for a profile file that has changed, or the 
+        whole cache if no path is provided. A cached profile is only discarded
+        if its file has really changed since it was loaded.
+        
+        Keyword arguments:
+        path          -- path of profile file that has changed
+        """
+        self._lock.acquire()
+        try:
+            self.generation += 1
+            if path is None:
+                self._profiles = {}
+                self._listings = {}
+                self._listed = set()
+                return
+            path = os.path.abspath(path)
+            stamp = _get_stamp(path)
+            for key in [ key for key in self._profiles if key[1] == path ]:
+                if self._profiles[key][0] != stamp:
+                    del self._profiles[key]
+            if stamp is None or not path in self._listed:
+                self._listings = {}
+                self._listed = set()
+        finally:
+            self._lock.release()
+            
+class ProfileMatcher():
+    """
+    Chooses the profile to activate when a window is focused or a command is
+    launched. The window names of all profiles that activate on focus are
+    compiled into a single Aho-Corasick automaton, so a window title is 
+    matched against every profile in one pass over the title. When more 
+    than one window name is found, the profile that comes first wins, just
+    as when each profile is tested in turn. Launch patterns are compiled
+    once. Use get_matcher() to get a matcher that is rebuilt when profiles
+    change.
+    
+    Keyword arguments:
+    profiles        -- profiles in order of preference
+    default_profile -- the default profile, which is never chosen by window name
+    """
+    
+    def __init__(self, profiles, default_profile = None):
+        self.generation = None
+        self._goto = [ {} ]
+        self._fail = [ 0 ]
+        self._output = [ None ]
+        self._window_profiles = []
+        self._launch_profiles = []
+        for profile in profiles:
+            if profile != default_profile and profile.activate_on_focus and len(profile.window_name) > 0:
+                self._add_window_name(profile.window_name.lower(), len(self._window_profiles))
+                self._window_profiles.append(profile)
+            if profile.launch_pattern is not None:
+                try:
+                    self._launch_profiles.append(( re.compile(profile.launch_pattern), profile ))
+                except re.error as e:
+                    logger.warning("Invalid launch pattern for profile %s", profile.name, exc_info = e)
+        self._build_failure_links()
+        
+    def match_window(self, application_name):
+        """
+        Get the profile that should be activated when a window or application
+        is focused, or None if no profile matches.
+        
+        Keyword arguments:
+        application_name    -- window title or application name
+        """
+        if application_name is None or len(self._window_profiles) == 0:
+            return None
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        best = None
+        state = 0
+        for c in application_name.lower():
+            while state != 0 and not c in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            index = output[state]
+            if index is not None and ( best is None or index < best ):
+                best = index
+                if best == 0:
+                    break
+        return self._window_profiles[best] if best is not None else None
+    
+    def match_command(self, command_line):
+        """
+        Get the first profile whose launch pattern matches a command line, or
+        None if no profile matches. See G15Profile.can_launch().
+        
+        Keyword arguments:
+        command_line        -- command line with each argument wrapped in quotes
+        """
+        for pattern, profile in self._launch_profiles:
+            if pattern.search(command_line):
+                return profile
+            
+    def _add_window_name(self, window_name, index):
+        state = 0
+        for c in window_name:
+            next_state = self._goto[state].get(c)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][c] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        if self._output[state] is None:
+            self._output[state] = index
+            
+    def _build_failure_links(self):
+        # Breadth first, so the failure state (which is shallower) is always complete
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state != 0 and not c in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                fail_state = self._goto[fail_state].get(c, 0)
+                self._fail[next_state] = fail_state
+                
+                # A state also matches everything its failure state matches
+                fail_output = self._output[fail_state]
+                if fail_output is not None and ( self._output[next_state] is None or fail_output < self._output[next_state] ):
+                    self._output[next_state] = fail_output
+            
+def _get_stamp(path):
+    try:
+        st = os.stat(path)
+        return ( st.st_mtime, st.st_size, st.st_mode )
+    except OSError:
+        return None
+            
+profile_cache = ProfileCache()
 
 notifier = pyinotify.ThreadedNotifier(wm, EventHandler())
 notifier.name = "ProfilePyInotify"
 notifier.setDaemon(True)
 notifier.start()
-wdd = wm.add_watch(conf_dir, mask, rec=True)
+wdd = wm.add_watch(conf_dir, mask, rec=True, auto_add=True)
 
 
 '''
@@ -133,6 +402,8 @@ DEFAULT_REPEAT_DELAY = -1.0
 
 
 __profile_dirs = []
+__profile_dir_watches = {}
+__matchers = {}
 
 def add_profile_dir(profile_dir):
     '''
@@ -142,6 +413,8 @@ def add_profile_dir(profile_dir):
     profile_dir    -- profile directory to register
     '''
     __profile_dirs.append(profile_dir)
+    __profile_dir_watches[profile_dir] = wm.add_watch(profile_dir, mask, rec=True, auto_add=True)
+    profile_cache.invalidate()
 
 def remove_profile_dir(profile_dir):
     '''
@@ -151,6 +424,10 @@ def remove_profile_dir(profile_dir):
     profile_dir    -- profile directory to de-register
     '''
     __profile_dirs.remove(profile_dir)
+    watches = __profile_dir_watches.pop(profile_dir, None)
+    if watches:
+        wm.rm_watch([ wd for wd in watches.values() if wd > 0 ])
+    profile_cache.invalidate()
     
 def get_profile_by_name(device, name):
     """
@@ -169,27 +446,39 @@ def get_profile_by_name(device, name):
 def get_profiles(device):
     '''
     Get list of all configured macro profiles for the specified device.
+    Profiles are loaded from the profile cache, so are only read from disk
+    if they have changed.
     
     Keyword arguments:
     device        -- device associated with profiles
     '''
     profiles = []
-    for profile_dir in get_all_profile_dirs(device):
-        if os.path.exists(profile_dir):
-            for profile in os.listdir(profile_dir):
-                if not profile.startswith(".") and profile.endswith(".macros"):
-                    profile_id = ".".join(profile.split(".")[:-1])
-                    profile_object = G15Profile(device, profile_id, \
-                                               file_path = "%s/%s" % \
-                                               ( profile_dir, profile ))
-                    if device.model_id in profile_object.models:
-                        profiles.append(profile_object)
+    for profile_id, path in profile_cache.get_profile_files(device):
+        profile_object = profile_cache.get(device, profile_id, path)
+        if profile_object is not None and device.model_id in profile_object.models:
+            profiles.append(profile_object)
                         
     if len(profiles) == 0:
         return [ create_default(device) ]
                         
     return profiles
 
+def get_matcher(device):
+    '''
+    Get the ProfileMatcher for the specified device. The matcher is only
+    rebuilt when the profile cache has changed since it was last built.
+    
+    Keyword arguments:
+    device        -- device associated with profiles
+    '''
+    generation = profile_cache.generation
+    matcher = __matchers.get(device.uid)
+    if matcher is None or matcher.generation != generation:
+        matcher = ProfileMatcher(get_profiles(device), get_default_profile(device))
+        matcher.generation = generation
+        __matchers[device.uid] = matcher
+    return matcher
+
 def get_all_profile_dirs(device):
     """
     Get a list of all the directories profiles are searched for in.
@@ -238,17 +527,17 @@ def generate_profile_id():
 def get_profile(device, profile_id):
     """
     Get a profile given the device it is associated with and it's ID. The
-    profile will be fully loaded on return. The object returned will be a 
-    new instance.
+    profile will be fully loaded on return. The object returned is shared
+    with other users of the profile cache, and will only be a new instance if
+    the profile has changed on disk.
     
     Keyword arguments:
     device        -- device associated with profile
     profile_id    -- ID of profile to load
     """
-    for profile_dir in get_all_profile_dirs(device):
-        path = "%s/%s.macros" % ( profile_dir, profile_id )
-        if os.path.exists(path):
-            return G15Profile(device, profile_id, file_path = path);
+    path = profile_cache.find(device, str(profile_id))
+    if path is not None:
+        return profile_cache.get(device, profile_id, path)
 
 def get_active_profile(device):
     """
@@ -379,9 +668,7 @@ def find_profile_for_command(args, device):
         
     logger.info("Processed command '%s'", command_line)
     
-    for p in get_profiles(device):
-        if p.can_launch(command_line):
-            return p
+    return get_matcher(device).match_command(command_line)
         
 def to_key_state_name(key_state_id):
     """
@@ -895,6 +1182,7 @@ class G15Profile(object):
         Delete this macro profile
         """
         os.remove(self.filename)
+        profile_cache.invalidate(self.filename)
         
     def delete_macro(self, activate_on, memory, keys):
         """
@@ -1159,6 +1447,7 @@ class G15Profile(object):
                 os.utime(save_file, None)
             finally:
                 fhandle.close()
+            profile_cache.invalidate(save_file)
         else:
             self.parser.write(save_file)
         
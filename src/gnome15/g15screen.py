@@ -40,6 +40,26 @@ Paint stages
 BACKGROUND_PAINTER = 0
 FOREGROUND_PAINTER = 1
 
+"""
+Default maximum number of frames per second drawn for a device. Redraw requests
+made faster than this are merged. May be overridden by the max_fps key of the
+device, where 0 means unlimited
+"""
+DEFAULT_MAX_FPS = 30
+
+"""
+Redraw requests that only affect hidden pages (i.e. their panel painters) are 
+drawn at this fraction of the maximum frame rate
+"""
+HIDDEN_PAGE_FPS_FACTOR = 0.5
+
+"""
+Redraws that only affect hidden pages are dropped if they have not started this
+many seconds after they were due, i.e. when the redraw queue is backed up. Redraws
+of the visible page and page changes are run first and are never dropped
+"""
+HIDDEN_REDRAW_DEADLINE = 1.0
+
 """
 Simple colors
 """
@@ -51,6 +71,7 @@ import util.g15pythonlang as g15pythonlang
 import util.g15gconf as g15gconf
 import util.g15cairo as g15cairo
 import util.g15icontools as g15icontools
+import util.jobqueue as jobqueue
 import g15profile
 import g15globals
 import g15drivermanager
@@ -252,6 +273,25 @@ class Painter():
         raise Exception("Not implemented")
     
     
+class RedrawRequest():
+    """
+    All the redraw requests that have been made since the last frame, merged into
+    one
+    """
+    
+    def __init__(self):
+        self.pages = set()
+        self.content_pages = set()
+        self.direction = "up"
+        self.transitions = False
+        
+    def add(self, page, direction, transitions, redraw_content):
+        self.pages.add(page)
+        if redraw_content:
+            self.content_pages.add(page)
+        self.direction = direction
+        self.transitions = self.transitions or transitions
+    
 class G15Screen():
     
     def __init__(self, plugin_manager_module, service, device):
@@ -286,11 +326,27 @@ class G15Screen():
         self.memory_bank_color_control = None
         self.acquired_controls = {}
         self.painters = []
+        self.frame_listeners = []
         self.fader = None
         self.mkey = 1
         self.temp_acquired_controls = {}
         self.key_handler = g15keyboard.G15KeyHandler(self)
         self.glass_pane = g15theme.Component("glasspane")
+        self.max_fps = DEFAULT_MAX_FPS
+        self.redraw_lock = RLock()
+        self.redraws_requested = 0
+        self.redraws_merged = 0
+        self.redraws_dropped = 0
+        self.profile_switches = 0
+        self.profile_switch_times = jobqueue.Histogram()
+        self.last_profile_switch_time = 0
+        self.max_profile_switch_time = 0
+        self.frames_rendered = 0
+        self._redraw_request = None
+        self._redraw_visible = False
+        self._redraw_scheduled = False
+        self._redraw_timer = None
+        self._last_frame_time = 0
         
         if not self._load_driver():
             raise Exception("Driver failed to load") 
@@ -311,24 +367,33 @@ class G15Screen():
         
         found = False
         if self.defeat_profile_change < 1 and not g15profile.is_locked(self.device):
-            choose_profile = None
+            start = time.time()
+            
             # Active window has changed, see if we have a profile that matches it
-            if application_name is not None:
-                for profile in g15profile.get_profiles(self.device):
-                    if not profile.get_default() and profile.activate_on_focus and len(profile.window_name) > 0 and application_name.lower().find(profile.window_name.lower()) != -1:
-                        choose_profile = profile 
-                        break
+            choose_profile = g15profile.get_matcher(self.device).match_window(application_name)
                 
             # No applicable profile found. Look for a default profile, and see if it is set to activate by default
+            activate_profile = None
             active_profile = g15profile.get_active_profile(self.device)
             if choose_profile == None:
                 default_profile = g15profile.get_default_profile(self.device)
                 
                 if (active_profile == None or active_profile.id != default_profile.id) and default_profile.activate_on_focus:
-                    default_profile.make_active()
-                    found = True
+                    activate_profile = default_profile
             elif active_profile == None or choose_profile.id != active_profile.id:
-                choose_profile.make_active()
+                activate_profile = choose_profile
+                
+            taken = time.time() - start
+            self.profile_switches += 1
+            self.profile_switch_times.add(taken)
+            self.last_profile_switch_time = taken
+            self.max_profile_switch_time = max(self.max_profile_switch_time, taken)
+            logger.debug("Chose profile %s for %s in %.3fms", 
+                         activate_profile.name if activate_profile is not None else None,
+                         application_name, taken * 1000.0)
+                
+            if activate_profile is not None:
+                activate_profile.make_active()
                 found = True
                 
         return found
@@ -361,6 +426,8 @@ class G15Screen():
         self.notify_handles.append(self.conf_client.notify_add("%s/cycle_screens" % screen_key, self.resched_cycle))
         self.notify_handles.append(self.conf_client.notify_add("%s/active_profile" % screen_key, self.active_profile_changed))
         self.notify_handles.append(self.conf_client.notify_add("%s/driver" % screen_key, self.driver_changed))
+        self.notify_handles.append(self.conf_client.notify_add("%s/max_fps" % screen_key, self._load_max_fps))
+        self._load_max_fps()
         for control in self.driver.get_controls():
             self.notify_handles.append(self.conf_client.notify_add("%s/%s" % (screen_key, control.id), self._control_changed))
         logger.info("Starting for %s is complete.", self.device.uid)
@@ -938,7 +1005,9 @@ class G15Screen():
         self.width = self.driver.get_size()[0]
         self.height = self.driver.get_size()[1]
         
-        self.surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+        self.surface_pool = g15cairo.SurfacePool()
+        self.surface = self.surface_pool.get(cairo.FORMAT_ARGB32, self.width, self.height)
+        self.old_surface = None
         self.size = (self.width, self.height)
         self.available_size = (0, 0, self.size[0], self.size[1])
         
@@ -953,6 +1022,125 @@ class G15Screen():
         self.deleting = { }
         self._do_redraw()
              
+    def _load_max_fps(self, client=None, connection_id=None, entry=None, args=None):
+        self.max_fps = max(0, g15gconf.get_int_or_default(self.conf_client, "/apps/gnome15/%s/max_fps" % self.device.uid, DEFAULT_MAX_FPS))
+        logger.info("Maximum frame rate for %s is %d", self.device.uid, self.max_fps)
+        
+    def _queue_redraw(self, page, direction, transitions, redraw_content):
+        self.redraw_lock.acquire()
+        try:
+            self.redraws_requested += 1
+            if self._redraw_request is None:
+                self._redraw_request = RedrawRequest()
+            else:
+                self.redraws_merged += 1
+            self._redraw_request.add(page, direction, transitions, redraw_content)
+            visible = page is None or page == self.visible_page
+            
+            # A redraw of the visible page may need to be brought forward if only hidden 
+            # pages were waiting to be redrawn. A hidden redraw already on the queue 
+            # cannot be taken back, it will find the request gone and do nothing
+            if self._redraw_scheduled and visible and not self._redraw_visible:
+                if self._redraw_timer is not None:
+                    self._redraw_timer.cancel()
+                self._redraw_scheduled = False
+                
+            if not self._redraw_scheduled:
+                self._schedule_redraw(visible)
+            elif visible:
+                self._redraw_visible = True
+        finally:
+            self.redraw_lock.release()
+            
+    def _schedule_redraw(self, visible):
+        """
+        Queue the job that draws the pending redraw request. Must be called with
+        the redraw lock held.
+        
+        Keyword arguments:
+        visible         -- whether the request affects the visible page
+        """
+        self._redraw_scheduled = True
+        self._redraw_visible = visible
+        delay = self._get_redraw_delay(visible)
+        if visible:
+            kwargs = { "priority" : g15scheduler.PRIORITY_HIGH }
+        else:
+            kwargs = { "priority" : g15scheduler.PRIORITY_LOW, 
+                       "deadline" : HIDDEN_REDRAW_DEADLINE,
+                       "on_drop" : self._queued_redraw_dropped }
+        if delay > 0:
+            self._redraw_timer = g15scheduler.queue(REDRAW_QUEUE, "Redraw", delay, self._do_queued_redraw, **kwargs)
+        else:
+            self._redraw_timer = None
+            g15scheduler.execute(REDRAW_QUEUE, "redraw", self._do_queued_redraw, **kwargs)
+            
+    def _queued_redraw_dropped(self):
+        """
+        Called when a redraw of hidden pages was not started before its deadline. If
+        the visible page has been asked to redraw since, it is scheduled again, 
+        otherwise the request is forgotten
+        """
+        self.redraw_lock.acquire()
+        try:
+            self._redraw_scheduled = False
+            self._redraw_timer = None
+            if self._redraw_request is not None:
+                if self._redraw_visible:
+                    self._schedule_redraw(True)
+                else:
+                    self._redraw_request = None
+                    self.redraws_dropped += 1
+        finally:
+            self.redraw_lock.release()
+            
+    def _get_redraw_delay(self, visible):
+        if self.max_fps < 1:
+            return 0
+        interval = 1.0 / self.max_fps
+        if not visible:
+            interval /= HIDDEN_PAGE_FPS_FACTOR
+        return max(0, self._last_frame_time + interval - time.time())
+    
+    def _cancel_redraw(self):
+        """
+        Forget about any waiting redraw, for when the page is about to be drawn 
+        anyway
+        """
+        self.redraw_lock.acquire()
+        try:
+            if self._redraw_timer is not None:
+                self._redraw_timer.cancel()
+                self._redraw_timer = None
+            self._redraw_request = None
+            self._redraw_scheduled = False
+        finally:
+            self.redraw_lock.release()
+    
+    def _do_queued_redraw(self):
+        self.redraw_lock.acquire()
+        try:
+            request = self._redraw_request
+            self._redraw_request = None
+            self._redraw_scheduled = False
+            self._redraw_timer = None
+        finally:
+            self.redraw_lock.release()
+            
+        if request is not None:
+            self.page_model_lock.acquire()
+            try :           
+                current_page = self._get_next_page_to_display()
+                if None in request.pages or current_page in request.pages:
+                    redraw_content = None in request.content_pages or current_page in request.content_pages
+                    self._draw_page(current_page, request.direction, request.transitions, redraw_content)
+                elif len([ page for page in request.pages if page.panel_painter != None ]) > 0:
+                    self._draw_page(current_page, request.direction, request.transitions, False)
+                else:
+                    self.redraws_dropped += 1
+            finally:    
+                self.page_model_lock.release()
+        
     def _control_changed(self, client, connection_id, entry, args):
         control_id = entry.get_key().split("/")[-1]
         control = self.driver.get_control(control_id)
@@ -1136,22 +1324,66 @@ class G15Screen():
     
     def cycle_to(self, page, transitions=True):
         g15scheduler.clear_jobs(REDRAW_QUEUE)
-        g15scheduler.execute(REDRAW_QUEUE, "cycleTo", self._do_cycle_to, page, transitions)
+        self._cancel_redraw()
+        g15scheduler.execute(REDRAW_QUEUE, "cycleTo", self._do_cycle_to, page, transitions, priority = g15scheduler.PRIORITY_HIGH)
             
     def cycle(self, number, transitions=True):
         g15scheduler.clear_jobs(REDRAW_QUEUE)
-        g15scheduler.execute(REDRAW_QUEUE, "doCycle", self._do_cycle, number, transitions)
+        self._cancel_redraw()
+        g15scheduler.execute(REDRAW_QUEUE, "doCycle", self._do_cycle, number, transitions, priority = g15scheduler.PRIORITY_HIGH)
             
     def redraw(self, page=None, direction="up", transitions=True, redraw_content=True, queue=True):
+        """
+        Redraw a page. Queued redraws are merged with any others that are waiting, and 
+        drawn no faster than the maximum frame rate for the device. Redraws of the visible
+        page take priority over redraws of hidden pages.
+        
+        Keyword arguments:
+        page            -- page to redraw or None for the current page
+        direction       -- direction of any transition
+        transitions     -- whether to run transitions
+        redraw_content  -- whether to repaint the page content
+        queue           -- queue the redraw, or draw it on the current thread 
+        """
         if page:
             logger.debug("Redrawing %s", page.id)
         else:
             logger.debug("Redrawing current page")
         if queue:
-            g15scheduler.execute(REDRAW_QUEUE, "redraw", self._do_redraw, page, direction, transitions, redraw_content)
+            self._queue_redraw(page, direction, transitions, redraw_content)
         else:
+            self.redraw_lock.acquire()
+            try:
+                self.redraws_requested += 1
+            finally:
+                self.redraw_lock.release()
             self._do_redraw(page, direction, transitions, redraw_content)
             
+    def get_redraw_statistics(self):
+        """
+        Get a dictionary of counters for redraws requested, redraws merged into
+        another pending redraw, redraws that had nothing to draw, and frames 
+        actually rendered
+        """
+        return { "requested" : self.redraws_requested,
+                 "merged" : self.redraws_merged,
+                 "dropped" : self.redraws_dropped,
+                 "rendered" : self.frames_rendered,
+                 "surfaces_allocated" : self.surface_pool.allocations,
+                 "max_fps" : self.max_fps }
+            
+        
+    def get_profile_switch_statistics(self):
+        """
+        Get a dictionary of the number of times a profile was chosen for a
+        newly focused window, how long the last and slowest decisions took
+        (in microseconds), and a histogram of decision times
+        """
+        stats = { "switches" : self.profile_switches,
+                  "last_us" : int(self.last_profile_switch_time * 1000000),
+                  "max_us" : int(self.max_profile_switch_time * 1000000) }
+        stats.update(self.profile_switch_times.get_statistics("decision"))
+        return stats
         
     def set_color_for_mkey(self):
         control = self.driver.get_control_for_hint(g15driver.HINT_DIMMABLE)
@@ -1305,13 +1537,13 @@ class G15Screen():
             
             painters = sorted(self.painters, key=lambda painter: painter.z_order)
             
-            # If the visible page is changing, creating a new surface. Both surfaces are
+            # If the visible page is changing, use another surface. Both surfaces are
             # then passed to any transition functions registered
             if visible_page != self.visible_page: 
-                logger.debug("Page has changed, recreating surface")
+                logger.debug("Page has changed, switching surface")
                 if visible_page.priority == PRI_NORMAL and not self.stopping:   
                     self.service.conf_client.set_string("/apps/gnome15/%s/last_page" % self.device.uid, visible_page.id)  
-                surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+                surface = self.surface_pool.get(cairo.FORMAT_ARGB32, self.width, self.height)
                 
             self.local_data.surface = surface
             canvas = cairo.Context (surface)
@@ -1348,10 +1580,14 @@ class G15Screen():
                              str(redraw_content))
             
                          
-                # Paint the content to a new surface so it can be cached
+                # Paint the content to its own surface so it can be cached
                 if self.content_surface == None or redraw_content:
-                    self.content_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+                    if self.content_surface == None:
+                        self.content_surface = self.surface_pool.get(cairo.FORMAT_ARGB32, self.width, self.height)
                     content_canvas = cairo.Context(self.content_surface)
+                    content_canvas.set_operator(cairo.OPERATOR_CLEAR)
+                    content_canvas.paint()
+                    content_canvas.set_operator(cairo.OPERATOR_OVER)
                     self.configure_canvas(content_canvas)
                     self.visible_page.paint(content_canvas)
                 
@@ -1394,10 +1630,26 @@ class G15Screen():
                 self.transition_function(self.old_surface, surface, old_page, self.visible_page, direction)
                 
             # Now apply any global transformations and paint
+            self._last_frame_time = time.time()
             if self.painter_function != None:
                 self.painter_function(surface)
             else:
                 self.driver.paint(surface)
+            self.frames_rendered += 1
+            
+            # Frame listeners are called with the draw lock held, so must
+            # only take a quick copy of the surface if they need it. A copy 
+            # of the list is iterated as listeners may be removed from any thread
+            for listener in list(self.frame_listeners):
+                try:
+                    listener(surface)
+                except Exception as e:
+                    logger.error("Frame listener failed", exc_info = e)
+                
+            # The surface of the previous page may be re-used for the next page change
+            if surface is not self.surface:
+                self.surface_pool.release(self.surface)
+                self.surface = surface
                 
             self.old_canvas = canvas
             self.old_surface = surface
@@ -74,6 +74,11 @@ VERSION = g15globals.version
 SERVICE_QUEUE = "serviceQueue"
 MACRO_HANDLER_QUEUE = "macroHandler"
 
+# Number of workers running jobs scheduled without a queue name (mostly plugins 
+# refreshing their data). Plugins expect these jobs to run one after another, so
+# more workers must be asked for explicitly with the scheduler_workers key
+DEFAULT_SCHEDULER_WORKERS = 1
+
 special_X_keysyms = {
     ' ' : "space",
     '\t' : "Tab",
@@ -554,6 +559,8 @@ class G15Service(g15desktop.G15AbstractService):
         self.session_active = True
         self.service_host = service_host
         self.active_window = None
+        self._wnck_name_source = None
+        self._wnck_name_handle = None
         self.shutting_down = False
         self.starting_up = True
         self.conf_client = gconf.client_get_default()
@@ -741,23 +748,60 @@ class G15Service(g15desktop.G15AbstractService):
             logger.debug("Could not check active application", exc_info = e)
             pass
         
-    def _check_active_application_with_wnck(self, event=None):
+    def _monitor_active_window_with_wnck(self):
+        import wnck
+        wnck_screen = wnck.screen_get_default()
+        wnck_screen.force_update()
+        wnck_screen.connect("active-window-changed", self._check_active_application_with_wnck)
+        self._check_active_application_with_wnck(wnck_screen)
+        
+    def _check_active_application_with_wnck(self, wnck_screen, previous_window = None):
         try:
-            import wnck
-            window = wnck.screen_get_default().get_active_window()
-            if window is not None and not window.is_skip_pager():
-                app = window.get_application()
-                active_application_name = app.get_name() if app is not None else ""
-                if active_application_name != self.active_application_name:
-                    self.active_application_name = active_application_name
-                    self.active_window_title = active_application_name
-                    logger.info("Active application is now %s", self.active_application_name)
-                    for screen in self.screens:
-                        screen.set_active_application_name(active_application_name)
+            window = wnck_screen.get_active_window()
+            self._watch_wnck_name(window)
+            self._check_wnck_application_name(window)
         except Exception as e:
             logger.warning("Failed to activate profile for active window", exc_info = e)
             
-        gobject.timeout_add(500, self._check_active_application_with_wnck)
+    def _watch_wnck_name(self, window):
+        """
+        The application name of single window applications follows the window
+        title, so it may change without the active window changing. Move the
+        "name-changed" handler over to the application of the newly active
+        window (or the window itself if it has no application).
+        
+        Keyword arguments:
+        window        --    newly active wnck window or None
+        """
+        if self._wnck_name_source is not None:
+            try:
+                self._wnck_name_source.disconnect(self._wnck_name_handle)
+            except Exception as e:
+                logger.debug("Could not disconnect from previous window", exc_info = e)
+            self._wnck_name_source = None
+            self._wnck_name_handle = None
+        if window is not None:
+            app = window.get_application()
+            source = app if app is not None else window
+            self._wnck_name_handle = source.connect("name-changed", self._wnck_name_changed, window)
+            self._wnck_name_source = source
+            
+    def _wnck_name_changed(self, source, window):
+        try:
+            self._check_wnck_application_name(window)
+        except Exception as e:
+            logger.warning("Failed to activate profile for active window", exc_info = e)
+        
+    def _check_wnck_application_name(self, window):
+        if window is not None and not window.is_skip_pager():
+            app = window.get_application()
+            active_application_name = app.get_name() if app is not None else ""
+            if active_application_name != self.active_application_name:
+                self.active_application_name = active_application_name
+                self.active_window_title = active_application_name
+                logger.info("Active application is now %s", self.active_application_name)
+                for screen in self.screens:
+                    screen.set_active_application_name(active_application_name)
         
     def _check_state_of_all_devices(self, quickly = False):
         logger.info("Checking state of %d devices", len(self.devices))
@@ -843,6 +887,7 @@ class G15Service(g15desktop.G15AbstractService):
         self.notify_handles.append(self.conf_client.notify_add("/apps/gnome15/key_hold_duration", self._hidden_configuration_changed))
         self.notify_handles.append(self.conf_client.notify_add("/apps/gnome15/use_x_test", self._hidden_configuration_changed))
         self.notify_handles.append(self.conf_client.notify_add("/apps/gnome15/disable_svg_glow", self._hidden_configuration_changed))
+        self.notify_handles.append(self.conf_client.notify_add("/apps/gnome15/scheduler_workers", self._hidden_configuration_changed))
         
             
         # Monitor active application    
@@ -1044,11 +1089,9 @@ class G15Service(g15desktop.G15AbstractService):
             if active_window:
                 self._active_window_changed("", active_window)
         except Exception as e:
-            logger.warning("BAMF not available, falling back to polling WNCK.", exc_info = e)
+            logger.warning("BAMF not available, falling back to WNCK.", exc_info = e)
             try :                
-                import wnck
-                wnck.__file__
-                self._check_active_application_with_wnck()
+                self._monitor_active_window_with_wnck()
             except Exception as e:
                 logger.warning("Python Wnck not available either, no automatic profile switching", exc_info = e)
             
@@ -1077,6 +1120,7 @@ class G15Service(g15desktop.G15AbstractService):
         self.all_off_on_disconnect = g15gconf.get_bool_or_default(self.conf_client, '/apps/gnome15/all_off_on_disconnect', True)
         self.fade_keyboard_backlight_on_close = g15gconf.get_bool_or_default(self.conf_client, '/apps/gnome15/fade_keyboard_backlight_on_close', True)
         self.start_in_threads = g15gconf.get_bool_or_default(self.conf_client, '/apps/gnome15/start_in_threads', False)
+        g15scheduler.set_number_of_workers(g15scheduler.DEFAULT_QUEUE, max(1, g15gconf.get_int_or_default(self.conf_client, '/apps/gnome15/scheduler_workers', DEFAULT_SCHEDULER_WORKERS)))
         self._mark_all_pages_dirty()
         
     def _mark_all_pages_dirty(self):
@@ -38,6 +38,7 @@ for progress bars, scroll bars.
 """
 
 import os
+import math
 import cairo
 import rsvg
 import sys
@@ -57,9 +58,11 @@ import base64
 import dbusmenu
 import logging
 import time
+import hashlib
 logger = logging.getLogger(__name__)
 from string import Template
 from copy import deepcopy
+from collections import OrderedDict
 from cStringIO import StringIO
 from lxml import etree
 from threading import RLock
@@ -71,6 +74,13 @@ DEBUG_SVG=False
 # The color in SVG theme files that by default gets replaced with the current 'highlight' color
 DEFAULT_HIGHLIGHT_COLOR="#ff0000"
 
+# Maximum total size (in bytes) of the surfaces held by the static layer cache
+LAYER_CACHE_SIZE=8 * 1024 * 1024
+
+# SVG elements that are only ever rendered by reference from other elements
+NON_RENDERED_TAGS=( "defs", "clipPath", "mask", "linearGradient", "radialGradient", "pattern", "filter", 
+                    "marker", "symbol", "style", "script", "metadata", "title", "desc" )
+
 class ThemeDefinition(object):
     def __init__(self, theme_id, directory, plugin_module = None):
         self.theme_id = theme_id
@@ -145,7 +155,230 @@ class Render(object):
         self.text_boxes = text_boxes
         self.attributes = attributes
         self.processing_result = processing_result
+
+# Kinds of slot in a compiled theme document. The values are also the order slots are
+# patched in, which is the same order the processing passes run in
+SLOT_DELETE = 0
+SLOT_PROGRESS = 1
+SLOT_IMAGE = 2
+SLOT_TEXT = 3
+
+# Names used for bindings to the text and tail of a node rather than an attribute
+BINDING_TEXT = "#text"
+BINDING_TAIL = "#tail"
+
+# Types of theme property value that cannot be changed in place, so can be compared
+# with the value the working document was last patched with
+IMMUTABLE_PROPERTY_TYPES = ( basestring, int, long, float, bool, type(None) )
+
+class Slot(object):
+    """
+    A node in a compiled theme document that must be patched whenever one of
+    the theme properties it is bound to changes
+    """
+    def __init__(self, kind, index, keys):
+        self.kind = kind
+        self.index = index
+        self.keys = keys
+        self.text_box = None
+
+class Binding(object):
+    """
+    An attribute, text or tail of a node in a compiled theme document that contains
+    property placeholders
+    """
+    def __init__(self, index, name, template):
+        self.index = index
+        self.name = name
+        self.template = Template(template)
+        self.keys = _get_placeholders(template)
+
+class CompiledDocument(object):
+    """
+    The static part of a theme document. This has all of the processing that does
+    not depend on theme properties already applied (relative image paths,
+    shadows, highlight colour and default style), and is built once per theme,
+    variant and set of driver colours. It also holds an index of the slots that
+    do depend on properties, and of the nodes properties are substituted into.
+    """
+    def __init__(self, document, key):
+        self.document = document
+        self.key = key
+        self.elements = list(document.iter())
+        self.positions = dict((e, i) for i, e in enumerate(self.elements))
+        self.slots = []
+        self.slot_keys = {}
+        self.bindings = []
+        self.binding_keys = {}
+        self.text_rects = False
+        self.component_slots = {}
+        self.layer_plans = {}
+
+    def add_slot(self, kind, element, keys):
+        slot = Slot(kind, self.positions[element], keys)
+        self.slots.append(slot)
+        for key in keys:
+            self.slot_keys.setdefault(key, []).append(slot)
+            
+    def add_binding(self, index, name, template):
+        binding = Binding(index, name, template)
+        self.bindings.append(binding)
+        for key in binding.keys:
+            self.binding_keys.setdefault(key, []).append(binding)
+
+    def get_slots(self, keys = None):
+        """
+        Get the slots bound to any of the given property keys, in the order they
+        should be patched. If no keys are provided, all slots are returned.
+
+        Keyword arguments:
+        keys        -- property keys or None for all slots
+        """
+        if keys is None:
+            slots = self.slots
+        else:
+            slots = set()
+            for key in keys:
+                if key in self.slot_keys:
+                    slots.update(self.slot_keys[key])
+        return sorted(slots, key = lambda slot: ( slot.kind, slot.index ))
         
+    def get_bindings(self, keys = None):
+        """
+        Get the bindings that substitute any of the given property keys. If no 
+        keys are provided, all bindings are returned.
+
+        Keyword arguments:
+        keys        -- property keys or None for all bindings
+        """
+        if keys is None:
+            return self.bindings
+        bindings = set()
+        for key in keys:
+            if key in self.binding_keys:
+                bindings.update(self.binding_keys[key])
+        return bindings
+    
+    def get_bindings_within(self, index):
+        """
+        Get the bindings of the node at the given index and all of its descendants.
+
+        Keyword arguments:
+        index       -- index of node in the compiled document
+        """
+        end = self.get_end(index)
+        return [ binding for binding in self.bindings if binding.index >= index and binding.index < end ]
+    
+    def get_end(self, index):
+        """
+        Get the index after the last descendant of the node at the given index.
+
+        Keyword arguments:
+        index       -- index of node in the compiled document
+        """
+        return index + sum(1 for e in self.elements[index].iter())
+
+    def contains_slots(self, element):
+        """
+        Get if the element or any of its descendants is a slot.
+
+        Keyword arguments:
+        element     -- element in the compiled document
+        """
+        start = self.positions[element]
+        end = self.get_end(start)
+        for slot in self.slots:
+            if slot.index >= start and slot.index < end:
+                return True
+        return False
+
+class LayerPlan(object):
+    """
+    How a compiled document is split into layers. Each run is a list of the indexes
+    of sibling (or cousin) elements in the compiled document, and a flag that is True
+    if none of them depend on theme properties, in which case the run may be
+    rendered once and cached.
+    
+    Each element is rendered by its ID. Elements without a unique ID are given one
+    in the layer XML (for static runs) or only while the working document is being
+    written out (for dynamic runs), so neither the compiled nor the working document
+    is changed.
+    """
+    def __init__(self, xml, runs, ids, working_ids):
+        self.xml = xml
+        self.digest = hashlib.md5(xml).hexdigest()
+        self.runs = runs
+        self.ids = ids
+        self.working_ids = working_ids
+
+class LayerCache(object):
+    """
+    Least recently used cache of pre-rendered static theme layers, limited by the 
+    total size of the surfaces held
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._surfaces = OrderedDict()
+        self._lock = RLock()
+        
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            surface = self._surfaces.pop(key, None)
+            if surface is not None:
+                self._surfaces[key] = surface
+            return surface
+        finally:
+            self._lock.release()
+            
+    def put(self, key, surface):
+        surface_size = _get_surface_size(surface)
+        if surface_size > self.max_size:
+            return
+        self._lock.acquire()
+        try:
+            if key in self._surfaces:
+                self.size -= _get_surface_size(self._surfaces.pop(key))
+            self._surfaces[key] = surface
+            self.size += surface_size
+            while self.size > self.max_size:
+                self.size -= _get_surface_size(self._surfaces.popitem(last = False)[1])
+        finally:
+            self._lock.release()
+            
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._surfaces.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+def _get_surface_size(surface):
+    return surface.get_stride() * surface.get_height()
+
+layer_cache = LayerCache(LAYER_CACHE_SIZE)
+
+def _get_local_name(tag):
+    return tag.split("}")[-1]
+
+def _get_placeholders(text):
+    """
+    Get the names of all the properties string.Template would substitute into
+    the given text
+
+    Keyword arguments:
+    text        -- template text
+    """
+    names = set()
+    if text:
+        for match in Template.pattern.finditer(text):
+            name = match.group("named") or match.group("braced")
+            if name:
+                names.add(name)
+    return names
+
 class ScrollState(object):
     
     def __init__(self):
@@ -1429,6 +1662,29 @@ class ConfirmationScreen(G15Page):
             self.get_screen().key_handler.action_listeners.remove(self)
             self.callback(self.arg)  
                 
+def _is_same_value(value, other):
+    """
+    Get if two property values are known to be the same. Only immutable values
+    (strings, numbers, booleans and None) can be compared, anything else may 
+    have been changed in place.
+
+    Keyword arguments:
+    value        -- value
+    other        -- value to compare with
+    """
+    if isinstance(value, IMMUTABLE_PROPERTY_TYPES) and type(value) is type(other):
+        return value == other
+    return False
+
+def _draws_element(component):
+    """
+    Get if a component overrides Component.draw() to adjust its theme element
+
+    Keyword arguments:
+    component        -- component
+    """
+    return type(component).draw.__func__ is not Component.draw.__func__
+
 class G15Theme(object):    
     def __init__(self, dir_path, variant = None, svg_text = None, prefix = None, auto_dirty = True, translation = None):
         self.translation = translation
@@ -1458,6 +1714,10 @@ class G15Theme(object):
         self.auto_dirty = auto_dirty
         self.render = None
         self.scroll_state = {}
+        self._compiled = None
+        self._working = None
+        self._patch_all = True
+        self._patched_properties = {}
         self.nsmap = {
             'sodipodi': 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
             'cc': 'http://web.resource.org/cc/',
@@ -1546,6 +1806,8 @@ class G15Theme(object):
                     
                 self.process_svg()
                 self.bounds = g15svg.get_bounds(self.document.getroot())
+            self._compiled = None
+            self._working = None
         finally:
             self.render_lock.release()
         
@@ -1685,8 +1947,20 @@ class G15Theme(object):
     
     def mark_dirty(self):
         self.dirty = True
+        self._patch_all = True
             
     def draw(self, canvas, properties = {}, attributes = {}):
+        """
+        Process the theme document with the given properties and render it to the
+        canvas. Returns the processed document. This belongs to the theme and may be
+        patched in place by the next draw, so it must not be changed or kept by the
+        caller (take a copy if it is needed later).
+        
+        Keyword arguments:
+        canvas        -- canvas to render to
+        properties    -- theme properties
+        attributes    -- theme attributes
+        """
         if self.render != None and self.auto_dirty:
             if self.render.properties != properties or self.render.attributes != attributes or \
                self.render.properties.values() != properties.values() or self.render.attributes.values() != attributes.values():
@@ -1701,7 +1975,6 @@ class G15Theme(object):
             self.text.set_canvas(canvas)
             
             try:
-                document = deepcopy(self.document)
                 processing_result = None
                 
                 # Give the python portion of the theme chance to draw stuff under the SVG
@@ -1710,37 +1983,45 @@ class G15Theme(object):
                         self.instance.paint_background(properties, attributes)
                     except Exception as e:
                         logger.debug("Error painting background", exc_info = e)
-                    
-                root = document.getroot()
-                         
-                # Process the SVG         
-                self._process_deletes(root, properties)
-                self._process_components(root)
-                self._set_progress_bars(root, properties) 
-                self._set_relative_image_paths(root)
-                self._convert_image_urls(root, properties)
-                self._do_shadow("shadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_BACKGROUND, (255, 255,255)), root)
-                self._do_shadow("reverseshadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_FOREGROUND, (0, 0, 0)), root)
-                self._set_highlight_color(root)
                 
-                text_boxes = []
-                self._handle_text_boxes(root, text_boxes, properties, canvas)        
+                compiled = self._get_compiled()
+                if self._can_patch(compiled):
+                    # Only the slots bound to changed properties need to be touched
+                    document, text_boxes = self._patch_document(compiled, properties, canvas)
+                else:
+                    # Process the whole SVG. Shadows, highlight and default style must
+                    # also be applied to anything the processors below add or change
+                    self._working = None
+                    document = deepcopy(self.document)
+                    root = document.getroot()
+                             
+                    self._process_deletes(root, properties)
+                    self._process_components(root)
+                    self._set_progress_bars(root, properties) 
+                    self._set_relative_image_paths(root)
+                    self._convert_image_urls(root, properties)
+                    self._do_shadow("shadow", compiled.key[0], root)
+                    self._do_shadow("reverseshadow", compiled.key[1], root)
+                    self._set_highlight_color(root)
                     
-                # Pass the SVG document to the SVG processor if there is one
-                if self.svg_processor != None:
-                    self.svg_processor(document, properties, attributes)
-                
-                # Pass the SVG document to the theme's python code to manipulate the document if required
-                if self.instance is not None and hasattr(self.instance, 'process_svg'):
-                    try:
-                        processing_result = self.instance.process_svg(self.driver,
-                                                                      root,
-                                                                      properties,
-                                                                      self.nsmap)
-                    except Exception as e:
-                        logger.debug("Error processing SVG", exc_info = e)
+                    text_boxes = []
+                    self._handle_text_boxes(root, text_boxes, properties, canvas)        
+                        
+                    # Pass the SVG document to the SVG processor if there is one
+                    if self.svg_processor != None:
+                        self.svg_processor(document, properties, attributes)
                     
-                self._set_default_style(root)
+                    # Pass the SVG document to the theme's python code to manipulate the document if required
+                    if self.instance is not None and hasattr(self.instance, 'process_svg'):
+                        try:
+                            processing_result = self.instance.process_svg(self.driver,
+                                                                          root,
+                                                                          properties,
+                                                                          self.nsmap)
+                        except Exception as e:
+                            logger.debug("Error processing SVG", exc_info = e)
+                            
+                    self._set_default_style(root)
                     
                 self.render = Render(document, properties, text_boxes, attributes, processing_result)
                 self.dirty = False
@@ -1769,6 +2050,339 @@ class G15Theme(object):
     Private
     """
     
+    def _get_compile_key(self):
+        """
+        Get the driver colours the static processing of the document depends on
+        """
+        driver = self.screen.driver
+        highlight = None
+        if driver.get_control_for_hint(g15driver.HINT_HIGHLIGHT):
+            highlight = driver.get_color_as_hexrgb(g15driver.HINT_HIGHLIGHT, (255, 0, 0 ))
+        fg_c = driver.get_control_for_hint(g15driver.HINT_FOREGROUND)
+        return ( driver.get_color_as_hexrgb(g15driver.HINT_BACKGROUND, (255, 255,255)),
+                 driver.get_color_as_hexrgb(g15driver.HINT_FOREGROUND, (0, 0, 0)),
+                 highlight,
+                 fg_c.value if fg_c is not None else None )
+    
+    def _get_compiled(self):
+        """
+        Get the compiled document, building it again if the theme document or
+        any of the driver colours have changed since it was last built
+        """
+        key = self._get_compile_key()
+        if self._compiled is None or self._compiled.key != key:
+            self._compiled = self._compile(key)
+            self._working = None
+        return self._compiled
+    
+    def _compile(self, key):
+        """
+        Apply all of the processing that does not depend on theme properties to a 
+        copy of the document, and index the elements that do.
+        
+        Keyword arguments:
+        key        -- driver colours the compiled document is for
+        """
+        document = deepcopy(self.document)
+        root = document.getroot()
+        self._set_relative_image_paths(root)
+        self._do_shadow("shadow", key[0], root)
+        self._do_shadow("reverseshadow", key[1], root)
+        self._set_highlight_color(root)
+        self._set_default_style(root)
+        
+        compiled = CompiledDocument(document, key)
+        for element in root.xpath('//svg:*[@title]',namespaces=self.nsmap):
+            delete_var = self._get_delete_var(element.get("title"))
+            if delete_var is not None:
+                compiled.add_slot(SLOT_DELETE, element, [ delete_var[0] ])
+        for element in root.xpath('//svg:rect[@class=\'progress\']',namespaces=self.nsmap):
+            id = element.get("id")
+            compiled.add_slot(SLOT_PROGRESS, element, [ id[:-9] ] if id.endswith("_progress") else [])
+        images = set()
+        for element in root.xpath('//svg:image[@title]',namespaces=self.nsmap):
+            keys = _get_placeholders(element.get("{http://www.w3.org/1999/xlink}href"))
+            keys.add(element.get("title"))
+            compiled.add_slot(SLOT_IMAGE, element, keys)
+            images.add(compiled.positions[element])
+        for element in root.xpath('//svg:text[@clip-path]',namespaces=self.nsmap):
+            compiled.add_slot(SLOT_TEXT, element, _get_placeholders(self._get_text_span(element).text))
+        compiled.text_rects = len(root.xpath('//svg:rect[@class=\'textbox\']',namespaces=self.nsmap)) > 0
+        
+        # Index everything properties are substituted into. The links of bound images 
+        # are substituted by their slot, as they may be replaced by a property
+        for index, node in enumerate(compiled.elements):
+            if node.text and "$" in node.text:
+                compiled.add_binding(index, BINDING_TEXT, node.text)
+            if node.tail and "$" in node.tail:
+                compiled.add_binding(index, BINDING_TAIL, node.tail)
+            if isinstance(node.tag, basestring):
+                for name, value in node.attrib.items():
+                    if "$" in value and not ( index in images and name == "{http://www.w3.org/1999/xlink}href" ):
+                        compiled.add_binding(index, name, value)
+        return compiled
+    
+    def _can_patch(self, compiled):
+        """
+        Get if the working document may be patched in place. This is not possible
+        if anything other than the theme itself may manipulate the document, or
+        if a component that adjusts its element contains any slots or shadowed
+        elements (shadows are made from where the element was before it was
+        adjusted).
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        """
+        if self.svg_processor is not None or compiled.text_rects or \
+                ( self.instance is not None and hasattr(self.instance, 'process_svg') ):
+            return False
+        if self.component:
+            for component_id, component in self.component.child_map.items():
+                if _draws_element(component):
+                    if not component_id in compiled.component_slots:
+                        element = self.get_element(component_id, compiled.document.getroot())
+                        compiled.component_slots[component_id] = element is not None and \
+                            ( compiled.contains_slots(element) or self._contains_shadows(element) )
+                    if compiled.component_slots[component_id]:
+                        return False
+        return True
+    
+    def _contains_shadows(self, element):
+        return len(element.xpath('descendant-or-self::svg:*[@class=\'shadow\' or @class=\'reverseshadow\']',namespaces=self.nsmap)) > 0
+    
+    def _patch_document(self, compiled, properties, canvas):
+        """
+        Bring the working document up to date with the current properties, only
+        patching the slots bound to properties that have changed since the last
+        time. Returns the document and the text boxes to render over it.
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        properties      -- theme properties
+        canvas          -- canvas
+        """
+        component_ids = frozenset(self.component.child_map.keys()) if self.component else frozenset()
+        if self._working is None or component_ids != self._working_components:
+            self._working = deepcopy(compiled.document)
+            self._working_nodes = list(self._working.iter())
+            self._working_components = component_ids
+            self._placeholders = {}
+            self._component_nodes = {}
+            changed = None
+        elif self._patch_all:
+            changed = None
+        else:
+            changed = self._get_changed_properties(properties)
+        slots = compiled.get_slots(changed)
+        self._patch_all = False
+        self._patched_properties = dict(properties)
+        
+        # Re-attached elements may contain text that is out of date, so re-measure all text
+        deletes_changed = False
+        for slot in slots:
+            if slot.kind == SLOT_DELETE and self._patch_delete(compiled, slot, properties):
+                deletes_changed = True
+        if deletes_changed:
+            slots = compiled.get_slots()
+                
+        self._patch_components(compiled, properties)
+        
+        root = self._working.getroot()
+        for slot in slots:
+            node = self._working_nodes[slot.index]
+            base = compiled.elements[slot.index]
+            if slot.kind == SLOT_PROGRESS:
+                node.set("width", base.get("width"))
+                self._set_progress_bar(node, properties)
+            elif slot.kind == SLOT_IMAGE:
+                href = base.get("{http://www.w3.org/1999/xlink}href")
+                if href is not None:
+                    node.set("{http://www.w3.org/1999/xlink}href", href)
+                self._convert_image_url(node, properties)
+                if href is not None and "$" in href and node.get("{http://www.w3.org/1999/xlink}href") == href:
+                    node.set("{http://www.w3.org/1999/xlink}href", self._substitute(Template(href), properties))
+            elif slot.kind == SLOT_TEXT and self._is_attached(self._get_text_anchor(compiled, slot), root):
+                self._patch_text(compiled, slot, properties, canvas)
+                
+        text_boxes = []
+        for slot in compiled.slots:
+            if slot.text_box is not None and self._is_attached(self._get_text_anchor(compiled, slot), root):
+                text_boxes.append(slot.text_box)
+                
+        # Substitute the changed properties into the nodes they are bound to
+        self._apply_bindings(compiled.get_bindings(changed), properties)
+        return self._working, text_boxes
+    
+    def _get_changed_properties(self, properties):
+        """
+        Get the keys of the properties that have changed since the working document 
+        was last patched. Values that may be changed in place (such as surfaces) 
+        cannot be compared with the old value, so are always treated as changed.
+        
+        Keyword arguments:
+        properties      -- theme properties
+        """
+        changed = set()
+        for key in set(properties.keys()) | set(self._patched_properties.keys()):
+            if not key in properties or not key in self._patched_properties or \
+                    not _is_same_value(properties[key], self._patched_properties[key]):
+                changed.add(key)
+        return changed
+    
+    def _patch_delete(self, compiled, slot, properties):
+        """
+        Swap an element that is dependent on a property for a placeholder (or 
+        back again). Returns True if the element was swapped.
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        slot            -- slot of element
+        properties      -- theme properties
+        """
+        node = self._working_nodes[slot.index]
+        placeholder = self._placeholders.get(slot.index)
+        deleted = placeholder is not None and placeholder.getparent() is not None
+        if self._is_deleted(compiled.elements[slot.index].get("title"), properties) != deleted:
+            if deleted:
+                placeholder.getparent().replace(placeholder, node)
+            else:
+                if placeholder is None:
+                    placeholder = etree.Comment("del %d" % slot.index)
+                    self._placeholders[slot.index] = placeholder
+                node.getparent().replace(node, placeholder)
+            return True
+        return False
+    
+    def _patch_components(self, compiled, properties):
+        """
+        Draw the elements that are associated with child components in the working
+        document. Elements of components that adjust them are first restored from the
+        compiled document.
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        properties      -- theme properties
+        """
+        if self.component:
+            root = self._working.getroot()
+            for component_id, component in self.component.child_map.items():
+                if not component_id in self._component_nodes:
+                    base = self.get_element(component_id, compiled.document.getroot())
+                    c = self._working_nodes[compiled.positions[base]] if base is not None else None
+                    if c is None or not self._is_attached(c, root):
+                        logger.warning("Cannot find SVG element for component %s", component_id)
+                        continue
+                    self._component_nodes[component_id] = compiled.positions[base]
+                    c_class = c.get("class")
+                    if c_class and "hidden-root" in c_class:
+                        c.getparent().remove(c)
+                elif _draws_element(component):
+                    index = self._component_nodes[component_id]
+                    c = self._working_nodes[index]
+                    restored = self._restore_node(compiled, index)
+                    if c.getparent() is not None:
+                        c.getparent().replace(c, restored)
+                    self._apply_bindings(compiled.get_bindings_within(index), properties)
+                node = self._working_nodes[self._component_nodes[component_id]]
+                component.draw(self, node)
+                if _draws_element(component):
+                    # The component may have set styles using the default highlight colour
+                    self._set_highlight_color(node)
+    
+    def _patch_text(self, compiled, slot, properties, canvas):
+        """
+        Restore a text element from the compiled document and measure and scroll it 
+        again. Wrapped text is removed from the document, so a placeholder is left
+        where it was.
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        slot            -- slot of element
+        properties      -- theme properties
+        canvas          -- canvas
+        """
+        base = compiled.elements[slot.index]
+        node = self._working_nodes[slot.index]
+        restored = self._restore_node(compiled, slot.index)
+        if "vertical-wrap" == base.get("title"):
+            placeholder = self._placeholders.get(slot.index)
+            if placeholder is None:
+                placeholder = etree.Comment("text %d" % slot.index)
+                self._placeholders[slot.index] = placeholder
+                node.addprevious(placeholder)
+            if node.getparent() is not None:
+                node.getparent().remove(node)
+            placeholder.addnext(restored)
+        else:
+            node.getparent().replace(node, restored)
+        
+        text_boxes = []
+        self._handle_text_box(restored, text_boxes, properties, canvas)
+        slot.text_box = text_boxes[0] if len(text_boxes) > 0 else None
+        self._apply_bindings(compiled.get_bindings_within(slot.index), properties)
+        
+    def _restore_node(self, compiled, index):
+        """
+        Create a new copy of a node from the compiled document to replace the one 
+        in the working document with. The caller must put it in place.
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        index           -- index of node
+        """
+        restored = deepcopy(compiled.elements[index])
+        for offset, node in enumerate(restored.iter()):
+            self._working_nodes[index + offset] = node
+        return restored
+    
+    def _apply_bindings(self, bindings, properties):
+        """
+        Substitute properties into the bound nodes of the working document.
+        
+        Keyword arguments:
+        bindings        -- bindings to apply
+        properties      -- theme properties
+        """
+        for binding in bindings:
+            node = self._working_nodes[binding.index]
+            value = self._substitute(binding.template, properties, binding.keys)
+            if binding.name == BINDING_TEXT:
+                if node.text != value:
+                    node.text = value
+            elif binding.name == BINDING_TAIL:
+                if node.tail != value:
+                    node.tail = value
+            elif node.get(binding.name) != value:
+                node.set(binding.name, value)
+                
+    def _substitute(self, template, properties, keys = None):
+        values = {}
+        for key in keys if keys is not None else properties.keys():
+            if key in properties:
+                values[key] = str(properties[key])
+        return template.safe_substitute(values)
+    
+    def _get_text_anchor(self, compiled, slot):
+        """
+        Get the node that marks the position of a text slot in the working document.
+        This is the placeholder for wrapped text (which is removed from the document),
+        or the text element itself otherwise. 
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        slot            -- slot of text element
+        """
+        if "vertical-wrap" == compiled.elements[slot.index].get("title") and slot.index in self._placeholders:
+            return self._placeholders[slot.index]
+        return self._working_nodes[slot.index]
+    
+    def _is_attached(self, node, root):
+        while node is not None:
+            if node is root:
+                return True
+            node = node.getparent()
+        return False
+    
     def _process_components(self, root):
         """
         Find all elements that are associated with child components in the component this
@@ -1798,18 +2412,39 @@ class G15Theme(object):
         properties  -- theme properties
         """ 
         for element in root.xpath('//svg:*[@title]',namespaces=self.nsmap):
-            title = element.get("title")
-            if title != None:
-                args = title.split(" ")
-                if args[0] == "del":
-                    var = args[1]
-                    condition = True
-                    if var.startswith("!"):
-                        var = var[1:]
-                        condition = False
-                    if ( condition and var in properties and properties[var] != "" and properties[var] != False ) or \
-                        ( not condition and ( not var in properties or properties[var] == "" or properties[var] == False ) ):
-                        element.getparent().remove(element)
+            if self._is_deleted(element.get("title"), properties):
+                element.getparent().remove(element)
+                        
+    def _get_delete_var(self, title):
+        """
+        Get the property key and condition of a "del" element title, or None if
+        the title is not a delete instruction
+        
+        Keyword arguments:
+        title       -- element title
+        """
+        if title != None:
+            args = title.split(" ")
+            if args[0] == "del":
+                var = args[1]
+                if var.startswith("!"):
+                    return var[1:], False
+                return var, True
+                
+    def _is_deleted(self, title, properties):
+        """
+        Get if an element with the given title should be removed from the document
+        
+        Keyword arguments:
+        title       -- element title
+        properties  -- theme properties
+        """
+        delete_var = self._get_delete_var(title)
+        if delete_var is not None:
+            var, condition = delete_var
+            return ( condition and var in properties and properties[var] != "" and properties[var] != False ) or \
+                ( not condition and ( not var in properties or properties[var] == "" or properties[var] == False ) )
+        return False
     
     def _set_progress_bars(self, root, properties):
         """
@@ -1822,20 +2457,23 @@ class G15Theme(object):
         properties  -- theme properties
         """ 
         for element in root.xpath('//svg:rect[@class=\'progress\']',namespaces=self.nsmap):
-            bounds = g15svg.get_bounds(element)
-            id = element.get("id")
-            if id.endswith("_progress"):
-                property_key = id[:-9]
-                if property_key in properties:
-                    value = float(properties[property_key])
-                    if value == 0:
-                        value = 0.1
-                    element.set("width", str(int((bounds[2] / 100.0) * value)))
-                else:
-                    logger.warning("Found progress element with an ID that doesn't exist in " + \
-                                   "theme properties. Theme directory is %s, variant is %s." % (self.dir, self.variant ))
+            self._set_progress_bar(element, properties)
+            
+    def _set_progress_bar(self, element, properties):
+        bounds = g15svg.get_bounds(element)
+        id = element.get("id")
+        if id.endswith("_progress"):
+            property_key = id[:-9]
+            if property_key in properties:
+                value = float(properties[property_key])
+                if value == 0:
+                    value = 0.1
+                element.set("width", str(int((bounds[2] / 100.0) * value)))
             else:
-                logger.warning("Found progress element with an ID that doesn't end in _progress")
+                logger.warning("Found progress element with an ID that doesn't exist in " + \
+                               "theme properties. Theme directory is %s, variant is %s." % (self.dir, self.variant ))
+        else:
+            logger.warning("Found progress element with an ID that doesn't end in _progress")
     
     def _set_highlight_color(self, root):
         """
@@ -1843,10 +2481,10 @@ class G15Theme(object):
         default with the configured highlight color
         
         Keyword arguments:
-        root        -- root of document
+        root        -- root of document, or of the elements to replace the colour in
         """
         if self.screen.driver.get_control_for_hint(g15driver.HINT_HIGHLIGHT):  
-            for element in root.xpath('//svg:*[@style]',namespaces=self.nsmap):
+            for element in root.xpath('descendant-or-self::svg:*[@style]',namespaces=self.nsmap):
                 element.set("style", element.get("style").replace(DEFAULT_HIGHLIGHT_COLOR, self.screen.driver.get_color_as_hexrgb(g15driver.HINT_HIGHLIGHT, (255, 0, 0 ))))
                 
     def _set_relative_image_paths(self, root):
@@ -1870,23 +2508,26 @@ class G15Theme(object):
         properties  -- theme properties
         """
         for element in root.xpath('//svg:image',namespaces=self.nsmap):
-            id = element.get("title")
-            if id != None and id in properties and properties[id] != None:
-                file_str = StringIO()
-                val = properties[id]
-                if isinstance(val, str) and str(val).startswith("file:"):
-                    file_str.write(val[5:])
-                elif isinstance(val, str) and str(val).startswith("/"):
+            self._convert_image_url(element, properties)
+            
+    def _convert_image_url(self, element, properties):
+        id = element.get("title")
+        if id != None and id in properties and properties[id] != None:
+            file_str = StringIO()
+            val = properties[id]
+            if isinstance(val, str) and str(val).startswith("file:"):
+                file_str.write(val[5:])
+            elif isinstance(val, str) and str(val).startswith("/"):
+                file_str.write(val)
+            else:
+                file_str.write("data:image/png;base64,")
+                img_data = StringIO()
+                if isinstance(val, cairo.Surface):
+                    val.write_to_png(img_data)
+                    file_str.write(base64.b64encode(img_data.getvalue()))
+                else: 
                     file_str.write(val)
-                else:
-                    file_str.write("data:image/png;base64,")
-                    img_data = StringIO()
-                    if isinstance(val, cairo.Surface):
-                        val.write_to_png(img_data)
-                        file_str.write(base64.b64encode(img_data.getvalue()))
-                    else: 
-                        file_str.write(val)
-                element.set("{http://www.w3.org/1999/xlink}href", file_str.getvalue())
+            element.set("{http://www.w3.org/1999/xlink}href", file_str.getvalue())
     
     def _set_default_style(self, root):        
         """
@@ -1916,43 +2557,7 @@ class G15Theme(object):
         # be used to wrap and scroll vertical text, replacing the old 'text box' mechanism
         
         for element in root.xpath('//svg:text[@clip-path]',namespaces=self.nsmap):
-            id = element.get("id")
-            clip_path_node = self._get_clip_path_element(element)
-            vertical_wrap = "vertical-wrap" == element.get("title")
-            if clip_path_node is not None:
-                
-                t_span_node = self.get_element_by_tag("tspan", root = element)
-                if t_span_node is None:
-                    # Doesn't have t_span
-                    t_span_node = element
-                
-                t_span_text = t_span_node.text
-                if not t_span_text:
-                    raise Exception("Text node had clip path, but no text/tspan->text could be found")
-                
-                clip_path_rect_node = self.get_element_by_tag("rect", clip_path_node)
-                if clip_path_rect_node is None:
-                    raise Exception("No svg:rect for clip %s" % str(clip_path_node))
-                clip_path_bounds = g15svg.get_actual_bounds(clip_path_rect_node, element)
-                text_bounds = g15svg.get_actual_bounds(element)
-                
-                text_box = TextBox()            
-                text_box.text = Template(t_span_text).safe_substitute(properties) 
-                text_box.css = self.parse_css(element.get("style"))
-                text_class = element.get("class")
-                if text_class:
-                    if "reverseshadow" in text_class:
-                        text_box.reverse_shadow = True
-                    elif "shadow" in text_class:
-                        text_box.normal_shadow = True
-                text_box.clip = clip_path_bounds
-                
-                self._update_text(text_box, vertical_wrap)
-                tx, ty, text_width, text_height = self.text.measure()
-#                text_width, text_height = self._get_actual_size(element, text_width, text_height)
-                text_box.bounds = ( text_bounds[0], text_bounds[1], text_width, text_height )
-
-                self._scroll_text_boxes(vertical_wrap, text_box, text_boxes, t_span_node, element)
+            self._handle_text_box(element, text_boxes, properties, canvas)
 
         # Find all of the  text boxes. This is a hack to get around rsvg not supporting
         # flowText completely. The SVG must contain two elements. The first must have
@@ -1980,6 +2585,48 @@ class G15Theme(object):
                 text_node.getparent().remove(text_node)
                 element.getparent().remove(element)
                 
+    def _get_text_span(self, element):
+        t_span_node = self.get_element_by_tag("tspan", root = element)
+        if t_span_node is None:
+            # Doesn't have t_span
+            t_span_node = element
+        return t_span_node
+                
+    def _handle_text_box(self, element, text_boxes, properties, canvas):
+        clip_path_node = self._get_clip_path_element(element)
+        vertical_wrap = "vertical-wrap" == element.get("title")
+        if clip_path_node is not None:
+            
+            t_span_node = self._get_text_span(element)
+            
+            t_span_text = t_span_node.text
+            if not t_span_text:
+                raise Exception("Text node had clip path, but no text/tspan->text could be found")
+            
+            clip_path_rect_node = self.get_element_by_tag("rect", clip_path_node)
+            if clip_path_rect_node is None:
+                raise Exception("No svg:rect for clip %s" % str(clip_path_node))
+            clip_path_bounds = g15svg.get_actual_bounds(clip_path_rect_node, element)
+            text_bounds = g15svg.get_actual_bounds(element)
+            
+            text_box = TextBox()            
+            text_box.text = Template(t_span_text).safe_substitute(properties) 
+            text_box.css = self.parse_css(element.get("style"))
+            text_class = element.get("class")
+            if text_class:
+                if "reverseshadow" in text_class:
+                    text_box.reverse_shadow = True
+                elif "shadow" in text_class:
+                    text_box.normal_shadow = True
+            text_box.clip = clip_path_bounds
+            
+            self._update_text(text_box, vertical_wrap)
+            tx, ty, text_width, text_height = self.text.measure()
+#            text_width, text_height = self._get_actual_size(element, text_width, text_height)
+            text_box.bounds = ( text_bounds[0], text_bounds[1], text_width, text_height )
+
+            self._scroll_text_boxes(vertical_wrap, text_box, text_boxes, t_span_node, element)
+    
     def _scroll_text_boxes(self, vertical_wrap, text_box, text_boxes, t_span_node, element):        
         id = element.get("id")
         text_height = text_box.bounds[3]
@@ -2058,15 +2705,20 @@ class G15Theme(object):
         pass
             
     def _render_document(self, canvas, render):
-            
-        encoded_properties = {}
-        # Encode entities in all the property values
-        for key in render.properties.keys():
-            encoded_properties[key] = saxutils.escape(str(render.properties[key]))
-                
-        xml = etree.tostring(render.document)
-        t = Template(xml)
-        xml = t.safe_substitute(encoded_properties)       
+        
+        plan = self._get_layer_plan(canvas, render)
+        if render.document is self._working:
+            # Properties have already been substituted into the working document
+            xml = self._get_working_xml(plan)
+        else:
+            encoded_properties = {}
+            # Encode entities in all the property values
+            for key in render.properties.keys():
+                encoded_properties[key] = saxutils.escape(str(render.properties[key]))
+                    
+            xml = etree.tostring(render.document)
+            t = Template(xml)
+            xml = t.safe_substitute(encoded_properties)       
         svg = rsvg.Handle()
         try :
             svg.write(xml)
@@ -2081,7 +2733,17 @@ class G15Theme(object):
         except Exception as e:
             logger.debug("Could not close SVG", exc_info = e)
         
-        svg.render_cairo(canvas)
+        # The document is clipped to its own size, as the outermost SVG element 
+        # clips to its viewport. This is also the size of cached layers
+        canvas.save()
+        if self.bounds is not None:
+            canvas.rectangle(0, 0, self.bounds[2], self.bounds[3])
+            canvas.clip()
+        if plan is None:
+            svg.render_cairo(canvas)
+        else:
+            self._render_layers(canvas, svg, plan)
+        canvas.restore()
          
         if len(render.text_boxes) > 0:
             rgb = self.screen.driver.get_color_as_ratios(g15driver.HINT_FOREGROUND, ( 0, 0, 0 ))
@@ -2099,6 +2761,189 @@ class G15Theme(object):
             except Exception as e:
                 logger.debug("Error painting foreground", exc_info = e)
             
+    def _get_layer_plan(self, canvas, render):
+        """
+        Get how the document being rendered is split into layers, or None if it must
+        be rendered in one go. Layers are only used for patched documents being 
+        painted without any scaling or rotation, at a whole pixel offset, so 
+        cached layers are pixel identical to rendering directly.
+        
+        Keyword arguments:
+        canvas        -- canvas
+        render        -- render
+        """
+        if self._working is None or render.document is not self._working or \
+                self.bounds is None or self.bounds[2] < 1 or self.bounds[3] < 1:
+            return None
+        xx, yx, xy, yy, x0, y0 = canvas.get_matrix()
+        if xx != 1 or yy != 1 or xy != 0 or yx != 0 or x0 != int(x0) or y0 != int(y0):
+            return None
+        compiled = self._compiled
+        if not self._working_components in compiled.layer_plans:
+            compiled.layer_plans[self._working_components] = self._plan_layers(compiled)
+        return compiled.layer_plans[self._working_components]
+    
+    def _plan_layers(self, compiled):
+        """
+        Split the compiled document into runs of elements that are either all
+        static or all dependent on theme properties. Groups are split into their 
+        children where they contain both, unless they have an effect (such as
+        opacity) that must be applied to the group as a whole. Returns None if
+        there are no static elements, or if the document cannot be split.
+        
+        Keyword arguments:
+        compiled        -- compiled document
+        """
+        root = compiled.document.getroot()
+        
+        # Find all the elements that may change between redraws
+        dynamic = set(slot.index for slot in compiled.slots)
+        for component_id in self._working_components:
+            element = self.get_element(component_id, root)
+            if element is not None:
+                dynamic.add(compiled.positions[element])
+        for index, element in enumerate(compiled.elements):
+            if isinstance(element.tag, basestring):
+                if _get_local_name(element.tag) == "use" or "$" in ( element.text or "" ) or \
+                        "$" in ( element.tail or "" ) or len([ v for v in element.attrib.values() if "$" in v ]) > 0:
+                    dynamic.add(index)
+                    
+        # Find the groups that contain them. Dynamic content that is only rendered by 
+        # reference cannot be layered, as the elements referencing it are not known
+        mixed = set()
+        for index in dynamic:
+            element = compiled.elements[index]
+            if element is root or _get_local_name(element.tag) in NON_RENDERED_TAGS:
+                return None
+            parent = element.getparent()
+            while parent is not None and not compiled.positions[parent] in mixed:
+                if _get_local_name(parent.tag) in NON_RENDERED_TAGS:
+                    return None
+                mixed.add(compiled.positions[parent])
+                parent = parent.getparent()
+        if self._has_group_effects(root):
+            return None
+                
+        leaves = []
+        self._collect_layer_leaves(root, compiled, dynamic, mixed, leaves)
+        if len([ leaf for leaf in leaves if leaf[1] ]) == 0:
+            return None
+        
+        # Each element must have a unique ID so it can be rendered on its own. Static 
+        # elements are given one in a copy of the compiled document, dynamic elements
+        # only while the working document is written out
+        layer_document = compiled.document
+        ids = {}
+        working_ids = {}
+        for index, static in leaves:
+            element = compiled.elements[index]
+            element_id = element.get("id")
+            if element_id is None or self.get_element(element_id, root) is not element:
+                element_id = "g15layer%d" % index
+                if not static:
+                    working_ids[index] = element_id
+                else:
+                    if layer_document is compiled.document:
+                        layer_document = deepcopy(compiled.document)
+                        layer_elements = list(layer_document.iter())
+                    layer_elements[index].set("id", element_id)
+            ids[index] = element_id
+        
+        runs = []
+        for index, static in leaves:
+            if len(runs) == 0 or runs[-1][0] != static:
+                runs.append(( static, [] ))
+            runs[-1][1].append(index)
+        return LayerPlan(etree.tostring(layer_document), runs, ids, working_ids)
+        
+    def _get_working_xml(self, plan):
+        """
+        Write out the working document, giving the elements of dynamic layers
+        that have no unique ID their layer ID while doing so
+        
+        Keyword arguments:
+        plan        -- layer plan or None
+        """
+        if plan is None or len(plan.working_ids) == 0:
+            return etree.tostring(self._working)
+        previous_ids = []
+        for index, element_id in plan.working_ids.items():
+            node = self._working_nodes[index]
+            previous_ids.append(( node, node.get("id") ))
+            node.set("id", element_id)
+        try:
+            return etree.tostring(self._working)
+        finally:
+            for node, element_id in previous_ids:
+                if element_id is None:
+                    del node.attrib["id"]
+                else:
+                    node.set("id", element_id)
+    
+    def _collect_layer_leaves(self, element, compiled, dynamic, mixed, leaves):
+        for child in element:
+            if not isinstance(child.tag, basestring) or _get_local_name(child.tag) in NON_RENDERED_TAGS:
+                continue
+            index = compiled.positions[child]
+            if index in mixed and not index in dynamic and _get_local_name(child.tag) == "g" and \
+                    not self._has_group_effects(child):
+                self._collect_layer_leaves(child, compiled, dynamic, mixed, leaves)
+            else:
+                leaves.append(( index, not index in dynamic and not index in mixed ))
+                
+    def _has_group_effects(self, element):
+        styles = self.parse_css(element.get("style") or "")
+        for name in [ "opacity", "filter", "mask", "clip-path", "display", "visibility" ]:
+            value = element.get(name)
+            if value is None:
+                value = styles.get(name)
+            if value is not None and not value.strip() in [ "none", "inline", "visible", "1" ]:
+                return True
+        return False
+    
+    def _render_layers(self, canvas, svg, plan):
+        """
+        Render the document a layer at a time, painting cached surfaces for
+        static layers, and rendering the elements of dynamic layers from 
+        the working document.
+        
+        Keyword arguments:
+        canvas        -- canvas
+        svg           -- rsvg handle of working document
+        plan          -- layer plan
+        """
+        root = self._working.getroot()
+        for run_index, run in enumerate(plan.runs):
+            static, indexes = run
+            if static:
+                canvas.save()
+                canvas.set_source_surface(self._get_layer_surface(plan, run_index), 0, 0)
+                canvas.paint()
+                canvas.restore()
+            else:
+                for index in indexes:
+                    if self._is_attached(self._working_nodes[index], root):
+                        svg.render_cairo(canvas, "#%s" % plan.ids[index])
+                        
+    def _get_layer_surface(self, plan, run_index):
+        width = int(math.ceil(self.bounds[2]))
+        height = int(math.ceil(self.bounds[3]))
+        key = ( plan.digest, run_index, width, height, self.driver.get_antialias() )
+        surface = layer_cache.get(key)
+        if surface is None:
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            context = cairo.Context(surface)
+            self.screen.configure_canvas(context)
+            svg = rsvg.Handle()
+            try:
+                svg.write(plan.xml)
+            finally:
+                svg.close()
+            for index in plan.runs[run_index][1]:
+                svg.render_cairo(context, "#%s" % plan.ids[index])
+            layer_cache.put(key, surface)
+        return surface
+            
     def _render_text_box(self, canvas, text_box, rgb, bg_rgb):
         self._update_text(text_box, text_box.wrap)
         
@@ -2225,4 +3070,151 @@ class G15Theme(object):
                             clip_path_element.addprevious(clip_copy)
                         
                         
-                        idx += 1
\ No newline at end of file
+                        idx += 1
+class _LegacyTheme(G15Theme):
+    """
+    Theme that processes a copy of the whole document and renders it in one go
+    on every draw, as all themes were drawn before documents were compiled,
+    patched in place and rendered in layers. Only used to check that both give
+    the same pixels.
+    """
+    def _can_patch(self, compiled):
+        return False
+
+if __name__ == "__main__":
+    # Run with the src directory on PYTHONPATH, e.g. PYTHONPATH=src python src/gnome15/g15theme.py [svg files]
+    # Every bundled theme (or the given SVG files) is drawn with randomly changing 
+    # properties through both the legacy and the patched pipelines, and the pixels
+    # compared. The python portions of themes are not loaded.
+    import glob
+    import random
+    logging.basicConfig()
+    
+    class CheckDriver(g15driver.AbstractDriver):
+        def __init__(self):
+            g15driver.AbstractDriver.__init__(self, "check")
+            self.controls = [ g15driver.Control("foreground", "Foreground", (255, 255, 255), hint = g15driver.HINT_FOREGROUND),
+                              g15driver.Control("background", "Background", (0, 0, 0), hint = g15driver.HINT_BACKGROUND),
+                              g15driver.Control("highlight", "Highlight", (0, 128, 255), hint = g15driver.HINT_HIGHLIGHT) ]
+        def get_controls(self):
+            return self.controls
+        def get_antialias(self):
+            return cairo.ANTIALIAS_DEFAULT
+        def get_model_name(self):
+            return g15driver.MODEL_G19
+        def process_svg(self, document):
+            pass
+        
+    class CheckService():
+        disable_svg_glow = False
+        scroll_delay = 0.5
+        scroll_amount = 5
+        
+    class CheckScreen():
+        def __init__(self):
+            self.driver = CheckDriver()
+            self.service = CheckService()
+        def configure_canvas(self, canvas):
+            canvas.set_antialias(self.driver.get_antialias())
+            fo = cairo.FontOptions()
+            fo.set_antialias(self.driver.get_antialias())
+            canvas.set_font_options(fo)
+            return fo
+        
+    def load_theme(theme_class, path, screen):
+        theme = theme_class(os.path.dirname(path))
+        theme.screen = screen
+        theme.driver = screen.driver
+        theme.text = g15text.new_text(screen)
+        theme.document = etree.parse(path)
+        theme.process_svg()
+        theme.bounds = g15svg.get_bounds(theme.document.getroot())
+        return theme
+    
+    def get_property_kinds(theme):
+        root = theme.document.getroot()
+        kinds = {}
+        for element in root.iter():
+            if isinstance(element.tag, basestring):
+                for value in [ element.text, element.tail ] + element.attrib.values():
+                    for key in _get_placeholders(value):
+                        kinds.setdefault(key, "text")
+                delete_var = theme._get_delete_var(element.get("title"))
+                if delete_var is not None and kinds.get(delete_var[0], "text") == "text":
+                    kinds[delete_var[0]] = "delete"
+        for element in root.xpath('//svg:image[@title]',namespaces=theme.nsmap):
+            kinds[element.get("title")] = "image"
+        for element in root.xpath('//svg:rect[@class=\'progress\']',namespaces=theme.nsmap):
+            if element.get("id", "").endswith("_progress"):
+                kinds[element.get("id")[:-9]] = "progress"
+        return kinds
+    
+    def random_image():
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 8, 8)
+        context = cairo.Context(surface)
+        context.set_source_rgb(random.random(), random.random(), random.random())
+        context.paint()
+        return surface
+    
+    def random_value(kind):
+        if kind == "progress":
+            return random.randint(0, 100)
+        elif kind == "image":
+            return random.choice([ None, random_image() ])
+        elif kind == "delete":
+            return random.choice([ "", False, "x", "Something" ])
+        return random.choice([ "", "a", "Short text", "12:34", "100%", "<b>&amp;</b> $x",
+                               "A much longer piece of text that will need to be wrapped or scrolled" ])
+    
+    def paint(theme, properties, size):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
+        canvas = cairo.Context(surface)
+        theme.screen.configure_canvas(canvas)
+        start = time.time()
+        theme.draw(canvas, dict(properties))
+        taken = time.time() - start
+        surface.flush()
+        return str(surface.get_data()), taken
+    
+    def check_theme(path, frames):
+        screen = CheckScreen()
+        legacy = load_theme(_LegacyTheme, path, screen)
+        patched = load_theme(G15Theme, path, screen)
+        size = ( max(1, int(math.ceil(legacy.bounds[2]))), max(1, int(math.ceil(legacy.bounds[3]))) )
+        kinds = get_property_kinds(legacy)
+        properties = dict((key, random_value(kind)) for key, kind in kinds.items())
+        mismatches = 0
+        legacy_time = 0
+        patched_time = 0
+        for frame in range(frames):
+            for key in random.sample(kinds.keys(), min(len(kinds), random.randint(1, 3))):
+                properties[key] = random_value(kinds[key])
+            if frame % 10 == 9:
+                patched.mark_dirty()
+            legacy_pixels, taken = paint(legacy, properties, size)
+            legacy_time += taken
+            patched_pixels, taken = paint(patched, properties, size)
+            patched_time += taken
+            if legacy_pixels != patched_pixels:
+                mismatches += 1
+        print("%-60s %4d frames %4d different %8.2f ms legacy %8.2f ms patched" % \
+              ( os.path.relpath(path), frames, mismatches, legacy_time * 1000 / frames, patched_time * 1000 / frames ))
+        return mismatches
+    
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = sys.argv[1:]
+    if len(paths) == 0:
+        for pattern in [ "../data/themes/*/*.svg", "plugins/*/default/*.svg", "plugins/*/*/default/*.svg" ]:
+            paths += sorted(glob.glob(os.path.join(src_dir, pattern)))
+    random.seed(15)
+    print("Comparing legacy and patched theme rendering")
+    failed = 0
+    for path in paths:
+        try:
+            if check_theme(path, 100) > 0:
+                failed += 1
+        except Exception as e:
+            logger.error("Failed to check %s", path, exc_info = e)
+            failed += 1
+    print("%d of %d themes differ" % ( failed, len(paths) ))
+    sys.exit(1 if failed > 0 else 0)
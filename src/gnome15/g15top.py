@@ -25,32 +25,47 @@ This class is stop gap until a better solution can be found
 
 import os
 import time
+from threading import Lock
+
+# Statistics requested less than this many seconds apart share the same sample
+SAMPLE_INTERVAL = 0.5
 
 class CPU():
-    def __init__(self, name):
+    def __init__(self, name, user = 0, nice = 0, sys = 0, idle = 0):
         self.name = name
-        self.user = 0
-        self.nice = 0
-        self.sys = 0
-        self.idle = 0
+        self.user = user
+        self.nice = nice
+        self.sys = sys
+        self.idle = idle
+        self.pc = 0.0
+        
+    def _calc_pc(self, last):
+        total = ( self.user + self.nice + self.sys + self.idle ) - \
+                ( last.user + last.nice + last.sys + last.idle )
+        if total > 0:
+            self.pc = 100.0 - ( ( self.idle - last.idle ) * 100.0 / total )
 
 class CPUS(CPU):
-    def __init__(self):
+    def __init__(self, data):
         CPU.__init__(self, "CPUS")
-        cpudata = open('/proc/stat')
         self.cpus = []
-        try:
-            for line in cpudata:
-                if line.startswith("cpu"):
-                    (name, cuse, cn, csys, idle, tail) = line.split(None, 5)
-                    cpu = self if name == "cpu" else CPU(name)
-                    self.user = int(cuse)
-                    self.nice = int(cn)
-                    self.sys = int(csys)
-                    self.idle = int(idle)
-                    self.cpus.append(cpu)
-        finally:
-            cpudata.close()
+        for line in data.split("\n"):
+            if not line.startswith("cpu"):
+                break
+            (name, cuse, cn, csys, idle) = line.split(None, 5)[:5]
+            if name == "cpu":
+                self.user = int(cuse)
+                self.nice = int(cn)
+                self.sys = int(csys)
+                self.idle = int(idle)
+            else:
+                self.cpus.append(CPU(name, int(cuse), int(cn), int(csys), int(idle)))
+                
+    def _calc_pc(self, last):
+        CPU._calc_pc(self, last)
+        if len(last.cpus) == len(self.cpus):
+            for cpu, last_cpu in zip(self.cpus, last.cpus):
+                cpu._calc_pc(last_cpu)
             
 class ProcState():
     
@@ -76,27 +91,147 @@ class NetworkLoad():
         self.net = net
         self.bytes_in = bytes_in
         self.bytes_out = bytes_out
+        self.rate_in = 0.0
+        self.rate_out = 0.0
         
 class Mem():
     
-    def __init__(self):
+    def __init__(self, data):
         self.total = 0
         self.free = 0
         self.cached = 0
-        memdata = open('/proc/meminfo')
-        try:
-            for line in memdata:
-                if line.startswith("MemTotal"):
-                    self.total = self._get_value(line)
-                elif line.startswith("MemFree"):
-                    self.free = self._get_value(line)
-                elif line.startswith("Cached"):
-                    self.cached = self._get_value(line)
-        finally:
-            memdata.close()
+        for line in data.split("\n"):
+            if line.startswith("MemTotal:"):
+                self.total = self._get_value(line)
+            elif line.startswith("MemFree:"):
+                self.free = self._get_value(line)
+            elif line.startswith("Cached:"):
+                self.cached = self._get_value(line)
+        self.used_pc = ( self.total - self.free ) * 100.0 / self.total if self.total > 0 else 0.0
             
     def _get_value(self, line):
         return int(line[line.index(':') + 1:line.index('kB')]) * 1024
+    
+class Uptime:
+    def __init__(self, uptime, idletime):
+        self.uptime = uptime
+        self.idletime = idletime
+        self.boot_time = time.time() - self.uptime
+    
+class Sample():
+    """
+    The CPU, memory, network and uptime statistics read at one point in time. 
+    CPU percentages and network rates are calculated against the previous
+    sample.
+    """
+    
+    def __init__(self, sample_time, cpus, mem, nets, net_loads, uptime):
+        self.time = sample_time
+        self.cpus = cpus
+        self.mem = mem
+        self.nets = nets
+        self.net_loads = net_loads
+        self.uptime = uptime
+        self._pids = None
+        
+    def get_pids(self):
+        """
+        Get the list of process IDs, listed the first time they are asked for
+        """
+        if self._pids is None:
+            pids = []
+            for d in os.listdir("/proc"):
+                if d.isdigit():
+                    pids.append(int(d))
+            self._pids = pids
+        return self._pids
+    
+class Sampler():
+    """
+    Reads all of the statistics from /proc at most once every SAMPLE_INTERVAL
+    seconds, so that all plugins asking during the same tick share one 
+    sample. The /proc files are kept open and read in a single call each.
+    """
+    
+    def __init__(self, interval = SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = Lock()
+        self._fds = {}
+        self._buffer_sizes = {}
+        self._sample = None
+        
+    def sample(self):
+        """
+        Get the current sample, reading a new one if the last is too old
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if self._sample is None or now - self._sample.time >= self.interval or now < self._sample.time:
+                self._sample = self._read_sample(now, self._sample)
+            return self._sample
+        finally:
+            self._lock.release()
+            
+    def close(self):
+        self._lock.acquire()
+        try:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = {}
+        finally:
+            self._lock.release()
+        
+    def _read_sample(self, now, last):
+        cpus = CPUS(self._read('/proc/stat'))
+        mem = Mem(self._read('/proc/meminfo'))
+        nets = []
+        net_loads = {}
+        for line in self._read('/proc/net/dev').split("\n")[2:]:
+            idx = line.find(':')
+            if idx != -1:
+                net = line[:idx].strip()
+                data = line[idx + 1:].split()
+                nets.append(net)
+                net_loads[net] = NetworkLoad(net, int(data[0]), int(data[8]))
+        vals = self._read('/proc/uptime').split()
+        sample = Sample(now, cpus, mem, nets, net_loads, Uptime(float(vals[0]), float(vals[1])))
+        
+        if last is not None:
+            cpus._calc_pc(last.cpus)
+            taken = now - last.time
+            if taken > 0:
+                for net, load in net_loads.items():
+                    last_load = last.net_loads.get(net)
+                    if last_load is not None:
+                        load.rate_in = max(0, load.bytes_in - last_load.bytes_in) / taken
+                        load.rate_out = max(0, load.bytes_out - last_load.bytes_out) / taken
+        return sample
+        
+    def _read(self, path):
+        fd = self._fds.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            self._fds[path] = fd
+        size = self._buffer_sizes.get(path, 4096)
+        while True:
+            os.lseek(fd, 0, os.SEEK_SET)
+            data = os.read(fd, size)
+            if len(data) < size:
+                break
+            # Buffer was filled so there may be more, try again with a bigger one
+            size *= 2
+        self._buffer_sizes[path] = size
+        return data
+    
+_sampler = Sampler()
+            
+def sample():
+    """
+    Get a Sample object containing all of the current statistics. Samples
+    are shared between all callers for SAMPLE_INTERVAL seconds
+    """
+    return _sampler.sample()
             
 def netload(net):
     """
@@ -106,57 +241,32 @@ def netload(net):
     Keyword arguments:
     net        --    network interface name
     """
-    prefix = '%6s:' % net
-    netdata = open('/proc/net/dev')
-    try:
-        for line in netdata:
-            if line.startswith(prefix):
-                data = line[line.index(':') + 1:].split()
-                return NetworkLoad(net, int(data[0]), int(data[8]))
-    finally:
-        netdata.close()
+    return sample().net_loads.get(net)
     
             
 def netlist():
     """
     Returns a list of Net objects, one for each available network interface 
     """
-    nets = []
-    f = open("/proc/net/dev", "r")
-    tmp = f.readlines(2000)
-    f.close()
-    for line in tmp:
-        line = line.strip()
-        line = line.split(' ')
-        if len(line) > 0 and line[0].endswith(":"):
-            nets.append(line[0][:-1])
-            
-    return nets
+    return list(sample().nets)
     
 def cpu():
     """
     Return an object containing data about all available CPUS
     """
-    return CPUS()
+    return sample().cpus
 
 def mem():
     """
     Return an object containing data about all available CPUS
     """
-    return Mem()
+    return sample().mem
 
 def proclist():
     """
     Get a list of all process IDs
     """
-    n = []
-    for d in os.listdir("/proc"):
-        if os.path.isdir("/proc/%s" % d):
-            try:
-                n.append(int(d))
-            except ValueError:
-                pass
-    return n
+    return list(sample().get_pids())
 
 def proc_state(pid):
     """
@@ -181,24 +291,132 @@ def proc_args(pid):
     finally:
         cmddata.close()
 
-class Uptime:
-    def __init__(self, uptime, idletime):
-        self.uptime = uptime
-        self.idletime = idletime
-        self.boot_time = time.time() - self.uptime
-
 def uptime():
     """
     Get the uptime of the computer
     """
-    cmddata = open('/proc/uptime')
-    try:
-        for line in cmddata:
-            vals = line.strip('\n').split(' ')
-    finally:
-        cmddata.close()
+    return sample().uptime
 
-    return Uptime(float(vals[0]), float(vals[1]))
+class Process():
+    """
+    A process known to a ProcessTable. The name, owner and arguments are read
+    once when the process is first seen. CPU usage and resident memory are
+    updated on every refresh that collects statistics.
+    """
+    
+    def __init__(self, pid, uid, cmd, args):
+        self.pid = pid
+        self.uid = uid
+        self.cmd = cmd
+        self.args = args
+        self.start_time = None
+        self.cpu_time = 0
+        self.cpu_pc = 0.0
+        self.rss = 0
+        
+class ProcessTable():
+    """
+    An index of running processes that is updated incrementally. Each refresh
+    lists the process IDs and only reads the details of processes that have
+    not been seen before, dropping those that have gone.
+    """
+    
+    def __init__(self, proc_dir = "/proc"):
+        self.proc_dir = proc_dir
+        self.processes = {}
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self._stats_time = None
+        
+    def refresh(self, stats = False):
+        """
+        Update the table, returning a tuple of the sets of process IDs that 
+        were added and removed.
+        
+        Keyword arguments:
+        stats        --    also read CPU usage and resident memory of every process
+        """
+        pids = set()
+        for d in os.listdir(self.proc_dir):
+            if d.isdigit():
+                pids.add(int(d))
+        known = set(self.processes)
+        removed = known - pids
+        for pid in removed:
+            del self.processes[pid]
+        added = set()
+        for pid in pids - known:
+            if self._add(pid):
+                added.add(pid)
+        if stats:
+            self._read_stats(added, removed)
+        return added, removed
+    
+    def get_processes(self, sort = None):
+        """
+        Get the known processes, ordered by process ID, or with the highest
+        "cpu" or "rss" first.
+        
+        Keyword arguments:
+        sort        --    "cpu", "rss" or None to order by process ID
+        """
+        if sort == "cpu":
+            return sorted(self.processes.values(), key = lambda p: ( -p.cpu_pc, p.pid ))
+        elif sort == "rss":
+            return sorted(self.processes.values(), key = lambda p: ( -p.rss, p.pid ))
+        else:
+            return [ self.processes[pid] for pid in sorted(self.processes) ]
+    
+    def _add(self, pid):
+        try:
+            uid = 0
+            cmd = ""
+            for line in self._read(pid, "status").split("\n"):
+                if line.startswith("Name:"):
+                    cmd = line[5:].strip()
+                elif line.startswith("Uid:"):
+                    uid = int(line[4:].split()[0])
+                    break
+            args = self._read(pid, "cmdline").split("\0")
+        except (IOError, OSError):
+            # Process has gone
+            return False
+        self.processes[pid] = Process(pid, uid, cmd, args)
+        return True
+        
+    def _read_stats(self, added, removed):
+        now = time.time()
+        taken = now - self._stats_time if self._stats_time is not None else 0
+        for pid, process in self.processes.items():
+            try:
+                stat = self._read(pid, "stat")
+            except (IOError, OSError):
+                del self.processes[pid]
+                added.discard(pid)
+                removed.add(pid)
+                continue
+            # The command may contain spaces and brackets, so split after the last one
+            fields = stat[stat.rfind(")") + 2:].split()
+            cpu_time = int(fields[11]) + int(fields[12])
+            start_time = fields[19]
+            if process.start_time is not None and process.start_time != start_time:
+                # Process ID has been reused since the last refresh
+                if self._add(pid):
+                    process = self.processes[pid]
+                    added.add(pid)
+            elif process.start_time is not None and taken > 0:
+                process.cpu_pc = ( cpu_time - process.cpu_time ) * 100.0 / self.clock_ticks / taken
+            process.start_time = start_time
+            process.cpu_time = cpu_time
+            process.rss = int(fields[21]) * self.page_size
+        self._stats_time = now
+            
+    def _read(self, pid, name):
+        f = open("%s/%d/%s" % ( self.proc_dir, pid, name ))
+        try:
+            return f.read()
+        finally:
+            f.close()
 
 if __name__ == "__main__":
     for d in proclist():
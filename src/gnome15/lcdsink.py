@@ -19,13 +19,21 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 """
-GdkPixbuf thumbnail sink
+Cairo surface thumbnail sink, and a bin that scales, converts and rate limits
+video to the size and format of the LCD before it reaches the sink
 """
 
 import gobject
 import gst
+import cairo
+import array
 import struct
-import time
+from threading import Lock
+
+'''
+Frames this much later than their presentation time are dropped
+'''
+MAX_LATENESS = 20 * gst.MSECOND
 
 big_to_cairo_alpha_mask = struct.unpack('=i', '\xFF\x00\x00\x00')[0]
 big_to_cairo_red_mask = struct.unpack('=i', '\x00\xFF\x00\x00')[0]
@@ -36,7 +44,10 @@ class CairoSurfaceThumbnailSink(gst.BaseSink):
     """
     GStreamer thumbnailing sink element.
 
-    Can be used in pipelines to generates gtk.gdk.Pixbuf automatically.
+    Can be used in pipelines to generate cairo surfaces automatically. The
+    last rendered buffer is kept (without copying it) and may be wrapped in
+    a surface using get_surface(). Frames that arrive late are dropped and
+    QoS events are sent upstream so decoders may skip frames too.
     """
 
     __gsignals__ = {
@@ -57,8 +68,7 @@ class CairoSurfaceThumbnailSink(gst.BaseSink):
                                   "green_mask = (int) %i, "
                                   "blue_mask = (int)  %i, "
                                   "width = (int) [ 1, max ], "
-                                  "height = (int) [ 1, max ], "
-                                  "framerate = (fraction) [ 0, 25 ]"
+                                  "height = (int) [ 1, max ]"
                                   % (big_to_cairo_alpha_mask,
                                      big_to_cairo_red_mask,
                                      big_to_cairo_green_mask,
@@ -70,19 +80,60 @@ class CairoSurfaceThumbnailSink(gst.BaseSink):
         self.width = 1
         self.height = 1
         self.set_sync(True)
-        self.data = None
+        self.set_property("max-lateness", MAX_LATENESS)
+        self.set_property("qos", True)
+        self._buffer = None
+        self._lock = Lock()
+
+    def get_surface(self):
+        """
+        Get a cairo surface for the last rendered frame, or None if no frame
+        has been rendered yet. When possible the surface shares memory with
+        the GStreamer buffer, otherwise the (LCD sized) frame is copied once.
+        """
+        self._lock.acquire()
+        try:
+            buf = self._buffer
+            width = self.width
+            height = self.height
+        finally:
+            self._lock.release()
+        if buf is None:
+            return None
+        # We don't use FORMAT_ARGB32 because Cairo uses premultiplied
+        # alpha, and gstreamer does not.  Discarding the alpha channel
+        # is not ideal, but the alternative would be to compute the
+        # conversion in python (slow!).
+        try:
+            return cairo.ImageSurface.create_for_data(buf, cairo.FORMAT_RGB24,
+                                                      width, height, width * 4)
+        except TypeError:
+            # The buffer is shared, so is not writable
+            data = array.array("B")
+            data.fromstring(buf)
+            return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_RGB24,
+                                                      width, height, width * 4)
 
     def do_set_caps(self, caps):
         self.log("caps %s" % caps.to_string())
         self.log("padcaps %s" % self.get_pad("sink").get_caps().to_string())
-        self.width = caps[0]["width"]
-        self.height = caps[0]["height"]
         if not caps[0].get_name() == "video/x-raw-rgb":
             return False
+        self._lock.acquire()
+        try:
+            self.width = caps[0]["width"]
+            self.height = caps[0]["height"]
+            self._buffer = None
+        finally:
+            self._lock.release()
         return True
 
     def do_render(self, buf):
-        self.data = str(buf.data)
+        self._lock.acquire()
+        try:
+            self._buffer = buf
+        finally:
+            self._lock.release()
         self.emit('thumbnail', buf.timestamp)
         return gst.FLOW_OK
  
@@ -90,3 +141,63 @@ class CairoSurfaceThumbnailSink(gst.BaseSink):
         return self.do_render(buf)
 
 gobject.type_register(CairoSurfaceThumbnailSink)
+
+class LCDVideoBin(gst.Bin):
+    """
+    Bin that drops frames above the LCD frame rate, scales the video to the
+    size it will be painted at and only then converts it to the format
+    cairo needs, so full resolution frames are never converted or copied.
+    The bin ends in a CairoSurfaceThumbnailSink, available as the sink
+    attribute.
+
+    Keyword arguments:
+    width        -- width to scale frames to
+    height       -- height to scale frames to
+    max_fps      -- maximum frame rate, or 0 for no limit
+    """
+
+    def __init__(self, width, height, max_fps = 0):
+        gst.Bin.__init__(self)
+        self.sink = CairoSurfaceThumbnailSink()
+        self._max_fps = max_fps
+        self._size = None
+        self._rate = gst.element_factory_make("videorate")
+        self._scale = gst.element_factory_make("videoscale")
+        self._filter = gst.element_factory_make("capsfilter")
+        self._color_space = gst.element_factory_make("ffmpegcolorspace")
+        self.set_size(width, height)
+        self.add(self._rate, self._scale, self._filter, self._color_space, self.sink)
+        gst.element_link_many(self._rate, self._scale, self._filter,
+                              self._color_space, self.sink)
+        self.add_pad(gst.GhostPad("sink", self._rate.get_pad("sink")))
+
+    def set_size(self, width, height):
+        """
+        Change the size frames are scaled to. May be called while playing.
+
+        Keyword arguments:
+        width        -- width to scale frames to
+        height       -- height to scale frames to
+        """
+        self._size = ( max(1, int(width)), max(1, int(height)) )
+        self._set_caps()
+        
+    def set_max_fps(self, max_fps):
+        """
+        Change the maximum frame rate. May be called while playing, and does
+        nothing if the frame rate has not changed.
+
+        Keyword arguments:
+        max_fps      -- maximum frame rate, or 0 for no limit
+        """
+        if max_fps != self._max_fps:
+            self._max_fps = max_fps
+            self._set_caps()
+        
+    def _set_caps(self):
+        size = "width = (int) %d, height = (int) %d" % self._size
+        if self._max_fps > 0:
+            size += ", framerate = (fraction) [ 0/1, %d/1 ]" % self._max_fps
+        self._filter.set_property("caps", gst.Caps("video/x-raw-yuv, %s; video/x-raw-rgb, %s" % ( size, size )))
+
+gobject.type_register(LCDVideoBin)
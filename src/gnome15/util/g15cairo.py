@@ -27,10 +27,14 @@ import math
 import rsvg
 import urllib
 import base64
+import array
 import xdg.Mime as mime
 import g15convert
 import g15os
-import gnome15.g15globals
+import g15pixels
+from g15surfacepool import SurfacePool
+import gnome15.g15globals as g15globals
+from PIL import Image
 
 # Logging
 import logging
@@ -174,13 +178,37 @@ def load_svg_as_surface(filename, size):
         svg.close()
     
 def image_to_surface(image, type = "ppm"):
-    # TODO make better
-    return pixbuf_to_surface(image_to_pixbuf(image, type))
+    """
+    Convert a PIL image to a cairo ARGB32 surface. The type argument is no
+    longer used, the pixels are converted directly.
+    
+    Keyword arguments:
+    image        -- PIL image
+    type         -- ignored
+    """
+    image = _to_rgb_image(image)
+    width, height = image.size
+    data = g15pixels.rgba_to_argb32(g15pixels.image_tobytes(image), width, height, has_alpha = image.mode == "RGBA")
+    return _argb32_to_surface(data, width, height)
+
+def surface_to_image(surface):
+    """
+    Convert a cairo surface to a PIL RGBA image.
+    
+    Keyword arguments:
+    surface        -- cairo image surface
+    """
+    width = surface.get_width()
+    height = surface.get_height()
+    return Image.frombuffer("RGBA", (width, height), _surface_to_rgba(surface), "raw", "RGBA", 0, 1)
         
 def pixbuf_to_surface(pixbuf, size = None):
     x = pixbuf.get_width()
     y = pixbuf.get_height()
     scale = get_scale(size, (x, y))
+    if scale == 1.0:
+        data = g15pixels.rgba_to_argb32(pixbuf.get_pixels(), x, y, pixbuf.get_rowstride(), pixbuf.get_has_alpha())
+        return _argb32_to_surface(data, x, y)
     surface = cairo.ImageSurface(0, int(x * scale), int(y * scale))
     context = cairo.Context(surface)
     gdk_context = gtk.gdk.CairoContext(context) 
@@ -193,36 +221,36 @@ def pixbuf_to_surface(pixbuf, size = None):
      
     
 '''
-Convert a PIL image to a GDK pixbuf  
+Convert a PIL image to a GDK pixbuf. The type argument is no longer used, 
+the pixels are converted directly
 '''
 def image_to_pixbuf(im, type = "ppm"):  
-    p_type = type
-    if type == "ppm":
-        p_type = "pnm"
-    file1 = StringIO()  
-    try:
-        im.save(file1, type)  
-        contents = file1.getvalue()  
-    finally:
-        file1.close()  
-    loader = gtk.gdk.PixbufLoader(p_type)  
-    loader.write(contents, len(contents))  
-    pixbuf = loader.get_pixbuf()  
-    loader.close()  
-    return pixbuf
+    im = _to_rgb_image(im)
+    has_alpha = im.mode == "RGBA"
+    return gtk.gdk.pixbuf_new_from_data(g15pixels.image_tobytes(im), gtk.gdk.COLORSPACE_RGB, 
+                                        has_alpha, 8, im.size[0], im.size[1], 
+                                        im.size[0] * ( 4 if has_alpha else 3 ))
 
 def surface_to_pixbuf(surface):  
-    try:
-        file1 = StringIO()
-        surface.write_to_png(file1) 
-        contents = file1.getvalue() 
-    finally:
-        file1.close()   
-    loader = gtk.gdk.PixbufLoader("png")  
-    loader.write(contents, len(contents))  
-    pixbuf = loader.get_pixbuf()  
-    loader.close()  
-    return pixbuf
+    width = surface.get_width()
+    height = surface.get_height()
+    return gtk.gdk.pixbuf_new_from_data(_surface_to_rgba(surface), gtk.gdk.COLORSPACE_RGB, 
+                                        True, 8, width, height, width * 4)
+
+def to_argb32_surface(surface):
+    """
+    Get a surface in a 32 bit per pixel format (ARGB32 or RGB24). The surface
+    itself is returned if it is already in such a format, otherwise a copy is
+    painted into a new ARGB32 surface.
+    """
+    if surface.get_format() in [ cairo.FORMAT_ARGB32, cairo.FORMAT_RGB24 ]:
+        return surface
+    argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, surface.get_width(), surface.get_height())
+    argb_context = cairo.Context(argb_surface)
+    argb_context.set_source_surface(surface, 0, 0)
+    argb_context.set_operator(cairo.OPERATOR_SOURCE)
+    argb_context.paint()
+    return argb_surface
 
 def paint_thumbnail_image(allocated_size, image, canvas):
     s = float(allocated_size) / image.get_height()
@@ -287,3 +315,135 @@ def approx_px_to_pt(px):
     else:
         return int(px * 72.0 / 96)
 
+'''
+Private
+'''
+
+def _to_rgb_image(image):
+    if image.mode in [ "RGB", "RGBA" ]:
+        return image
+    return image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+
+def _argb32_to_surface(data, width, height):
+    return cairo.ImageSurface.create_for_data(array.array("B", data), cairo.FORMAT_ARGB32, width, height, width * 4)
+
+def _surface_to_rgba(surface):
+    surface = to_argb32_surface(surface)
+    surface.flush()
+    return g15pixels.argb32_to_rgba(surface.get_data(), surface.get_width(), surface.get_height(), 
+                                    surface.get_stride(), surface.get_format() == cairo.FORMAT_RGB24)
+
+def _legacy_image_to_pixbuf(im, type = "ppm"):
+    # The original conversion through an encoded image, kept for benchmarking only
+    p_type = type
+    if type == "ppm":
+        p_type = "pnm"
+    file1 = StringIO()  
+    try:
+        im.save(file1, type)  
+        contents = file1.getvalue()  
+    finally:
+        file1.close()  
+    loader = gtk.gdk.PixbufLoader(p_type)  
+    loader.write(contents, len(contents))  
+    pixbuf = loader.get_pixbuf()  
+    loader.close()  
+    return pixbuf
+
+def _legacy_surface_to_pixbuf(surface):
+    # The original conversion through an encoded PNG, kept for benchmarking only
+    try:
+        file1 = StringIO()
+        surface.write_to_png(file1) 
+        contents = file1.getvalue() 
+    finally:
+        file1.close()   
+    loader = gtk.gdk.PixbufLoader("png")  
+    loader.write(contents, len(contents))  
+    pixbuf = loader.get_pixbuf()  
+    loader.close()  
+    return pixbuf
+
+def _benchmark(name, function, count):
+    import time
+    start = time.time()
+    for i in range(count):
+        function()
+    taken = time.time() - start
+    print("%-40s %10.2f calls/sec %10.1f us/call" % (name, count / taken, taken * 1000000 / count))
+
+if __name__ == "__main__":
+    # Run with the src directory on PYTHONPATH, e.g. PYTHONPATH=src python src/gnome15/util/g15cairo.py
+    import random
+    import tempfile
+    import shutil
+    
+    width, height = 320, 240
+    print("Benchmarking cairo utilities with %dx%d surfaces (pixel engine: %s)" % (width, height, g15pixels.get_engine()))
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(surface)
+    for i in range(50):
+        context.set_source_rgba(random.random(), random.random(), random.random(), random.random())
+        context.rectangle(random.randint(0, width), random.randint(0, height), random.randint(1, 100), random.randint(1, 100))
+        context.fill()
+    rgb24_surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    a8_surface = cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+    image = surface_to_image(surface)
+    rgb_image = image.convert("RGB")
+    mono_image = image.convert("1")
+    pixbuf = surface_to_pixbuf(surface)
+    
+    print("Conversions")
+    _benchmark("surface_to_pixbuf (legacy PNG)", lambda: _legacy_surface_to_pixbuf(surface), 100)
+    _benchmark("surface_to_pixbuf", lambda: surface_to_pixbuf(surface), 500)
+    _benchmark("surface_to_pixbuf (RGB24)", lambda: surface_to_pixbuf(rgb24_surface), 500)
+    _benchmark("surface_to_image", lambda: surface_to_image(surface), 500)
+    _benchmark("image_to_pixbuf (legacy PPM)", lambda: _legacy_image_to_pixbuf(image), 100)
+    _benchmark("image_to_pixbuf (legacy PNG)", lambda: _legacy_image_to_pixbuf(image, "png"), 100)
+    _benchmark("image_to_pixbuf (RGBA)", lambda: image_to_pixbuf(image), 500)
+    _benchmark("image_to_pixbuf (RGB)", lambda: image_to_pixbuf(rgb_image), 500)
+    _benchmark("image_to_pixbuf (1 bit)", lambda: image_to_pixbuf(mono_image), 500)
+    _benchmark("image_to_surface (legacy PPM)", lambda: pixbuf_to_surface(_legacy_image_to_pixbuf(image)), 100)
+    _benchmark("image_to_surface (RGBA)", lambda: image_to_surface(image), 500)
+    _benchmark("image_to_surface (RGB)", lambda: image_to_surface(rgb_image), 500)
+    _benchmark("pixbuf_to_surface", lambda: pixbuf_to_surface(pixbuf), 500)
+    _benchmark("pixbuf_to_surface (scaled)", lambda: pixbuf_to_surface(pixbuf, (160, 120)), 500)
+    _benchmark("to_argb32_surface (ARGB32)", lambda: to_argb32_surface(surface), 10000)
+    _benchmark("to_argb32_surface (A8)", lambda: to_argb32_surface(a8_surface), 500)
+    
+    print("Loading")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        png_file = os.path.join(tmp_dir, "test.png")
+        surface.write_to_png(png_file)
+        svg_file = os.path.join(tmp_dir, "test.svg")
+        with open(svg_file, "w") as f:
+            f.write('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">' \
+                    '<rect x="10" y="10" width="100" height="50" style="fill:#ff0000"/>' \
+                    '<circle cx="160" cy="120" r="40" style="fill:#0000ff"/></svg>' % (width, height))
+        _benchmark("load_surface_from_file (PNG)", lambda: load_surface_from_file(png_file), 200)
+        _benchmark("load_surface_from_file (PNG, scaled)", lambda: load_surface_from_file(png_file, 64), 200)
+        _benchmark("load_surface_from_file (file:// URL)", lambda: load_surface_from_file("file://%s" % png_file), 200)
+        _benchmark("load_surface_from_file (SVG)", lambda: load_surface_from_file(svg_file), 200)
+        _benchmark("load_svg_as_surface", lambda: load_svg_as_surface(svg_file, (64, 48)), 200)
+        _benchmark("get_cache_filename", lambda: get_cache_filename("http://localhost/test.png", (64, 64)), 10000)
+        _benchmark("get_image_cache_file", lambda: get_image_cache_file("http://localhost/test.png", (64, 64)), 10000)
+    finally:
+        shutil.rmtree(tmp_dir, True)
+    
+    print("Painting")
+    pool = SurfacePool()
+    def pool_cycle():
+        pool.release(pool.get(cairo.FORMAT_ARGB32, width, height))
+    _benchmark("SurfacePool get and release", pool_cycle, 10000)
+    _benchmark("rotate", lambda: rotate(context, 90), 10000)
+    _benchmark("rotate_around_center", lambda: rotate_around_center(context, width, height, 90), 10000)
+    _benchmark("flip_horizontal", lambda: flip_horizontal(context, width, height), 10000)
+    _benchmark("flip_vertical", lambda: flip_vertical(context, width, height), 10000)
+    _benchmark("flip_hv_centered_on", lambda: flip_hv_centered_on(context, -1, 1, width / 2, height / 2), 10000)
+    _benchmark("paint_thumbnail_image", lambda: paint_thumbnail_image(24, surface, cairo.Context(rgb24_surface)), 1000)
+    
+    print("Other")
+    _benchmark("get_scale", lambda: get_scale((64, 48), (width, height)), 10000)
+    _benchmark("is_url", lambda: is_url("http://localhost/test.png"), 10000)
+    _benchmark("approx_px_to_pt", lambda: approx_px_to_pt(13.4), 10000)
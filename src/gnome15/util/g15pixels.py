@@ -0,0 +1,524 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Pixel format conversion for LCD frame buffers.
+
+Converts whole cairo ARGB32 buffers into the formats the devices expect in
+a single call. For colour (5-6-5) frames NumPy is used when it is available,
+otherwise the conversion falls back to byte-wise table translation on
+bytearrays, which still avoids a Python level loop over every pixel.
+Monochrome frames are dithered and packed by PIL.
+
+This module deliberately has no dependencies on GTK or cairo so that it may
+also be used by pylibg19 and the system service.
+'''
+
+import sys
+import binascii
+from PIL import Image
+from PIL import ImageChops
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError as e:
+    logger.debug("NumPy not available, using fallback pixel conversion", exc_info = e)
+    numpy = None
+
+'''
+Byte offsets of the blue, green, red and alpha channels within a native endian
+ARGB32 pixel (as used by cairo.FORMAT_ARGB32 and cairo.FORMAT_RGB24)
+'''
+if sys.byteorder == "little":
+    B_OFFSET, G_OFFSET, R_OFFSET, A_OFFSET = 0, 1, 2, 3
+else:
+    B_OFFSET, G_OFFSET, R_OFFSET, A_OFFSET = 3, 2, 1, 0
+
+'''
+The PIL raw mode that produces the same byte layout as a native ARGB32 surface
+'''
+PIL_ARGB32_MODE = "BGRA" if sys.byteorder == "little" else "ARGB"
+
+'''
+Dither modes for monochrome conversion
+'''
+DITHER_THRESHOLD = "threshold"
+DITHER_ORDERED = "ordered"
+DITHER_FLOYD_STEINBERG = "floyd-steinberg"
+DITHER_MODES = [ DITHER_THRESHOLD, DITHER_ORDERED, DITHER_FLOYD_STEINBERG ]
+
+'''
+Bit orders for packed monochrome frames. libg15 expects the left most pixel
+in the most significant bit, the kernel framebuffer in the least significant
+bit. BIT_ORDER_NONE produces one byte (0 or 1) per pixel.
+'''
+BIT_ORDER_MSB = "msb"
+BIT_ORDER_LSB = "lsb"
+BIT_ORDER_NONE = None
+
+'''
+Channel lookup tables. These reproduce the scaling used by the original
+per-pixel conversion exactly (g15convert.rgb_to_uint16)
+'''
+_R5 = [ min(v * 32 // 255, 31) for v in range(256) ]
+_G6 = [ min(v * 64 // 255, 63) for v in range(256) ]
+_B5 = _R5
+
+def _table(values):
+    return bytes(bytearray(values))
+
+# High byte is RRRRRGGG, low byte is GGGBBBBB
+_HI_R = _table([ r << 3 for r in _R5 ])
+_HI_G = _table([ g >> 3 for g in _G6 ])
+_LO_G = _table([ ( g << 5 ) & 0xff for g in _G6 ])
+_LO_B = _table(_B5)
+
+if numpy is not None:
+    _NP_R = numpy.array(_R5, dtype = numpy.uint16) << 11
+    _NP_G = numpy.array(_G6, dtype = numpy.uint16) << 5
+    _NP_B = numpy.array(_B5, dtype = numpy.uint16)
+
+def get_engine():
+    """
+    Get the name of the conversion engine in use, either "numpy" or "python"
+    """
+    return "numpy" if numpy is not None else "python"
+
+def surface_to_rgb565(surface, column_major = False):
+    """
+    Convert a cairo ARGB32 (or RGB24) image surface to packed little-endian
+    16 bit (5-6-5) pixels.
+
+    Keyword arguments:
+    surface        -- cairo image surface
+    column_major   -- if True, pixels are emitted column by column (as the G19 expects)
+    """
+    surface.flush()
+    return argb32_to_rgb565(surface.get_data(), surface.get_width(),
+                            surface.get_height(), surface.get_stride(),
+                            column_major)
+
+def argb32_to_rgb565(data, width, height, stride = None, column_major = False):
+    """
+    Convert a buffer of native endian ARGB32 pixels to packed little-endian
+    16 bit (5-6-5) pixels. The alpha channel is ignored.
+
+    Keyword arguments:
+    data           -- any object supporting the buffer protocol (e.g. the result of get_data())
+    width          -- width in pixels
+    height         -- height in pixels
+    stride         -- bytes per row, defaults to width * 4
+    column_major   -- if True, pixels are emitted column by column rather than row by row
+    """
+    if stride is None:
+        stride = width * 4
+    if width == 0 or height == 0:
+        return bytes()
+    if numpy is not None:
+        return _np_argb32_to_rgb565(data, width, height, stride, column_major)
+    return _py_argb32_to_rgb565(data, width, height, stride, column_major)
+
+def image_tobytes(image, *args):
+    """
+    Get the raw data of a PIL image, coping with both the old (tostring) and
+    new (tobytes) PIL APIs.
+    """
+    tobytes = getattr(image, "tobytes", None) or image.tostring
+    return tobytes(*args)
+
+def get_dither(name, default = DITHER_FLOYD_STEINBERG):
+    """
+    Get the dither mode with the given name, as read from configuration. An unknown 
+    name is logged and the default mode returned instead.
+    
+    Keyword arguments:
+    name           -- name of dither mode
+    default        -- mode to use if the name is not one of DITHER_MODES
+    """
+    if name in DITHER_MODES:
+        return name
+    logger.warning("Unknown dither mode '%s', using %s. Valid modes are %s", name, default, ", ".join(DITHER_MODES))
+    return default
+
+def surface_to_mono(surface, dither = DITHER_FLOYD_STEINBERG, invert = False,
+                    bit_order = BIT_ORDER_MSB, line_length = None):
+    """
+    Convert a cairo ARGB32 (or RGB24) image surface to a 1 bit per pixel
+    frame. See argb32_to_mono().
+    
+    Keyword arguments:
+    surface        -- cairo image surface
+    dither         -- one of DITHER_MODES
+    invert         -- if True, set bits are light pixels rather than dark
+    bit_order      -- one of BIT_ORDER_MSB, BIT_ORDER_LSB or BIT_ORDER_NONE
+    line_length    -- bytes per output row, defaults to the minimum needed
+    """
+    surface.flush()
+    return argb32_to_mono(surface.get_data(), surface.get_width(),
+                          surface.get_height(), surface.get_stride(),
+                          dither, invert, bit_order, line_length)
+
+def argb32_to_mono(data, width, height, stride = None, dither = DITHER_FLOYD_STEINBERG,
+                   invert = False, bit_order = BIT_ORDER_MSB, line_length = None):
+    """
+    Convert a buffer of native endian ARGB32 pixels to a row-major 1 bit per
+    pixel frame. By default a set bit is a dark pixel, i.e. an "on" pixel
+    on the LCD. Each row starts on a byte boundary, and may be padded to
+    line_length bytes (as required by the framebuffer).
+    
+    Keyword arguments:
+    data           -- any object supporting the buffer protocol (e.g. the result of get_data())
+    width          -- width in pixels
+    height         -- height in pixels
+    stride         -- bytes per input row, defaults to width * 4
+    dither         -- one of DITHER_MODES
+    invert         -- if True, set bits are light pixels rather than dark
+    bit_order      -- one of BIT_ORDER_MSB, BIT_ORDER_LSB or BIT_ORDER_NONE
+    line_length    -- bytes per output row, defaults to the minimum needed
+    """
+    if stride is None:
+        stride = width * 4
+    if width == 0 or height == 0:
+        return bytes()
+    pil_img = Image.frombuffer("RGBA", (width, height), data, "raw", PIL_ARGB32_MODE, stride, 1)
+    pil_img = _dither(pil_img.convert("L"), dither)
+    if bit_order == BIT_ORDER_NONE:
+        return image_tobytes(pil_img.convert("L").point(_INVERT_BYTES if invert else _NORMAL_BYTES))
+    buf = image_tobytes(pil_img, "raw", _MONO_RAW_MODES[(bit_order, invert)])
+    row_bytes = ( width + 7 ) // 8
+    if line_length is not None and line_length != row_bytes:
+        buf = _pad_rows(buf, row_bytes, height, line_length)
+    return buf
+
+def mono_to_argb32(data, width, height, packed = True, foreground = ( 255, 255, 255, 255 ),
+                   background = ( 0, 0, 0, 255 )):
+    """
+    Convert a 1 bit per pixel frame (such as those sent by g15daemon clients)
+    to native endian ARGB32 pixels, as used by cairo.ImageSurface.create_for_data()
+    with a stride of width * 4. Any bytes after the frame are ignored.
+    
+    Keyword arguments:
+    data           -- any object supporting the buffer protocol
+    width          -- width in pixels
+    height         -- height in pixels
+    packed         -- if True, each row is packed into bytes with the left most pixel in the 
+                      most significant bit. Otherwise there is one byte per pixel. Set bits 
+                      (or non-zero bytes) are "on" pixels 
+    foreground     -- RGBA colour of "on" pixels
+    background     -- RGBA colour of "off" pixels
+    """
+    if packed:
+        frame_len = ( ( width + 7 ) // 8 ) * height
+    else:
+        frame_len = width * height
+    if len(data) < frame_len:
+        raise ValueError("Expected a frame of at least %d bytes, got %d" % (frame_len, len(data)))
+    if packed:
+        mask_img = Image.frombuffer("1", (width, height), bytes(data[:frame_len]), "raw", "1", 0, 1).convert("L")
+    else:
+        mask_img = Image.frombuffer("L", (width, height), bytes(data[:frame_len]), "raw", "L", 0, 1).point(_POSITIVE)
+    channels = [ mask_img.point([ off ] + [ on ] * 255) for on, off in zip(_premultiply(foreground), _premultiply(background)) ]
+    return image_tobytes(Image.merge("RGBA", channels), "raw", PIL_ARGB32_MODE)
+
+def argb32_to_rgba(data, width, height, stride = None, opaque = False):
+    """
+    Convert a buffer of native endian, premultiplied ARGB32 pixels (as used
+    by cairo) to RGBA bytes that are not premultiplied (as used by GdkPixbuf
+    and PIL). Rows in the result are width * 4 bytes.
+    
+    Keyword arguments:
+    data           -- any object supporting the buffer protocol (e.g. the result of get_data())
+    width          -- width in pixels
+    height         -- height in pixels
+    stride         -- bytes per input row, defaults to width * 4
+    opaque         -- if True, the alpha channel is ignored and all pixels are opaque (as for cairo.FORMAT_RGB24)
+    """
+    if stride is None:
+        stride = width * 4
+    if width == 0 or height == 0:
+        return bytes()
+    data = _pad_to(data, stride * height)
+    if numpy is not None:
+        return _np_argb32_to_rgba(data, width, height, stride, opaque)
+    pil_img = Image.frombuffer("RGBA", (width, height), data, "raw", PIL_ARGB32_MODE, stride, 1)
+    if opaque:
+        return image_tobytes(pil_img.convert("RGB").convert("RGBA"))
+    return image_tobytes(Image.merge("RGBa", pil_img.split()).convert("RGBA"))
+
+def rgba_to_argb32(data, width, height, stride = None, has_alpha = True):
+    """
+    Convert RGBA (or RGB) bytes that are not premultiplied (as used by
+    GdkPixbuf and PIL) to native endian premultiplied ARGB32 pixels, as used by
+    cairo.ImageSurface.create_for_data() with a stride of width * 4.
+    
+    Keyword arguments:
+    data           -- any object supporting the buffer protocol (e.g. the result of get_pixels())
+    width          -- width in pixels
+    height         -- height in pixels
+    stride         -- bytes per input row, defaults to width * 4 (or width * 3 without alpha)
+    has_alpha      -- if False, input pixels are RGB
+    """
+    channels = 4 if has_alpha else 3
+    if stride is None:
+        stride = width * channels
+    if width == 0 or height == 0:
+        return bytes()
+    data = _pad_to(data, stride * height)
+    if numpy is not None:
+        return _np_rgba_to_argb32(data, width, height, stride, channels)
+    mode = "RGBA" if has_alpha else "RGB"
+    pil_img = Image.frombuffer(mode, (width, height), data, "raw", mode, stride, 1)
+    if has_alpha:
+        pil_img = Image.merge("RGBA", pil_img.convert("RGBa").split())
+    else:
+        pil_img = pil_img.convert("RGBA")
+    return image_tobytes(pil_img, "raw", PIL_ARGB32_MODE)
+
+'''
+Private
+'''
+
+'''
+PIL raw modes to pack mode "1" images. In mode "1" images a set bit is
+white, so the "I" modes are the default, where set bits are dark pixels.
+'''
+_MONO_RAW_MODES = {
+    ( BIT_ORDER_MSB, False ) : "1;I",
+    ( BIT_ORDER_MSB, True ) : "1",
+    ( BIT_ORDER_LSB, False ) : "1;IR",
+    ( BIT_ORDER_LSB, True ) : "1;R"
+}
+
+# Point tables for unpacked output (0 or 255 in, 0 or 1 out)
+_NORMAL_BYTES = [ 1 ] + [ 0 ] * 255
+_INVERT_BYTES = [ 0 ] * 255 + [ 1 ]
+
+# Threshold table for grey levels
+_THRESHOLD = [ 0 ] * 128 + [ 255 ] * 128
+
+# 4x4 Bayer matrix, scaled to grey levels
+_BAYER = [ [ 0, 8, 2, 10 ],
+           [ 12, 4, 14, 6 ],
+           [ 3, 11, 1, 9 ],
+           [ 15, 7, 13, 5 ] ]
+
+# Positive differences from the ordered dither threshold map to white
+_POSITIVE = [ 0 ] + [ 255 ] * 255
+
+_bayer_images = {}
+
+def _dither(grey_img, dither):
+    if dither == DITHER_FLOYD_STEINBERG:
+        return grey_img.convert("1")
+    elif dither == DITHER_THRESHOLD:
+        return grey_img.point(_THRESHOLD).convert("1")
+    elif dither == DITHER_ORDERED:
+        diff = ImageChops.subtract(grey_img, _get_bayer_image(grey_img.size))
+        return diff.point(_POSITIVE).convert("1")
+    else:
+        raise ValueError("Unknown dither mode %s" % dither)
+
+def _premultiply(rgba):
+    # cairo expects colour channels to be premultiplied by alpha
+    return [ c * rgba[3] // 255 for c in rgba[:3] ] + [ rgba[3] ]
+
+def _get_bayer_image(size):
+    if not size in _bayer_images:
+        row_data = []
+        for y in range(size[1]):
+            row = _BAYER[y % 4]
+            row_data.append(bytearray([ row[x % 4] * 16 + 8 for x in range(size[0]) ]))
+        _bayer_images[size] = Image.frombuffer("L", size, b"".join(bytes(row) for row in row_data), "raw", "L", 0, 1)
+    return _bayer_images[size]
+
+def _pad_rows(buf, row_bytes, height, line_length):
+    out = bytearray(line_length * height)
+    for y in range(height):
+        out[y * line_length:y * line_length + row_bytes] = buf[y * row_bytes:( y + 1 ) * row_bytes]
+    return bytes(out)
+
+def _pad_to(data, length):
+    # GdkPixbuf does not allocate the padding at the end of the last row
+    if len(data) >= length:
+        return data
+    return bytes(data) + b"\0" * ( length - len(data) )
+
+def _np_pixels(data, width, height, stride, channels):
+    px = numpy.frombuffer(data, dtype = numpy.uint8, count = stride * height)
+    return px.reshape(height, stride)[:, :width * channels].reshape(height, width, channels)
+
+def _np_argb32_to_rgba(data, width, height, stride, opaque):
+    px = _np_pixels(data, width, height, stride, 4)
+    out = numpy.empty((height, width, 4), dtype = numpy.uint8)
+    if opaque:
+        for i, offset in enumerate(( R_OFFSET, G_OFFSET, B_OFFSET )):
+            out[:, :, i] = px[:, :, offset]
+        out[:, :, 3] = 255
+    else:
+        # Un-premultiply with rounding, as cairo does when writing PNG files
+        px = px.astype(numpy.uint16)
+        alpha = px[:, :, A_OFFSET]
+        half = alpha >> 1
+        divisor = numpy.maximum(alpha, 1)
+        for i, offset in enumerate(( R_OFFSET, G_OFFSET, B_OFFSET )):
+            out[:, :, i] = numpy.minimum(( px[:, :, offset] * 255 + half ) // divisor, 255)
+        out[:, :, 3] = alpha
+    return out.tobytes()
+
+def _np_rgba_to_argb32(data, width, height, stride, channels):
+    px = _np_pixels(data, width, height, stride, channels)
+    out = numpy.empty((height, width, 4), dtype = numpy.uint8)
+    if channels == 4:
+        # Premultiply with rounding, as GDK and cairo do
+        px = px.astype(numpy.uint16)
+        alpha = px[:, :, 3]
+        for i, offset in enumerate(( R_OFFSET, G_OFFSET, B_OFFSET )):
+            t = px[:, :, i] * alpha + 0x80
+            out[:, :, offset] = ( ( t >> 8 ) + t ) >> 8
+        out[:, :, A_OFFSET] = alpha
+    else:
+        for i, offset in enumerate(( R_OFFSET, G_OFFSET, B_OFFSET )):
+            out[:, :, offset] = px[:, :, i]
+        out[:, :, A_OFFSET] = 255
+    return out.tobytes()
+
+def _np_argb32_to_rgb565(data, width, height, stride, column_major):
+    px = numpy.frombuffer(data, dtype = numpy.uint8, count = stride * height)
+    px = px.reshape(height, stride)[:, :width * 4].reshape(height, width, 4)
+    val = _NP_R[px[:, :, R_OFFSET]] | _NP_G[px[:, :, G_OFFSET]] | _NP_B[px[:, :, B_OFFSET]]
+    if column_major:
+        val = val.T
+    return numpy.ascontiguousarray(val, dtype = "<u2").tobytes()
+
+def _py_argb32_to_rgb565(data, width, height, stride, column_major):
+    data = _strip_stride(bytearray(data), width * 4, height, stride)
+    r = data[R_OFFSET::4]
+    g = data[G_OFFSET::4]
+    b = data[B_OFFSET::4]
+    hi = _or_bytes(r.translate(_HI_R), g.translate(_HI_G))
+    lo = _or_bytes(g.translate(_LO_G), b.translate(_LO_B))
+    if column_major:
+        hi = _transpose(hi, width, height)
+        lo = _transpose(lo, width, height)
+    out = bytearray(len(hi) * 2)
+    out[0::2] = lo
+    out[1::2] = hi
+    return bytes(out)
+
+def _strip_stride(data, row_bytes, height, stride):
+    if stride == row_bytes:
+        return data[:row_bytes * height]
+    out = bytearray()
+    for y in range(height):
+        out += data[y * stride:y * stride + row_bytes]
+    return out
+
+def _or_bytes(a, b):
+    """
+    Bitwise OR two equal length byte arrays. The arrays are treated as big
+    integers so the work happens in C rather than per byte in Python.
+    """
+    n = len(a)
+    v = int(binascii.hexlify(a), 16) | int(binascii.hexlify(b), 16)
+    return bytearray(binascii.unhexlify("%0*x" % (n * 2, v)))
+
+def _transpose(data, width, height):
+    out = bytearray(len(data))
+    for x in range(width):
+        out[x * height:(x + 1) * height] = data[x::width]
+    return out
+
+def _legacy_argb32_to_rgb565(data, width, height):
+    # The original per-pixel conversion (g15convert.rgb_to_uint16), kept for benchmarking only
+    data = bytearray(data)
+    out = bytearray()
+    for i in range(0, width * height * 4, 4):
+        r = min(data[i + R_OFFSET] * 32 // 255, 31)
+        g = min(data[i + G_OFFSET] * 64 // 255, 63)
+        b = min(data[i + B_OFFSET] * 32 // 255, 31)
+        out.append(( ( g << 5 ) | b ) & 0xff)
+        out.append(( ( r << 3 ) | ( g >> 3 ) ) & 0xff)
+    return bytes(out)
+
+def _legacy_argb32_to_mono(data, width, height):
+    # The original PIL and per-pixel packing used by the G15 direct driver, kept for benchmarking only
+    pil_img = Image.frombuffer("RGBA", (width, height), data, "raw", "RGBA", 0, 1)
+    pil_img = pil_img.convert("1").convert("P")
+    pil_img = pil_img.point(lambda i: i >= 250,'1')
+    pil_img = pil_img.point(lambda i: 1^i)
+    buf = list(pil_img.getdata())
+    arrbuf = bytearray(( width * height + 7 ) // 8)
+    for x in range(0, width):
+        for y in range(0, height):
+            pixel_offset = y * width + x
+            byte_offset = pixel_offset // 8
+            bit_offset = 7 - ( pixel_offset % 8 )
+            if buf[x + ( y * width )] > 0:
+                arrbuf[byte_offset] |= 1 << bit_offset
+            else:
+                arrbuf[byte_offset] &= ~( 1 << bit_offset )
+    return bytes(arrbuf)
+
+def _benchmark(name, function, frames):
+    import time
+    start = time.time()
+    for i in range(frames):
+        function()
+    taken = time.time() - start
+    print("%-30s %10.2f frames/sec %10.1f us/frame" % (name, frames / taken, taken * 1000000 / frames))
+
+if __name__ == "__main__":
+    import random
+    width, height = 320, 240
+    frame = bytes(bytearray(random.randint(0, 255) for i in range(width * height * 4)))
+    print("Converting %dx%d ARGB32 frames to RGB565 (engine: %s)" % (width, height, get_engine()))
+    _benchmark("legacy per-pixel", lambda: _legacy_argb32_to_rgb565(frame, width, height), 3)
+    _benchmark("python fallback", lambda: _py_argb32_to_rgb565(frame, width, height, width * 4, False), 50)
+    _benchmark("python fallback (columns)", lambda: _py_argb32_to_rgb565(frame, width, height, width * 4, True), 50)
+    if numpy is not None:
+        _benchmark("numpy", lambda: _np_argb32_to_rgb565(frame, width, height, width * 4, False), 200)
+        _benchmark("numpy (columns)", lambda: _np_argb32_to_rgb565(frame, width, height, width * 4, True), 200)
+        
+    width, height = 160, 43
+    frame = bytes(bytearray(random.randint(0, 255) for i in range(width * height * 4)))
+    print("Converting %dx%d ARGB32 frames to 1 bit per pixel" % (width, height))
+    _benchmark("legacy per-pixel", lambda: _legacy_argb32_to_mono(frame, width, height), 20)
+    for dither in DITHER_MODES:
+        _benchmark(dither, lambda: argb32_to_mono(frame, width, height, dither = dither), 1000)
+    _benchmark("floyd-steinberg (lsb, padded)", lambda: argb32_to_mono(frame, width, height,
+                                                                       bit_order = BIT_ORDER_LSB,
+                                                                       line_length = 24), 1000)
+    
+    width, height = 320, 240
+    frame = bytes(bytearray(random.randint(0, 255) for i in range(width * height * 4)))
+    print("Converting %dx%d frames between ARGB32 and RGBA (engine: %s)" % (width, height, get_engine()))
+    _benchmark("ARGB32 to RGBA", lambda: argb32_to_rgba(frame, width, height), 200)
+    _benchmark("ARGB32 to RGBA (opaque)", lambda: argb32_to_rgba(frame, width, height, opaque = True), 200)
+    _benchmark("RGBA to ARGB32", lambda: rgba_to_argb32(frame, width, height), 200)
+    _benchmark("RGB to ARGB32", lambda: rgba_to_argb32(frame, width, height, width * 3, False), 200)
+    
+    width, height = 160, 43
+    print("Converting %dx%d 1 bit per pixel frames to ARGB32" % (width, height))
+    frame = bytes(bytearray(random.randint(0, 255) for i in range(1048)))
+    _benchmark("packed", lambda: mono_to_argb32(frame, width, height), 1000)
+    frame = bytes(bytearray(random.choice([0, 1]) for i in range(width * height)))
+    _benchmark("byte per pixel", lambda: mono_to_argb32(frame, width, height, packed = False,
+                                                         foreground = (255, 128, 0, 255),
+                                                         background = (0, 0, 0, 0)), 1000)
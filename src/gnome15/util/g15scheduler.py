@@ -23,6 +23,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import jobqueue
+from jobqueue import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW, DEFAULT_QUEUE
 
 '''
 Default scheduler
@@ -38,11 +39,11 @@ event loop, which then executes the job on a different thread
 def clear_jobs(queue_name = None):
     scheduler.clear_jobs(queue_name)
 
-def execute(queue_name, job_name, function, *args):
-    return scheduler.execute(queue_name, job_name, function, *args)
+def execute(queue_name, job_name, function, *args, **kwargs):
+    return scheduler.execute(queue_name, job_name, function, *args, **kwargs)
 
-def schedule(job_name, interval, function, *args):
-    return scheduler.schedule(job_name, interval, function, *args)
+def schedule(job_name, interval, function, *args, **kwargs):
+    return scheduler.schedule(job_name, interval, function, *args, **kwargs)
 
 def run_on_gobject(function, *args):
     if g15pythonlang.is_gobject_thread():
@@ -54,8 +55,14 @@ def run_on_gobject(function, *args):
 def stop_queue(queue_name):
     scheduler.stop_queue(queue_name)
 
-def queue(queue_name, job_name, interval, function, *args):
-    return scheduler.queue(queue_name, job_name, interval, function, *args)
+def queue(queue_name, job_name, interval, function, *args, **kwargs):
+    return scheduler.queue(queue_name, job_name, interval, function, *args, **kwargs)
+
+def set_number_of_workers(queue_name, number_of_workers):
+    scheduler.set_number_of_workers(queue_name, number_of_workers)
+    
+def get_statistics():
+    return scheduler.get_statistics()
 
 def stop_all_schedulers():
     scheduler.stop_all()
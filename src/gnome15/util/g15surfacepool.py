@@ -0,0 +1,86 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Pooling of cairo image surfaces so frame buffers can be re-used. Only depends
+on cairo, so it may be used by drivers that have no display.
+'''
+
+import cairo
+from threading import Lock
+
+class SurfacePool():
+    """
+    Keeps image surfaces that are no longer needed so they can be re-used instead
+    of allocating new pixel buffers for every frame. Surfaces are pooled by their
+    format and size. The contents of a surface obtained from the pool are whatever
+    was last painted on it, so the caller must paint the whole surface (or clear it)
+    """
+    
+    def __init__(self):
+        self.allocations = 0
+        self._free = {}
+        self._lock = Lock()
+        
+    def get(self, format, width, height):
+        """
+        Get a surface of the given format and size, allocating a new one only if 
+        there is none free in the pool
+        
+        Keyword arguments:
+        format        -- cairo format
+        width         -- width of surface
+        height        -- height of surface
+        """
+        key = (format, width, height)
+        self._lock.acquire()
+        try:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+            self.allocations += 1
+        finally:
+            self._lock.release()
+        return cairo.ImageSurface(format, width, height)
+    
+    def release(self, surface):
+        """
+        Return a surface to the pool. The surface must not be used by the caller
+        after this.
+        
+        Keyword arguments:
+        surface       -- surface to return, may be None
+        """
+        if surface is None:
+            return
+        key = (surface.get_format(), surface.get_width(), surface.get_height())
+        self._lock.acquire()
+        try:
+            free = self._free.setdefault(key, [])
+            if not surface in free:
+                free.append(surface)
+        finally:
+            self._lock.release()
+            
+    def clear(self):
+        """
+        Discard all free surfaces
+        """
+        self._lock.acquire()
+        try:
+            self._free = {}
+        finally:
+            self._lock.release()
@@ -17,7 +17,8 @@
 import Queue
 import threading
 import traceback
-import sys
+import itertools
+import bisect
 import gobject
 import time
 from threading import RLock
@@ -26,6 +27,23 @@ from threading import local
 # Can be adjusted to speed up time to aid debugging.
 TIME_FACTOR=1
 
+# Set to True to record where each job was queued from, so the stack can be logged
+# if the job fails. This is expensive, so is off by default
+CAPTURE_STACKS=False
+
+# Job priorities. Jobs with a lower value are run first, jobs of equal priority are 
+# run in the order they were queued
+PRIORITY_HIGH=0
+PRIORITY_NORMAL=1
+PRIORITY_LOW=2
+
+# Queue used for jobs that do not name one
+DEFAULT_QUEUE="default"
+
+# Upper bounds (in milliseconds) of the buckets used for job wait and run time 
+# histograms. Anything longer goes into a final overflow bucket
+HISTOGRAM_BUCKETS=[ 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000 ]
+
 # Logging
 import logging
 logger = logging.getLogger(__name__)
@@ -49,8 +67,25 @@ def is_on_queue(queue_name):
         return True
     return False
 
+class Histogram():
+    """
+    Counts of timings falling into each of HISTOGRAM_BUCKETS
+    """
+    def __init__(self):
+        self.counts = [ 0 ] * ( len(HISTOGRAM_BUCKETS) + 1 )
+        
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds * 1000.0)] += 1
+        
+    def get_statistics(self, prefix):
+        stats = {}
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            stats["%s_le_%dms" % (prefix, bound)] = self.counts[i]
+        stats["%s_gt_%dms" % (prefix, HISTOGRAM_BUCKETS[-1])] = self.counts[-1]
+        return stats
+
 class GTimer:    
-    def __init__(self, scheduler, task_queue, task_name, interval, function, stack, *args):
+    def __init__(self, scheduler, task_queue, task_name, interval, function, stack, *args, **kwargs):
         self.function = function
         if function == None:
             logger.warning("Attempt to run empty job %s on %s", task_name, task_queue.name)
@@ -60,20 +95,24 @@ class GTimer:
         self.scheduler = scheduler
         self.task_queue = task_queue
         self.task_name = task_name
-        self.source = gobject.timeout_add(int(float(interval) * 1000.0 * TIME_FACTOR), self.exec_item, function, *args)
+        self.kwargs = kwargs
         self.complete = False
-        self.scheduler.all_jobs.append(self)
+        self.scheduler.all_jobs_lock.acquire()
+        try:
+            self.source = gobject.timeout_add(int(float(interval) * 1000.0 * TIME_FACTOR), self.exec_item, function, *args)
+            self.scheduler.all_jobs.add(self)
+        finally:
+            self.scheduler.all_jobs_lock.release()
         
     def exec_item(self, function, *args):
         try:
             logger.debug("Executing GTimer %s", str(self.task_name))
-            ji = self.task_queue.run(self.stack, function, *args)
+            ji = self.task_queue.run(self.stack, function, *args, name = self.task_name, **self.kwargs)
             logger.debug("Executed GTimer %s", str(self.task_name))
         finally:
             self.scheduler.all_jobs_lock.acquire()
             try:
-                if self in self.scheduler.all_jobs:
-                    self.scheduler.all_jobs.remove(self)
+                self.scheduler.all_jobs.discard(self)
                 self.complete = True
             finally:
                 self.scheduler.all_jobs_lock.release()
@@ -84,8 +123,7 @@ class GTimer:
     def cancel(self, *args):
         self.scheduler.all_jobs_lock.acquire()
         try:
-            if self in self.scheduler.all_jobs:
-                self.scheduler.all_jobs.remove(self)
+            self.scheduler.all_jobs.discard(self)
             gobject.source_remove(self.source)
             logger.debug("Cancelled GTimer %s", str(self.task_name))
         finally:
@@ -101,7 +139,9 @@ class JobScheduler():
     
     def __init__(self):
         self.queues = {}
-        self.all_jobs = []
+        self.queue_workers = {}
+        self.queues_lock = RLock()
+        self.all_jobs = set()
         self.all_jobs_lock = RLock()
         
     def print_all_jobs(self):
@@ -114,9 +154,36 @@ class JobScheduler():
         print "-------"
         for q in self.queues:
             self.queues[q].print_all_jobs()
+            
+    def get_statistics(self):
+        """
+        Get a dictionary of statistics dictionaries, one for each queue
+        """
+        stats = {}
+        for queue_name, job_queue in self.queues.items():
+            stats[queue_name] = job_queue.get_statistics()
+        return stats
+    
+    def set_number_of_workers(self, queue_name, number_of_workers):
+        """
+        Set how many threads run jobs for a queue. Queues have a single worker unless
+        set otherwise. Jobs on a queue with more than one worker may run concurrently
+        and complete out of order.
+        
+        Keyword arguments:
+        queue_name        -- queue name
+        number_of_workers -- number of workers
+        """
+        self.queues_lock.acquire()
+        try:
+            self.queue_workers[queue_name] = number_of_workers
+            if queue_name in self.queues:
+                self.queues[queue_name].set_number_of_workers(number_of_workers)
+        finally:
+            self.queues_lock.release()
         
-    def schedule(self, name, interval, function, *args):
-        return self.queue("default", name, interval, function, *args)
+    def schedule(self, name, interval, function, *args, **kwargs):
+        return self.queue(DEFAULT_QUEUE, name, interval, function, *args, **kwargs)
     
     def stop_all(self):
         logger.info("Stopping all queues")
@@ -128,34 +195,65 @@ class JobScheduler():
             self.queues[queue_name].clear()
             
     def stop_queue(self, queue_name):
-        if queue_name in self.queues:
-            self.queues[queue_name].stop()
-            del self.queues[queue_name]
+        self.queues_lock.acquire()
+        try:
+            if queue_name in self.queues:
+                self.queues[queue_name].stop()
+                del self.queues[queue_name]
+        finally:
+            self.queues_lock.release()
     
-    def execute(self, queue_name, name, function, *args):
+    def execute(self, queue_name, name, function, *args, **kwargs):
+        """
+        Run a function on a queue as soon as a worker is free. 
+        
+        Keyword arguments:
+        queue_name        -- queue name
+        name              -- job name
+        function          -- function to run
+        args              -- arguments to pass to function
+        priority          -- (keyword only) one of PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+        deadline          -- (keyword only) seconds after which the job is dropped if it has not started
+        on_drop           -- (keyword only) function to run instead if the job is dropped
+        """
         logger.debug("Executing on queue %s", queue_name)
-        if not queue_name in self.queues:
-            self.queues[queue_name] = JobQueue(name=queue_name)   
-        self.queues[queue_name].run(self._get_stack(), function, *args)        
+        self._get_queue(queue_name).run(self._get_stack(), function, *args, name = name, **kwargs)        
+        
+    def _get_queue(self, queue_name):
+        self.queues_lock.acquire()
+        try:
+            if not queue_name in self.queues:
+                self.queues[queue_name] = JobQueue(self.queue_workers.get(queue_name, 1), name=queue_name)
+            return self.queues[queue_name]
+        finally:
+            self.queues_lock.release()
         
     def _get_stack(self):
-        try: 1/0
-        except:
-            tb = sys.exc_info()[2]
-            return traceback.extract_stack()[:-5]
+        if CAPTURE_STACKS:
+            return traceback.extract_stack()[:-2]
     
-    def queue(self, queue_name, name, interval, function, *args):
+    def queue(self, queue_name, name, interval, function, *args, **kwargs):
+        """
+        Run a function on a queue after an interval. See execute() for the keyword 
+        only arguments. Any deadline starts from when the interval has elapsed.
+        
+        Keyword arguments:
+        queue_name        -- queue name
+        name              -- job name
+        interval          -- interval in seconds
+        function          -- function to run
+        args              -- arguments to pass to function
+        """
         if not hasattr(function, "__call__"):
             raise Exception("Not a function")
         logger.debug("Queueing %s on %s for execution in %f", name, queue_name, interval)
-        if not queue_name in self.queues:
-            self.queues[queue_name] = JobQueue(name=queue_name)
+        job_queue = self._get_queue(queue_name)
         
         if interval == 0:
             # Optimisation, if this is un-timed, avoid putting on main loop
-            self.queues[queue_name].run(self._get_stack(), function, *args)
+            job_queue.run(self._get_stack(), function, *args, name = name, **kwargs)
         else:
-            timer = GTimer(self, self.queues[queue_name], name, interval, function, self._get_stack(), *args)
+            timer = GTimer(self, job_queue, name, interval, function, self._get_stack(), *args, **kwargs)
             logger.debug("Queued %s", name)
             return timer
 
@@ -163,45 +261,94 @@ class JobScheduler():
 class JobQueue():
     
     class JobItem():
-        def __init__(self, stack, item, args = None):
+        def __init__(self, stack, item, args = None, name = None, priority = PRIORITY_NORMAL, deadline = None, on_drop = None):
             self.args = args
             self.item = item
+            self.name = name
+            self.priority = priority
+            self.on_drop = on_drop
             self.queued = time.time()
+            self.deadline = self.queued + deadline if deadline is not None else None
             self.started = None
             self.finished = None
             self.stack = stack
         
     def __init__(self,number_of_workers=1, name="JobQueue"):
         logger.debug("Creating job queue %s with %d workers", name, number_of_workers)
-        self.work_queue = Queue.Queue()
-        self.queued_jobs = []
+        self.work_queue = Queue.PriorityQueue()
+        self.queued_jobs = {}
         self.name = name
         self.stopping = False
         self.all_jobs_lock = threading.Lock()
-        self.number_of_workers = number_of_workers
+        self.number_of_workers = 0
         self.threads = []
-        for __ in range(number_of_workers):
-            t = threading.Thread(target = self.worker)
-            t.name = name
-            t.setDaemon(True)
-            t.start()
-            self.threads.append(t)
+        self.created = time.time()
+        self.jobs_run = 0
+        self.jobs_failed = 0
+        self.jobs_dropped = 0
+        self.wait_times = Histogram()
+        self.run_times = Histogram()
+        self._sequence = itertools.count()
+        self.set_number_of_workers(number_of_workers)
+        
+    def set_number_of_workers(self, number_of_workers):
+        """
+        Start more workers if there are fewer than the number requested. Workers
+        are never stopped until the queue is.
+        
+        Keyword arguments:
+        number_of_workers -- number of workers
+        """
+        self.all_jobs_lock.acquire()
+        try:
+            for __ in range(self.number_of_workers, number_of_workers):
+                t = threading.Thread(target = self.worker)
+                t.name = self.name
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+            self.number_of_workers = max(self.number_of_workers, number_of_workers)
+        finally:
+            self.all_jobs_lock.release()
             
     def print_all_jobs(self):
         print "Queue %s" % self.name
-        for s in self.queued_jobs:
+        for s in self.queued_jobs.values():
             print "     %s - %s" % (str(s.item), str(s.queued))
             
+    def get_statistics(self):
+        """
+        Get a dictionary of counters for the jobs run, failed and dropped because
+        their deadline passed, together with histograms of how long jobs waited 
+        to start and how long they took to run
+        """
+        self.all_jobs_lock.acquire()
+        try:
+            stats = { "workers" : self.number_of_workers,
+                      "queued" : len(self.queued_jobs),
+                      "jobs_run" : self.jobs_run,
+                      "jobs_failed" : self.jobs_failed,
+                      "jobs_dropped" : self.jobs_dropped,
+                      "uptime_ms" : int(( time.time() - self.created ) * 1000) }
+            stats.update(self.wait_times.get_statistics("wait"))
+            stats.update(self.run_times.get_statistics("run"))
+            return stats
+        finally:
+            self.all_jobs_lock.release()
+            
     def stop(self):
         logger.info("Stopping queue %s", self.name)
         self.stopping = True
         self.clear()
         for i in range(0, self.number_of_workers):
-            self.work_queue.put(self.JobItem("Stopping", self._dummy))
+            self._put(self.JobItem(None, self._dummy, name = "Stopping", priority = PRIORITY_HIGH))
         logger.info("Stopped queue %s", self.name)
         
     def _dummy(self):
         pass
+    
+    def _put(self, item):
+        self.work_queue.put((item.priority, next(self._sequence), item))
             
     def clear(self):
         jobs = self.work_queue.qsize()
@@ -209,7 +356,7 @@ class JobQueue():
             logger.info("Clearing queue %s as it has %d jobs", self.name, jobs)
             try :
                 while True:
-                    item = self.work_queue.get_nowait()
+                    item = self.work_queue.get_nowait()[2]
                     logger.debug("Removed func = %s, args = %s, queued = %s, " \
                                  "started = %s, finished = %s",
                                  str(item.item),
@@ -217,14 +364,26 @@ class JobQueue():
                                  str(item.queued),
                                  str(item.started),
                                  str(item.finished))
-                    if item in self.queued_jobs:
-                        self.queued_jobs.remove(item)
+                    self.queued_jobs.pop(id(item), None)
+                    self.work_queue.task_done()
             except Queue.Empty as e:
                 logger.debug("The queue is already empty", exc_info = e)
                 pass
             logger.info("Cleared queue %s", self.name)
             
-    def run(self, stack, item, *args):
+    def run(self, stack, item, *args, **kwargs):
+        """
+        Queue a function to run.
+        
+        Keyword arguments:
+        stack             -- stack the job was queued from or None
+        item              -- function to run
+        args              -- arguments to pass to function
+        name              -- (keyword only) job name
+        priority          -- (keyword only) one of PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+        deadline          -- (keyword only) seconds after which the job is dropped if it has not started
+        on_drop           -- (keyword only) function to run instead if the job is dropped
+        """
         if self.stopping:
             return
         if item == None:
@@ -234,9 +393,9 @@ class JobQueue():
         self.all_jobs_lock.acquire()
         try :
             logger.debug("Queued task on %s", self.name)
-            ji = self.JobItem(stack, item, args)
-            self.queued_jobs.append(ji)
-            self.work_queue.put(ji)
+            ji = self.JobItem(stack, item, args, **kwargs)
+            self.queued_jobs[id(ji)] = ji
+            self._put(ji)
             jobs = self.work_queue.qsize()
             if jobs > 1:
                 logger.debug("Queue %s filling, now at %d jobs.", self.name, jobs)
@@ -248,34 +407,62 @@ class JobQueue():
     def worker(self):
         queue_names.queue_name = self.name
         while not self.stopping:
-            item = self.work_queue.get()
+            item = self.work_queue.get()[2]
             try:
                 if item != None:
                     try:
-                        logger.debug("Running task on %s", self.name)
                         item.started = time.time()
+                        if item.deadline is not None and item.started > item.deadline:
+                            logger.debug("Dropping stale task %s on %s", item.name, self.name)
+                            self._count("jobs_dropped")
+                            if item.on_drop is not None:
+                                item.on_drop()
+                            continue
+                        
+                        logger.debug("Running task on %s", self.name)
                         if item.args and len(item.args) > 0:
                             item.item(*item.args)
                         else:
                             item.item()
                         item.finished = time.time()
+                        self._count("jobs_run", item)
                         logger.debug("Ran task on %s", self.name)
                     finally:
-                        if item in self.queued_jobs: 
-                            self.queued_jobs.remove(item)
+                        self.queued_jobs.pop(id(item), None)
             except Exception as a:
+                self._count("jobs_failed")
                 try:
                     logger.debug("Error on worker", exc_info = a)
-                    logger.debug("Caused by job")
-                    logger.debug("%s\n", item.stack)
+                    logger.debug("Caused by job %s", item.name)
+                    if item.stack is not None:
+                        logger.debug("%s\n", "".join(traceback.format_list(item.stack)))
                 except Exception as e:
                     logger.debug("Could not log error on worker", exc_info = e)
                     pass
-            self.work_queue.task_done()
+            finally:
+                self.work_queue.task_done()
             
         if logger:
             try:
                 logger.info("Exited queue %s", self.name)
             except Exception as e:
                 pass
- 
+            
+    def _count(self, counter, item = None):
+        """
+        Increment one of the job counters and, for a job that ran, add its timings to
+        the histograms. Workers may finish jobs at the same time, so this is done under 
+        the queue lock
+        
+        Keyword arguments:
+        counter           -- name of counter attribute
+        item              -- job that ran or None
+        """
+        self.all_jobs_lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+            if item is not None:
+                self.wait_times.add(item.started - item.queued)
+                self.run_times.add(item.finished - item.started)
+        finally:
+            self.all_jobs_lock.release()
@@ -49,6 +49,13 @@ static pa_sample_spec sample_spec = {
 
 static pa_stream_flags_t flags = 0;
 
+/* FFT buffers and plan, created on first use and reused for every snapshot */
+static double *fft_in = NULL;
+static fftw_complex *fft_out = NULL;
+static fftw_plan fft_plan;
+
+static double magnitude[ CHUNK / 4 ];
+
 static pa_channel_map channel_map;
 static int channel_map_set = 0;
 
@@ -170,10 +177,34 @@ static void context_state_callback( pa_context *c, void *userdata ) {
 	}
 }
 
+static void create_fft_plan( void ) {
+	if ( fft_in )
+		return;
+
+	fft_in = (double*) fftw_malloc( sizeof( double ) * ( CHUNK / 2 ) );
+	fft_out = (fftw_complex*) fftw_malloc( sizeof( fftw_complex ) * ( CHUNK / 4 + 1 ) );
+
+	/* Planning overwrites the buffers, so it must happen before they are filled */
+	fft_plan = fftw_plan_dft_r2c_1d( CHUNK / 2, fft_in, fft_out, FFTW_MEASURE );
+}
+
+static void destroy_fft_plan( void ) {
+	if ( !fft_in )
+		return;
+
+	fftw_destroy_plan( fft_plan );
+	fftw_free( fft_in );
+	fftw_free( fft_out );
+	fft_in = NULL;
+	fft_out = NULL;
+}
+
 void im_stop (void) {
 
 	pa_threaded_mainloop_stop( mainloop );
 
+	destroy_fft_plan( );
+
 	//printf( "exit\n" );
 }
 
@@ -187,9 +218,11 @@ void im_setSourceIndex( uint32_t index ) {
 		init_source_stream_for_recording();
 }
 
-double *im_getSnapshot( int fft ) {
+int im_getSnapshotSize( void ) {
+	return CHUNK / 4;
+}
 
-	static double magnitude[ CHUNK / 4 ];
+double *im_getSnapshot( int fft ) {
 
 	if ( ! fft ) {
 		int i;
@@ -201,41 +234,52 @@ double *im_getSnapshot( int fft ) {
 		}
 	} else {
 
-		double *in;
-		fftw_complex *out;
-		fftw_plan p;
+		create_fft_plan( );
 
-		in = (double*) malloc( sizeof( double ) * ( CHUNK / 2 ) );
-		out = (fftw_complex*) fftw_malloc( sizeof( fftw_complex ) * ( CHUNK / 2 ) );
-
-		if ( snapshot != NULL ) {
-			int i;
-			for ( i = 0; i < CHUNK / 2; i++ ) {
-				in[ i ] = (double) snapshot[ i ];
-			}
+		int i;
+		for ( i = 0; i < CHUNK / 2; i++ ) {
+			fft_in[ i ] = (double) snapshot[ i ];
 		}
 
-		p = fftw_plan_dft_r2c_1d( CHUNK / 2, in, out, 0 );
-
-		fftw_execute( p );
-
-		fftw_destroy_plan( p );
+		fftw_execute( fft_plan );
 
-		if ( out != NULL ) {
-			int i;
-			for ( i = 0; i < CHUNK / 2 / sample_spec.channels; i++ ) {
-				magnitude[ i ] = (double) sqrt( pow( out[ i ][ 0 ], 2 ) + pow( out[ i ][ 1 ], 2 ) ) / (double) fft_max[ i ];
-				if ( magnitude[ i ] > 1.0 ) magnitude[ i ] = 1.0;
-			}
+		for ( i = 0; i < CHUNK / 2 / sample_spec.channels; i++ ) {
+			magnitude[ i ] = (double) sqrt( fft_out[ i ][ 0 ] * fft_out[ i ][ 0 ] + fft_out[ i ][ 1 ] * fft_out[ i ][ 1 ] ) / (double) fft_max[ i ];
+			if ( magnitude[ i ] > 1.0 ) magnitude[ i ] = 1.0;
 		}
-
-		free( in );
-		fftw_free(out);
 	}
 
 	return magnitude; // PyString_FromStringAndSize( (char *) snapshot, CHUNK );
 }
 
+void im_getBands( int fft, double *bands, int n_bands ) {
+
+	double *m = im_getSnapshot( fft );
+	int size = im_getSnapshotSize( );
+	int i, j, start = 0, end;
+
+	for ( i = 0; i < n_bands; i++ ) {
+		/* Frequency bins are grouped logarithmically, so the low frequencies
+		 * get bands of their own. Waveform samples are grouped evenly */
+		if ( fft )
+			end = (int) ( pow( (double) size, (double) ( i + 1 ) / n_bands ) + 0.5 );
+		else
+			end = ( i + 1 ) * size / n_bands;
+		if ( end <= start )
+			end = start + 1;
+		if ( end > size || i == n_bands - 1 )
+			end = size;
+
+		bands[ i ] = 0;
+		for ( j = start; j < end; j++ ) {
+			if ( m[ j ] > bands[ i ] )
+				bands[ i ] = m[ j ];
+		}
+		if ( end > start )
+			start = end;
+	}
+}
+
 
 void im_start ( void ) {
 
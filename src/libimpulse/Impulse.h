@@ -23,8 +23,12 @@
 #define IM_NOFFT 0
 #define IM_FFT 1
 
+int im_getSnapshotSize( void );
+
 double *im_getSnapshot( int fft );
 
+void im_getBands( int fft, double *bands, int n_bands );
+
 void im_setSourceIndex( uint32_t index );
 
 void im_start( void );
@@ -26,25 +26,69 @@
 #include <stdio.h>
 #include <stdlib.h>
 
+/* array.array, used to create the snapshot when no output buffer is supplied */
+static PyObject *array_type = NULL;
+
+static void fill_snapshot( double *dest, int fft, int bands, double gain ) {
+	int i, size;
+
+	if ( bands > 0 ) {
+		size = bands;
+		im_getBands( fft, dest, bands );
+	} else {
+		size = im_getSnapshotSize( );
+		memcpy( dest, im_getSnapshot( fft ), sizeof( double ) * size );
+	}
+
+	if ( gain != 1.0 ) {
+		for ( i = 0; i < size; i++ )
+			dest[ i ] *= gain;
+	}
+}
+
 static PyObject * impulse_getSnapshot( PyObject *self, PyObject *args, PyObject *kwargs ) {
-	PyObject *magnitude;
+	PyObject *out = NULL, *data, *magnitude;
+	void *buffer;
+	Py_ssize_t length;
 
 	int fft = 0;
+	int bands = 0;
+	double gain = 1.0;
 
-	static char *kwlist[] = { "fft", NULL };
+	static char *kwlist[] = { "fft", "bands", "gain", "out", NULL };
 
-	if ( !PyArg_ParseTupleAndKeywords( args, kwargs, "b", kwlist, &fft ) )
+	if ( !PyArg_ParseTupleAndKeywords( args, kwargs, "i|idO", kwlist, &fft, &bands, &gain, &out ) )
 		return NULL;
 
-	magnitude = PyTuple_New( 256 );
-
-	double *m = im_getSnapshot( fft );
-
-	int i;
-	for ( i = 0; i < 256; i++ )
-		PyTuple_SetItem( magnitude, i, PyFloat_FromDouble( m[ i ] ) );
+	if ( bands < 0 ) {
+		PyErr_SetString( PyExc_ValueError, "bands must not be negative" );
+		return NULL;
+	}
+
+	length = sizeof( double ) * ( bands > 0 ? bands : im_getSnapshotSize( ) );
+
+	if ( out != NULL && out != Py_None ) {
+		/* Fill the caller's buffer (e.g. an array.array('d')) in place */
+		Py_ssize_t out_length;
+		if ( PyObject_AsWriteBuffer( out, &buffer, &out_length ) < 0 )
+			return NULL;
+		if ( out_length < length ) {
+			PyErr_SetString( PyExc_ValueError, "out is too small for the snapshot" );
+			return NULL;
+		}
+		fill_snapshot( (double *) buffer, fft, bands, gain );
+		Py_INCREF( out );
+		return out;
+	}
+
+	data = PyString_FromStringAndSize( NULL, length );
+	if ( data == NULL )
+		return NULL;
+	fill_snapshot( (double *) PyString_AS_STRING( data ), fft, bands, gain );
+	magnitude = PyObject_CallFunction( array_type, "sO", "d", data );
+	Py_DECREF( data );
 
-	return magnitude; // PyString_FromStringAndSize( (char *) snapshot, CHUNK );
+	return magnitude;
 }
 
 static PyObject* impulse_setSourceIndex( PyObject* self, PyObject* args, PyObject* kwargs ) {
@@ -63,18 +107,26 @@ static PyObject* impulse_setSourceIndex( PyObject* self, PyObject* args, PyObjec
 static PyObject *ImpulseError;
 
 static PyMethodDef ImpulseMethods[ ] = {
-	{ "getSnapshot",  (PyCFunction)impulse_getSnapshot, METH_VARARGS | METH_KEYWORDS, "Returns the current audio snapshot from Pulseaudio." },
+	{ "getSnapshot",  (PyCFunction)impulse_getSnapshot, METH_VARARGS | METH_KEYWORDS, "Returns the current audio snapshot from Pulseaudio as an array of doubles, optionally grouped into bands, scaled by gain and written to the supplied out buffer." },
 	{ "setSourceIndex",  (PyCFunction)impulse_setSourceIndex, METH_VARARGS | METH_KEYWORDS, "Changes the Pulseaudio source by it's index." },
 	{ NULL }		/* Sentinel */
 };
 
 PyMODINIT_FUNC initimpulse ( void ) {
-	PyObject *m;
+	PyObject *m, *array_module;
 
 	m = Py_InitModule( "impulse", ImpulseMethods );
 	if (m == NULL)
 		return;
 
+	array_module = PyImport_ImportModule( "array" );
+	if ( array_module == NULL )
+		return;
+	array_type = PyObject_GetAttrString( array_module, "array" );
+	Py_DECREF( array_module );
+	if ( array_type == NULL )
+		return;
+
 	ImpulseError = PyErr_NewException( "impulse.error", NULL, NULL );
 	Py_INCREF( ImpulseError );
 	PyModule_AddObject( m, "error", ImpulseError );
@@ -302,6 +302,32 @@ class G15DBUSDebugService(dbus.service.Object):
             for filename, lineno, name, line in traceback.extract_stack(stack):
                 print '    File: "%s", line %d, in %s' % (filename, lineno, name)
         
+    @dbus.service.method(DEBUG_IF_NAME, out_signature='a{sa{st}}')
+    def FrameStatistics(self):
+        stats = {}
+        for scr in self._service.screens:
+            if scr.driver is not None:
+                stats[scr.device.uid] = scr.driver.get_frame_statistics()
+        return stats
+        
+    @dbus.service.method(DEBUG_IF_NAME, out_signature='a{sa{st}}')
+    def RedrawStatistics(self):
+        stats = {}
+        for scr in self._service.screens:
+            stats[scr.device.uid] = scr.get_redraw_statistics()
+        return stats
+        
+    @dbus.service.method(DEBUG_IF_NAME, out_signature='a{sa{st}}')
+    def ProfileSwitchStatistics(self):
+        stats = {}
+        for scr in self._service.screens:
+            stats[scr.device.uid] = scr.get_profile_switch_statistics()
+        return stats
+        
+    @dbus.service.method(DEBUG_IF_NAME, out_signature='a{sa{st}}')
+    def JobStatistics(self):
+        return g15scheduler.get_statistics()
+        
     @dbus.service.method(DEBUG_IF_NAME)
     def ShowGraph(self):
         objgraph.show_refs(self._service)
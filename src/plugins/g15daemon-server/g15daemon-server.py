@@ -15,11 +15,8 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
  
 from threading import Thread
-from PIL import Image
-from PIL import ImageMath
-from PIL import ImageOps
+from threading import Lock
 import array
-import asyncore
 import cairo
 import gnome15.g15driver as g15driver
 import gnome15.g15locale as g15locale
@@ -28,11 +25,15 @@ import gnome15.g15theme as g15theme
 import gnome15.util.g15convert as g15convert
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15gconf as g15gconf
-import gnome15.util.g15cairo as g15cairo
+import gnome15.util.g15scheduler as g15scheduler
+import gnome15.util.g15pixels as g15pixels
 import gobject
 import gtk
+import errno
+import fcntl
 import logging
 import os
+import select
 import socket
 import struct
 import sys
@@ -67,6 +68,17 @@ CLIENT_CMD_KB_BACKLIGHT=0x8
 CLIENT_CMD_CONTRAST=0x40
 CLIENT_CMD_MKEY_LIGHTS=0x20
 
+# LCD size of a G15, as assumed by all g15daemon clients
+G15DAEMON_WIDTH=160
+G15DAEMON_HEIGHT=43
+
+# Length of a frame for each buffer type a client may ask for. G is one byte per pixel,
+# R is packed one bit per pixel (as libg15), W is a WBMP image (as libg15 plus a header)
+BUFFER_LENGTHS = { "G" : 6880, "R" : 1048, "W" : 865 }
+
+# Queue frames are converted and drawn on
+DRAW_QUEUE="g15daemonDrawQueue"
+
 
 KEY_MAP = {
         g15driver.G_KEY_G1  : 1<<0,
@@ -124,13 +136,27 @@ def show_preferences(parent, driver, gconf_client, gconf_key):
     dialog.run()
     dialog.hide()
 
-class G15DaemonClient(asyncore.dispatcher):
-    def __init__(self, conn, plugin):
-        asyncore.dispatcher.__init__(self, sock=conn)
+class G15DaemonClient():
+    def __init__(self, conn, plugin, server):
+        self.socket = conn
+        self.socket.setblocking(False)
+        self.server = server
         self.out_buffer  = ""
-        self.img_buffer = None
+        self.oob_buffer = ""
+        self.output_lock = Lock()
         self.buffer_type = None
         self.buffer_len = 0
+        self.handshake_buffer = ""
+        self.frame_buffer = None
+        self.frame_view = None
+        self.received = 0
+        self.frame_lock = Lock()
+        self.pending_frame = None
+        self.draw_scheduled = False
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.closed = False
+        self.close_lock = Lock()
         self.surface = None
         self.last_img_buffer = None
         self.enable_keys = False
@@ -148,13 +174,39 @@ class G15DaemonClient(asyncore.dispatcher):
         self.backlight_acquire = None
         self.keyboard_backlight_acquire = None
         
-        self.out_buffer += "G15 daemon HELLO"
-        self.oob_buffer = ""
+        self.queue_output("G15 daemon HELLO")
+        
+    def fileno(self):
+        return self.socket.fileno()
         
     def handle_close(self):
+        # May be called by both the server thread and the plugin deactivating
+        self.close_lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+        finally:
+            self.close_lock.release()
+        logger.debug("Closing g15daemon client, %d frames received, %d dropped", self.frames_received, self.frames_dropped)
         self.plugin.screen.del_page(self.page)
         self.plugin.leave(self)
-        self.close()
+        self.server.remove_client(self)
+        self.socket.close()
+        
+    def queue_output(self, data, oob = False):
+        """
+        Queue data to be sent to the client, when the socket is next writable
+        """
+        self.output_lock.acquire()
+        try:
+            if oob:
+                self.oob_buffer += data
+            else:
+                self.out_buffer += data
+        finally:
+            self.output_lock.release()
+        self.server.wakeup()
         
     def handle_expt(self):
         data = self.socket.recv(1, socket.MSG_OOB)
@@ -165,9 +217,9 @@ class G15DaemonClient(asyncore.dispatcher):
         elif val == CLIENT_CMD_NEVER_SELECT: 
             self.plugin.screen.set_priority(self, self.page, g15screen.PRI_LOW)
         elif val == CLIENT_CMD_IS_FOREGROUND:
-            self.oob_buffer += "1" if self.plugin.screen.get_visible_page() == self.page else "0"
+            self.queue_output("1" if self.plugin.screen.get_visible_page() == self.page else "0", oob = True)
         elif val == CLIENT_CMD_IS_USER_SELECTED:
-            self.oob_buffer += "1" if self.plugin.screen.get_visible_page() == self.page and self.page.priority == g15screen.PRI_NORMAL else "0"
+            self.queue_output("1" if self.plugin.screen.get_visible_page() == self.page and self.page.priority == g15screen.PRI_NORMAL else "0", oob = True)
         elif val & CLIENT_CMD_MKEY_LIGHTS > 0:
             self.screen.driver.set_value(val - CLIENT_CMD_MKEY_LIGHTS)
         elif val & CLIENT_CMD_KEY_HANDLER > 0:
@@ -218,52 +270,54 @@ class G15DaemonClient(asyncore.dispatcher):
 
     def handle_read(self):
         if not self.handshake:
-            buf_type = self.recv(4)
-            
-            self.buffer_type = buf_type[0]
-            self.handshake = True
-            self.img_buffer = ""
+            recv = self.socket.recv(4 - len(self.handshake_buffer))
+            if not recv:
+                self.handle_close()
+                return
+            self.handshake_buffer += recv
+            if len(self.handshake_buffer) < 4:
+                return
             
-            if self.buffer_type == "G":
-                self.buffer_len = 6880
-            elif self.buffer_type == "R":
-                self.buffer_len = 1048
-# TODO
-#            elif self.buffer_type == "W":
-#                self.buffer_len = 865
-            else:
+            self.buffer_type = self.handshake_buffer[0]
+            if not self.buffer_type in BUFFER_LENGTHS:
                 logger.warning("WARNING: Unsupported buffer type. Closing")
                 self.handle_close()
                 return
+            
+            # The frame is always received into the same buffer
+            self.handshake = True
+            self.buffer_len = BUFFER_LENGTHS[self.buffer_type]
+            self.frame_buffer = bytearray(self.buffer_len)
+            self.frame_view = memoryview(self.frame_buffer)
+            self.received = 0
         else:        
-            recv = self.recv(self.buffer_len - len(self.img_buffer))
-            self.img_buffer += recv
-            if len(self.img_buffer) == self.buffer_len:
-                if self.buffer_type == "G":
-                    self.img_buffer = self.convert_gbuf(self.img_buffer)
-                self.draw_buffer(self.img_buffer)
-                self.last_img_buffer = self.img_buffer
-                self.img_buffer = ""
-
-            elif len(self.img_buffer) > self.buffer_len:
-                logger.warning("Received bad frame (%d bytes), should be %d",
-                               len(self.img_buffer),
-                               self.buffer_len)
+            recv = self.socket.recv_into(self.frame_view[self.received:], self.buffer_len - self.received)
+            if recv == 0:
+                self.handle_close()
+                return
+            self.received += recv
+            if self.received == self.buffer_len:
+                self.received = 0
+                self._frame_received(str(self.frame_buffer))
                 
     def draw_buffer(self, img_buffer):
-                
-        pil_img = Image.fromstring("1", (160,43), img_buffer)
-        mask_img = pil_img.copy()                           
-        mask_img = mask_img.convert("L")
-        pil_img = pil_img.convert("P")
-        if self.plugin.palette is not None:
-            pil_img.putpalette(self.plugin.palette)                              
-            pil_img = pil_img.convert("RGBA")                        
-            pil_img.putalpha(mask_img)                    
-
-        # TODO find a quicker way of converting
-        pixbuf = g15cairo.image_to_pixbuf(pil_img, "png")
-        self.surface = g15cairo.pixbuf_to_surface(pixbuf)
+        """
+        Convert a complete frame, as received from the client, straight to an ARGB32 
+        surface in the configured colours and redraw the page
+        """
+        if self.plugin.foreground is None:
+            foreground = ( 255, 255, 255, 255 )
+            background = ( 0, 0, 0, 255 )
+        else:
+            foreground = self.plugin.foreground + ( 255, )
+            background = ( 0, 0, 0, 0 )
+        if self.buffer_type == "W":
+            img_buffer = self._get_wbmp_data(img_buffer)
+        data = g15pixels.mono_to_argb32(img_buffer, G15DAEMON_WIDTH, G15DAEMON_HEIGHT,
+                                        packed = self.buffer_type != "G",
+                                        foreground = foreground, background = background)
+        self.surface = cairo.ImageSurface.create_for_data(array.array('B', data), cairo.FORMAT_ARGB32,
+                                                          G15DAEMON_WIDTH, G15DAEMON_HEIGHT, G15DAEMON_WIDTH * 4)
         self.plugin.screen.redraw(self.page)
                 
     def dump_buf(self, buf):
@@ -277,58 +331,85 @@ class G15DaemonClient(asyncore.dispatcher):
                     l += "*"
             logger.info(l)
             
-    def convert_gbuf(self, g_buffer):
-        r_buffer = array.array('c', chr(0)*1048)
-        new_buf = ""
-        for x in range(160):
-            for y in range(43):
-                pixel_offset = y * 160 + x
-                byte_offset = pixel_offset / 8
-                bit_offset = 7 - (pixel_offset % 8)    
-                val = ord(g_buffer[x + ( y * 160)])
-                if val:
-                    r_buffer[byte_offset] = chr(ord(r_buffer[byte_offset]) | 1 << bit_offset)
-                else:
-                    r_buffer[byte_offset] = chr(ord(r_buffer[byte_offset])  &  ~(1 << bit_offset))
-        return r_buffer.tostring()
-         
-    def convert_rbuf(self, buffer):
-        new_buf = ""
-        for x in range(160):
-            for y in range(43):
-                pixel_offset = y * 143 + x
-                byte_offset = pixel_offset / 8
-                bit_offset = 7 - (pixel_offset % 8)                
-                ch = ord(buffer[byte_offset])
-                new_buf += chr( ( ch >> bit_offset ) & 0xfe )
-                
-        return new_buf
-             
-    def writable(self):
-        return len(self.out_buffer) > 0
+    def wants_write(self):
+        return len(self.out_buffer) > 0 or len(self.oob_buffer) > 0
 
     def handle_write(self):
-        if len(self.out_buffer) > 0:
-            sent = self.send(self.out_buffer)
-            self.out_buffer = self.out_buffer[sent:]
-            
-        if len(self.oob_buffer) > 0:
-            sent = self.socket.send(self.oob_buffer, socket.MSG_OOB)
-            self.oob_buffer = self.oob_buffer[sent:]
+        self.output_lock.acquire()
+        try:
+            if len(self.out_buffer) > 0:
+                sent = self._send(self.out_buffer)
+                self.out_buffer = self.out_buffer[sent:]
+                
+            if len(self.oob_buffer) > 0:
+                sent = self._send(self.oob_buffer, socket.MSG_OOB)
+                self.oob_buffer = self.oob_buffer[sent:]
+        finally:
+            self.output_lock.release()
             
     def handle_key(self, keys, state):
         val = 0
         for key in keys:
             if key in KEY_MAP:
                 val += KEY_MAP[key]                
-                self.out_buffer += struct.pack("<L",val)                            
-                self.out_buffer += struct.pack("<L",0)
+                self.queue_output(struct.pack("<L",val) + struct.pack("<L",0))
             else:
                 logger.warning("Unmapped G19 -> G15 key")
                 
     """
     Private
     """
+    
+    def _send(self, data, flags = 0):
+        try:
+            return self.socket.send(data, flags)
+        except socket.error as e:
+            if e.errno in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+                return 0
+            raise
+        
+    def _frame_received(self, frame):
+        """
+        Hand a complete frame over to be drawn. If the previous frame has not been
+        drawn yet (i.e. the client is sending faster than the LCD is updated), it is
+        dropped in favour of this one
+        """
+        self.frames_received += 1
+        self.frame_lock.acquire()
+        try:
+            if self.pending_frame is not None:
+                self.frames_dropped += 1
+            self.pending_frame = frame
+            schedule = not self.draw_scheduled
+            self.draw_scheduled = True
+        finally:
+            self.frame_lock.release()
+        if schedule:
+            g15scheduler.execute(DRAW_QUEUE, "G15DaemonFrame", self._draw_pending_frame)
+            
+    def _draw_pending_frame(self):
+        self.frame_lock.acquire()
+        try:
+            frame = self.pending_frame
+            self.pending_frame = None
+            self.draw_scheduled = False
+        finally:
+            self.frame_lock.release()
+        if frame is not None and not self.closed:
+            self.draw_buffer(frame)
+            self.last_img_buffer = frame
+            
+    def _get_wbmp_data(self, wbmp):
+        """
+        Skip over the header of a WBMP image (type, fixed header, then width and height 
+        as multi-byte integers), returning the packed pixels
+        """
+        offset = 2
+        for i in range(2):
+            while ord(wbmp[offset]) & 0x80:
+                offset += 1
+            offset += 1
+        return wbmp[offset:]
                 
     def _on_hidden(self):
         if self.keyboard_backlight_acquire:
@@ -361,18 +442,6 @@ class G15DaemonClient(asyncore.dispatcher):
             canvas.set_source_surface(self.surface)
             canvas.paint()
         
-class G15Async(Thread):
-    def __init__(self):
-        Thread.__init__(self)
-        self.name = "G15Async"
-        self.setDaemon(True)
-        
-    def run(self):  
-        try :      
-            asyncore.loop(timeout=0.05)
-        except Exception as e:
-            logger.warning("Failed to connect to G15Daemon client", exc_info = e)
-
 class G15DaemonServer():
     
     def __init__(self, gconf_key, gconf_client, screen):
@@ -388,8 +457,7 @@ class G15DaemonServer():
         self.load_configuration()                
         self.notify_handle = self.gconf_client.notify_add(self.gconf_key, self._config_changed);
         self.daemon = G15Daemon(self._get_port(), self)
-        self.async = G15Async()
-        self.async.start()
+        self.daemon.start()
     
     def deactivate(self):
         self._stop_all_clients()
@@ -421,15 +489,14 @@ class G15DaemonServer():
                 self._stop_all_clients()
                 self.daemon.close()
             self.daemon = G15Daemon(port, self)
-            self.async = G15Async()
-            self.async.start()
+            self.daemon.start()
         else:
             for c in self.clients:
                 if c.last_img_buffer is not None:
                     c.draw_buffer(c.last_img_buffer)
             
     def _stop_all_clients(self):
-        for c in self.clients:
+        for c in list(self.clients):
             c.handle_close()
         
     def load_configuration(self):
@@ -437,19 +504,13 @@ class G15DaemonServer():
         
         if g15gconf.get_bool_or_default(self.gconf_client, "%s/use_custom_foreground" % self.gconf_key, False):
             col = g15gconf.get_rgb_or_default(self.gconf_client, "%s/custom_foreground" % self.gconf_key, (255,255,255))
-            self.palette = [0 for n in range(768)]
-            self.palette[765] = col[0]
-            self.palette[766] = col[1]
-            self.palette[767] = col[2]
+            self.foreground = tuple(col[:3])
         else: 
             foreground_control = self.screen.driver.get_control("foreground")
             if foreground_control is None:
-                self.palette = None
+                self.foreground = None
             else:        
-                self.palette = [0 for n in range(768)]
-                self.palette[765] = foreground_control.value[0]
-                self.palette[766] = foreground_control.value[1]
-                self.palette[767] = foreground_control.value[2]
+                self.foreground = tuple(foreground_control.value[:3])
         
         backlight_control = self.screen.driver.get_control_for_hint(g15driver.HINT_DIMMABLE)
         self.default_backlight = backlight_control.value if backlight_control is not None else None 
@@ -472,22 +533,180 @@ class G15DaemonServer():
                     client.handle_key(keys, state)
                     return True
     
-class G15Daemon(asyncore.dispatcher):
+class Poller():
+    """
+    Wraps epoll, or poll where epoll is not available
+    """
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self._poll = select.epoll()
+            self._timeout_scale = 1.0
+            self.READ, self.PRIORITY, self.WRITE = select.EPOLLIN, select.EPOLLPRI, select.EPOLLOUT
+            self.ERROR = select.EPOLLERR | select.EPOLLHUP
+        else:
+            self._poll = select.poll()
+            self._timeout_scale = 1000.0
+            self.READ, self.PRIORITY, self.WRITE = select.POLLIN, select.POLLPRI, select.POLLOUT
+            self.ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            
+    def register(self, fd, mask):
+        self._poll.register(fd, mask)
+        
+    def modify(self, fd, mask):
+        self._poll.modify(fd, mask)
+        
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+        
+    def poll(self, timeout):
+        try:
+            return self._poll.poll(timeout * self._timeout_scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        
+    def close(self):
+        if hasattr(self._poll, "close"):
+            self._poll.close()
+
+class G15Daemon(Thread):
+    """
+    Accepts g15daemon clients and services all of their sockets from a single thread
+    """
+    
     def __init__(self, port, plugin):
-        asyncore.dispatcher.__init__(self)        
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
+        Thread.__init__(self)
+        self.name = "G15Daemon"
+        self.setDaemon(True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         logger.info('Binding to port %d', port)
-        self.bind(("127.0.0.1", port))
+        self.socket.bind(("127.0.0.1", port))
         logger.info('Bound to port %d', port)
-        self.listen(5)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
         self.plugin = plugin
         self.port = port
- 
-    def handle_accept(self):
-        sock, addr = self.accept()
-        logger.debug('Got client')
-        client = G15DaemonClient(sock, self.plugin)
+        self.stopping = False
+        self.clients = {}
+        self.interest = {}
+        self.clients_lock = Lock()
+        
+        # Other threads write to this pipe to wake the loop up
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in ( self.wake_read, self.wake_write ):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        
+        self.poller = Poller()
+        self.poller.register(self.socket.fileno(), self.poller.READ)
+        self.poller.register(self.wake_read, self.poller.READ)
+        
+    def wakeup(self):
+        try:
+            os.write(self.wake_write, "x")
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            
+    def close(self):
+        self.stopping = True
+        self.wakeup()
         
-    def handle_sig_term(self, arg0, arg1):
-        self.close()
\ No newline at end of file
+    def remove_client(self, client):
+        self.clients_lock.acquire()
+        try:
+            fd = client.fileno()
+            if fd in self.clients:
+                del self.clients[fd]
+                del self.interest[fd]
+                self.poller.unregister(fd)
+        finally:
+            self.clients_lock.release()
+            
+    def run(self):
+        try:
+            while not self.stopping:
+                for fd, event in self.poller.poll(1.0):
+                    if fd == self.socket.fileno():
+                        self._accept()
+                    elif fd == self.wake_read:
+                        self._drain_wakeups()
+                    else:
+                        client = self.clients.get(fd)
+                        if client is not None:
+                            self._handle_event(client, event)
+        except Exception as e:
+            logger.warning("G15Daemon server failed", exc_info = e)
+        finally:
+            self.poller.close()
+            self.socket.close()
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+        logger.info("Stopped G15Daemon server on port %d", self.port)
+            
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.socket.accept()
+            except socket.error as e:
+                if e.errno in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+                    return
+                raise
+            logger.debug('Got client')
+            client = G15DaemonClient(sock, self.plugin, self)
+            self.clients_lock.acquire()
+            try:
+                fd = client.fileno()
+                self.clients[fd] = client
+                self.interest[fd] = self._get_interest(client)
+                self.poller.register(fd, self.interest[fd])
+            finally:
+                self.clients_lock.release()
+        
+    def _drain_wakeups(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.clients_lock.acquire()
+        try:
+            for client in self.clients.values():
+                self._update_interest(client)
+        finally:
+            self.clients_lock.release()
+            
+    def _handle_event(self, client, event):
+        try:
+            if event & self.poller.PRIORITY:
+                client.handle_expt()
+            if event & self.poller.READ:
+                client.handle_read()
+            elif event & self.poller.ERROR:
+                client.handle_close()
+            if not client.closed and event & self.poller.WRITE:
+                client.handle_write()
+            if not client.closed:
+                self.clients_lock.acquire()
+                try:
+                    self._update_interest(client)
+                finally:
+                    self.clients_lock.release()
+        except Exception as e:
+            logger.warning("Error servicing g15daemon client, closing", exc_info = e)
+            client.handle_close()
+            
+    def _get_interest(self, client):
+        mask = self.poller.READ | self.poller.PRIORITY
+        if client.wants_write():
+            mask |= self.poller.WRITE
+        return mask
+    
+    def _update_interest(self, client):
+        fd = client.fileno()
+        mask = self._get_interest(client)
+        if fd in self.interest and self.interest[fd] != mask:
+            self.interest[fd] = mask
+            self.poller.modify(fd, mask)
@@ -21,10 +21,12 @@ import gnome15.util.g15gconf as g15gconf
 import gnome15.util.g15os as g15os
 import gnome15.g15driver as g15driver
 import gnome15.g15theme as g15theme
+import impulserender
 import gobject
 import gtk
 import os
 import sys
+import array
 import datetime
 
 # Logging
@@ -114,14 +116,15 @@ class G15ImpulsePainter(g15screen.Painter):
         self.mode = "default"
         self.plugin = plugin
         self.last_sound = datetime.datetime.now()
+        self._sample = None
         
     def do_lights(self, audio_sample_array = None):     
         if not audio_sample_array:
             audio_sample_array = self._get_sample()
         
         if self.backlight_acquisition is not None:
-            self.backlight_acquisition.set_value(self._col_avg(audio_sample_array))
-        tot_avg = self._tot_avg(audio_sample_array)
+            self.backlight_acquisition.set_value(impulserender.get_colour_average(audio_sample_array))
+        tot_avg = impulserender.get_total_average(audio_sample_array)
         if self.mkey_acquisition is not None:
             self._set_mkey_lights(tot_avg)
         return tot_avg
@@ -150,36 +153,17 @@ class G15ImpulsePainter(g15screen.Painter):
         if hasattr( self.theme_module, "fft" ) and self.theme_module.fft:
             fft = True
 
-        audio_sample_array = impulse.getSnapshot( fft )
-        if self.plugin.gain != 1:
-            arr = []
-            for a in audio_sample_array:
-                arr.append(a * self.plugin.gain)
-            audio_sample_array = arr
-        
-        return audio_sample_array
-    
-    def _col_avg(self, list):
-        cols = []
-        each = len(list) / 3
-        z = 0
-        for j in range(0, 3):
-            t = 0
-            for x in range(0, each):
-                t += min(255, list[z] * 340)
-                z += 1
-            cols.append(int(t / each))
-        return ( cols[0], cols[1], cols[2] )
+        # Themes may ask for the spectrum to be grouped into a number of bands
+        bands = getattr( self.theme_module, "bands", 0 )
+        if callable(bands):
+            bands = bands( self.plugin )
+        size = bands if bands > 0 else 256
+            
+        # The same array is filled in place for every frame
+        if self._sample is None or len(self._sample) != size:
+            self._sample = array.array('d', [ 0.0 ]) * size
+        return impulse.getSnapshot( fft, bands = bands, gain = self.plugin.gain, out = self._sample )
     
-    def _tot_avg(self, list):
-        sz = len(list)
-        z = 0
-        t = 0
-        for x in range(0, sz):
-            t += min(255, list[z] * 340)
-            z += 1
-        return t / sz
-                  
     def _set_mkey_lights(self, val):
         if val > 200:
             self.mkey_acquisition.set_value(g15driver.MKEY_LIGHT_MR | g15driver.MKEY_LIGHT_1 | g15driver.MKEY_LIGHT_2 | g15driver.MKEY_LIGHT_3)        
@@ -264,26 +248,6 @@ class G15Impulse():
     def destroy(self):
         pass
     
-    def paint(self, canvas):
-        if not self.theme_module: 
-            return
-
-        fft = False
-        if hasattr( self.theme_module, "fft" ) and self.theme_module.fft:
-            fft = True
-
-        audio_sample_array = impulse.getSnapshot( fft )
-        
-        if self.backlight_acquisition is not None:
-            self.backlight_acquisition.set_value(self._col_avg(audio_sample_array))
-        
-        if self.mkey_acquisition is not None:
-            self._set_mkey_lights(self._tot_avg(audio_sample_array))
-        
-        canvas.save()
-        self.theme_module.on_draw( audio_sample_array, canvas, self )
-        canvas.restore()
-    
     def redraw(self):        
         if self.screen.driver.get_bpp() == 0:
             self.painter.do_lights()
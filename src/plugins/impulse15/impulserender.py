@@ -0,0 +1,253 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ 
+
+'''
+Helpers for the Impulse themes that work on all of the bars of a frame at
+once. The bar levels, peaks and light show averages are calculated as whole
+arrays using NumPy when it is available (falling back to plain Python lists
+otherwise), leaving the themes to build one cairo path per colour.
+
+Run this module directly to benchmark the frame time of each theme.
+'''
+
+import math
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError as e:
+    logger.debug("NumPy not available, using fallback theme calculations", exc_info = e)
+    numpy = None
+
+'''
+Peaks fall a little faster on each frame they are not pushed up
+'''
+PEAK_DECAY = 0.1
+
+def as_array(samples):
+    """
+    Get the samples as a NumPy array of doubles, without copying them if 
+    they are already in a buffer of doubles (such as array.array('d')). If
+    NumPy is not available a list is returned.
+    
+    Keyword arguments:
+    samples        -- sequence of levels
+    """
+    if numpy is None:
+        return list(samples)
+    if isinstance(samples, numpy.ndarray):
+        return samples
+    try:
+        return numpy.frombuffer(samples, dtype = numpy.float64)
+    except (TypeError, ValueError, AttributeError):
+        return numpy.array(samples, dtype = numpy.float64)
+    
+def as_list(values):
+    """
+    Get values as a list of Python numbers, for passing to cairo
+    
+    Keyword arguments:
+    values        -- array or list
+    """
+    return values.tolist() if numpy is not None and isinstance(values, numpy.ndarray) else values
+
+def get_bars(samples, bars):
+    """
+    Get the level of each bar, taking every len(samples) / bars sample as
+    the themes always have.
+    
+    Keyword arguments:
+    samples        -- sequence of levels
+    bars           -- number of bars wanted
+    """
+    return as_array(samples)[::max(1, len(samples) // max(1, bars))]
+
+def scale(values, factor, offset = 0, integer = False):
+    """
+    Get ( value * factor ) + offset for all values, optionally truncated to 
+    integers.
+    
+    Keyword arguments:
+    values        -- array or list of levels
+    factor        -- multiplier
+    offset        -- amount to add after multiplying
+    integer       -- truncate to integers
+    """
+    if numpy is not None:
+        scaled = numpy.asarray(values, dtype = numpy.float64) * factor + offset
+        return scaled.astype(int) if integer else scaled
+    elif integer:
+        return [ int(v * factor + offset) for v in values ]
+    else:
+        return [ v * factor + offset for v in values ]
+    
+def polar(values, radius, factor, centre_x, centre_y, angle = None):
+    """
+    Get the x and y co-ordinates of each value plotted around a circle, with 
+    the distance from the centre being radius + value * factor.
+    
+    Keyword arguments:
+    values        -- array or list of levels
+    radius        -- radius of a zero value
+    factor        -- multiplier
+    centre_x      -- x co-ordinate of the centre
+    centre_y      -- y co-ordinate of the centre
+    angle         -- angle between each value, defaults to an even spread
+    """
+    n = len(values)
+    if angle is None:
+        angle = math.pi * 2 / max(1, n)
+    if numpy is not None:
+        a = numpy.arange(n) * angle
+        r = numpy.asarray(values, dtype = numpy.float64) * factor + radius
+        return ( numpy.sin(a) * r + centre_x ).tolist(), ( numpy.cos(a) * r + centre_y ).tolist()
+    else:
+        xs = []
+        ys = []
+        for i, v in enumerate(values):
+            r = v * factor + radius
+            xs.append(math.sin(i * angle) * r + centre_x)
+            ys.append(math.cos(i * angle) * r + centre_y)
+        return xs, ys
+
+def get_colour_average(samples):
+    """
+    Get an RGB colour from the average level of each third of the samples,
+    as used for the keyboard backlight light show
+    
+    Keyword arguments:
+    samples        -- sequence of levels
+    """
+    each = len(samples) // 3
+    if each == 0:
+        return ( 0, 0, 0 )
+    if numpy is not None:
+        levels = numpy.minimum(as_array(samples)[:each * 3] * 340, 255)
+        return tuple([ int(t / each) for t in levels.reshape(3, each).sum(axis = 1).tolist() ])
+    cols = []
+    for j in range(0, 3):
+        t = 0
+        for v in samples[j * each:( j + 1 ) * each]:
+            t += min(255, v * 340)
+        cols.append(int(t / each))
+    return ( cols[0], cols[1], cols[2] )
+
+def get_total_average(samples):
+    """
+    Get the average level of all samples, as used for the M-Key light show
+    
+    Keyword arguments:
+    samples        -- sequence of levels
+    """
+    if len(samples) == 0:
+        return 0
+    if numpy is not None:
+        return float(numpy.minimum(as_array(samples) * 340, 255).sum()) / len(samples)
+    t = 0
+    for v in samples:
+        t += min(255, v * 340)
+    return t / len(samples)
+
+class Peaks():
+    """
+    Tracks the peak of each bar. A peak jumps up with its bar and then falls
+    at an increasing speed.
+    """
+    
+    def __init__(self, decay = PEAK_DECAY):
+        self.decay = decay
+        self.heights = None
+        self._speeds = None
+        
+    def update(self, values):
+        """
+        Update the peaks from this frame's values, returning the new heights
+        
+        Keyword arguments:
+        values        -- array or list of bar heights
+        """
+        if numpy is not None:
+            values = numpy.asarray(values, dtype = numpy.float64)
+            if self.heights is None or len(self.heights) != len(values):
+                self.heights = numpy.zeros(len(values))
+                self._speeds = numpy.zeros(len(values))
+            rising = values > self.heights
+            self._speeds = numpy.where(rising, 0.0, self._speeds + self.decay)
+            self.heights = numpy.maximum(numpy.where(rising, values, self.heights - self._speeds), 0)
+        else:
+            if self.heights is None or len(self.heights) != len(values):
+                self.heights = [ 0 ] * len(values)
+                self._speeds = [ 0.0 ] * len(values)
+            for i, v in enumerate(values):
+                if v > self.heights[i]:
+                    self.heights[i] = v
+                    self._speeds[i] = 0.0
+                else:
+                    self._speeds[i] += self.decay
+                    self.heights[i] = max(0, self.heights[i] - self._speeds[i])
+        return self.heights
+    
+class _BenchmarkScreenlet():
+    """
+    Stands in for the plugin with the default settings on a G19
+    """
+    def __init__(self):
+        self.width = 320
+        self.height = 240
+        self.bars = 16
+        self.bar_width = 16
+        self.bar_height = 2
+        self.rows = 16
+        self.spacing = 0
+        self.col1 = ( 1.0, 0.0, 0.0, 1.0 )
+        self.col2 = ( 0.0, 0.0, 1.0, 1.0 )
+    
+def _benchmark(frames):
+    import array
+    import cairo
+    import os
+    import random
+    import sys
+    import time
+    
+    themes_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "themes")
+    sys.path.append(themes_dir)
+    screenlet = _BenchmarkScreenlet()
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, screenlet.width, screenlet.height)
+    samples = [ array.array('d', [ random.random() for i in range(256) ]) for j in range(32) ]
+    print("Drawing %d frames of %dx%d with %d bars (engine: %s)" % ( frames, screenlet.width, screenlet.height, screenlet.bars, "numpy" if numpy is not None else "python" ))
+    for theme in sorted(os.listdir(themes_dir)):
+        if not os.path.exists(os.path.join(themes_dir, theme, "__init__.py")):
+            continue
+        theme_module = __import__(theme)
+        theme_module.load_theme(screenlet)
+        start = time.time()
+        for i in range(frames):
+            cr = cairo.Context(surface)
+            cr.save()
+            theme_module.on_draw(samples[i % len(samples)], cr, screenlet)
+            cr.restore()
+        surface.flush()
+        taken = time.time() - start
+        print("%-12s %8.2f ms/frame %8.1f frames/sec %5.1f%% of a 30 FPS budget" % ( theme, taken * 1000 / frames, frames / taken, taken * 30 * 100 / frames ))
+        
+if __name__ == "__main__":
+    import sys
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -1,4 +1,5 @@
 import math
+import impulserender
 
 fft = True
 
@@ -20,8 +21,6 @@ def on_after_set_attribute ( self, name, value, screenlet ):
 
 def on_draw( audio_sample_array, cr, screenlet ):
 
-	l = len( audio_sample_array )
-
 	width, height = ( screenlet.width, screenlet.height )
 
 
@@ -29,25 +28,25 @@ def on_draw( audio_sample_array, cr, screenlet ):
 
 	cr.set_line_width( screenlet.bar_width )
 
-	for i in range( 0, l, l / n_bars ):
-		bar_amp_norm = audio_sample_array[ i ]
-
-
-		bar_height = ( bar_amp_norm * ( screenlet.width / 2 ) + screenlet.bar_width ) * ( screenlet.bar_height / 10.0 )
-
-		cc = screenlet.col2
+	levels = impulserender.get_bars( audio_sample_array, n_bars )
+	bar_heights = impulserender.scale( levels, ( screenlet.width / 2 ) * ( screenlet.bar_height / 10.0 ), screenlet.bar_width * ( screenlet.bar_height / 10.0 ) )
+	rings = impulserender.as_list( impulserender.scale( bar_heights, 1 / 5.0, integer = True ) )
+	ring_step = max(max(1, screenlet.spacing) / 5, 1)
+	angle = math.pi*2 / n_bars
+
+	# The innermost ring of every bar is stroked as one path, then all of the others
+	for inner in ( True, False ):
+		for i in range( 0, len( rings ) ):
+			for j in range( 0 if inner else ring_step, min( rings[ i ], 1 ) if inner else rings[ i ], ring_step ):
+				cr.new_sub_path( )
+				cr.arc(
+					width / 2,
+					height / 2,
+					20 + j * screenlet.bar_width,
+					angle * i,
+					angle * ( i + 1 ) - .05
+				)
+
+		cc = screenlet.col2 if inner else screenlet.col1
 		cr.set_source_rgba( cc[ 0 ],  cc[ 1 ],  cc[ 2 ],  cc[ 3 ] )
-		for j in range( 0, int( bar_height / 5 ), max(max(1, screenlet.spacing) / 5, 1) ):
-			cr.arc(
-				width / 2,
-				height / 2,
-				20 + j * screenlet.bar_width,
-				( math.pi*2 / n_bars ) * ( i / ( l / n_bars ) ),
-				( math.pi*2 / n_bars ) * ( i / ( l / n_bars ) + 1 ) - .05
-			)
-
-			cr.stroke( )
-			
-			if j == 0:		
-				cc = screenlet.col1	
-				cr.set_source_rgba( cc[ 0 ],  cc[ 1 ],  cc[ 2 ],  cc[ 3 ] )
+		cr.stroke( )
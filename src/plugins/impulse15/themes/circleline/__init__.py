@@ -1,4 +1,5 @@
 import math
+import impulserender
 
 fft=True
 
@@ -18,8 +19,6 @@ def on_after_set_attribute ( self, name, value, screenlet ):
 
 def on_draw( audio_sample_array, cr, screenlet ):
 
-	l = len( audio_sample_array )
-
 	width, height = ( screenlet.width, screenlet.height )
 
 	co = screenlet.col1
@@ -31,36 +30,14 @@ def on_draw( audio_sample_array, cr, screenlet ):
 
 	h = screenlet.bar_height
 
-	fx = 0
-	fy = 0
-
-	for i in range( 0, l, l / n_bars ):
-
-		bar_amp_norm = audio_sample_array[ i ]
-
-		bar_height = bar_amp_norm * 100
-
-
-		a = ( math.pi*2 / n_bars ) * ( i / ( l / n_bars ) )
-
-		x = ( math.sin( a ) * ( h + bar_height ) + width / 2 ) 
-		y = ( math.cos( a ) * ( h + bar_height ) + height / 2 )
-
-		if not i:
-			fx = x
-			fy = y
-			cr.move_to( x, y )
-
-		cr.curve_to(
-			x, y,
-			x, y,
-			x, y
-		)
+	# Plot every bar around the circle at once, then draw them as one line
+	levels = impulserender.get_bars( audio_sample_array, n_bars )
+	xs, ys = impulserender.polar( levels, h, 100, width / 2, height / 2, math.pi*2 / n_bars )
 
-	cr.curve_to(
-		fx, fy,
-		fx, fy,
-		fx, fy
-	)
+	if len( xs ) > 0:
+		cr.move_to( xs[ 0 ], ys[ 0 ] )
+		for i in range( 1, len( xs ) ):
+			cr.line_to( xs[ i ], ys[ i ] )
+		cr.line_to( xs[ 0 ], ys[ 0 ] )
 
 	cr.stroke( )
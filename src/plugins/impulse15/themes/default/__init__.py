@@ -1,5 +1,6 @@
-peak_heights = [ 0 for i in range( 256 ) ]
-peak_acceleration = [ 0.0 for i in range( 256 ) ]
+import impulserender
+
+peaks = impulserender.Peaks()
 fft = True
 
 def load_theme ( screenlet):
@@ -18,50 +19,41 @@ def on_draw ( audio_sample_array, cr, screenlet ):
 	actual_cols = ( len( audio_sample_array ) / freq ) + 1 
 	
 	total_width = ( actual_cols * ( col_width + col_spacing ) ) - col_spacing
-	
-#	print "Total width = %d, Cols = %d, width = %d, spacing = %d, freq = %f, len = %d, actual_cols = %d" % ( total_width, n_cols, col_width, col_spacing, freq, len(audio_sample_array), actual_cols  )
+
+	# Work out the rows lit in each column and the peaks for the whole frame
+	levels = impulserender.get_bars( audio_sample_array, n_cols )
+	rows = impulserender.scale( levels, n_rows - 2, integer = True )
+	peak_heights = impulserender.as_list( peaks.update( rows ) )
+	rows = impulserender.as_list( rows )
 	
 	cr.save()
 	cr.translate( ( screenlet.width - total_width ) / 2, 0)
 
-	for i in range( 0, len( audio_sample_array ), freq ):
-
-		col = i / freq
-		rows = int( audio_sample_array[ i ] * ( n_rows - 2 ) )
-
-		cr.set_source_rgba( bar_color[ 0 ], bar_color[ 1 ], bar_color[ 2 ], bar_color[ 3 ] )
-
-		if rows > peak_heights[ i ]:
-			peak_heights[ i ] = rows
-			peak_acceleration[ i ] = 0.0
+	# All of the bars are filled as a single path
+	for col in range( 0, len( rows ) ):
+		x = col * ( col_width + col_spacing )
+		if row_spacing == 0:
+			if rows[ col ] > 0:
+				cr.rectangle( x, screenlet.height, col_width, -row_height * rows[ col ] )
 		else:
-			peak_acceleration[ i ] += .1
-			peak_heights[ i ] -= peak_acceleration[ i ]
-
-		if peak_heights[ i ] < 0:
-			peak_heights[ i ] = 0
-
-		for row in range( 0, rows ):
-
-			cr.rectangle(
-				col * ( col_width + col_spacing ),
-				screenlet.height - row * ( row_height + row_spacing ),
-				col_width, -row_height
-			)
-
-		cr.fill( )
-
-		cr.set_source_rgba( peak_color[ 0 ], peak_color[ 1 ], peak_color[ 2 ], peak_color[ 3 ] )
+			for row in range( 0, rows[ col ] ):
+				cr.rectangle(
+					x,
+					screenlet.height - row * ( row_height + row_spacing ),
+					col_width, -row_height
+				)
+
+	cr.set_source_rgba( bar_color[ 0 ], bar_color[ 1 ], bar_color[ 2 ], bar_color[ 3 ] )
+	cr.fill( )
 
+	# Followed by all of the peaks
+	for col in range( 0, len( peak_heights ) ):
 		cr.rectangle(
 			col * ( col_width + col_spacing ),
-			screenlet.height - peak_heights[ i ] * ( row_height + row_spacing ),
+			screenlet.height - peak_heights[ col ] * ( row_height + row_spacing ),
 			col_width, -row_height
 		)
 
-		cr.fill( )
-
+	cr.set_source_rgba( peak_color[ 0 ], peak_color[ 1 ], peak_color[ 2 ], peak_color[ 3 ] )
 	cr.fill( )
-	cr.stroke( )
 	cr.restore()
-
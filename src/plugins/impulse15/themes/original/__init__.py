@@ -1,3 +1,5 @@
+import impulserender
+
 fft = True
 
 def load_theme( screenlet ):
@@ -5,8 +7,6 @@ def load_theme( screenlet ):
 
 def on_draw( audio_sample_array, cr, screenlet ):
 
-	l = len( audio_sample_array )
-
 	width, height = ( screenlet.width, screenlet.height )
 
 	# start drawing spectrum
@@ -22,23 +22,24 @@ def on_draw( audio_sample_array, cr, screenlet ):
 	total_width = ( actual_cols * ( bar_width + bar_spacing ) ) - bar_spacing
 	cr.translate( ( screenlet.width - total_width ) / 2, 0)
 
-	for i in range( 0, l, l / n_bars ):
+	levels = impulserender.get_bars( audio_sample_array, n_bars )
+	bar_heights = impulserender.as_list( impulserender.scale( levels, height * ( screenlet.bar_height / 10.0 ), 2 * ( screenlet.bar_height / 10.0 ) ) )
 
-		bar_amp_norm = audio_sample_array[ i ]
+	# All bars are filled and outlined as a single path
+	for i in range( 0, len( bar_heights ) ):
 
-		bar_height = ( bar_amp_norm * height + 2 ) * ( screenlet.bar_height / 10.0 )
+		bar_height = bar_heights[ i ]
 
 		cr.rectangle(
-			( bar_width + bar_spacing ) * ( i / ( l / n_bars ) ),
+			( bar_width + bar_spacing ) * i,
 			height / 2 - bar_height / 2,
 			bar_width,
 			bar_height
 		)
 		
-		co = screenlet.col1
-		cr.set_source_rgba( co[ 0 ], co[ 1 ], co[ 2 ], co[ 3 ] )
-		cr.fill_preserve()
-		co = screenlet.col2
-		cr.set_source_rgba( co[ 0 ], co[ 1 ], co[ 2 ], co[ 3 ] )
-		cr.stroke()
-
+	co = screenlet.col1
+	cr.set_source_rgba( co[ 0 ], co[ 1 ], co[ 2 ], co[ 3 ] )
+	cr.fill_preserve()
+	co = screenlet.col2
+	cr.set_source_rgba( co[ 0 ], co[ 1 ], co[ 2 ], co[ 3 ] )
+	cr.stroke()
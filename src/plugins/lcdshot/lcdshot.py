@@ -25,21 +25,28 @@ import gnome15.g15globals as g15globals
 import gnome15.g15actions as g15actions
 import os.path
 import gtk
-import gobject
 import gnome15.util.g15convert as g15convert
 import gnome15.g15notify as g15notify
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15gconf as g15gconf
-import gnome15.util.g15os as g15os
 import gnome15.util.g15cairo as g15cairo
-import subprocess
-import shutil
+import gnome15.util.g15scheduler as g15scheduler
+import time
+import struct
+from collections import deque
 from threading import Thread
+from threading import Condition
  
 # Logging
 import logging
 logger = logging.getLogger(__name__)
 
+try:
+    import gst
+except ImportError as e:
+    logger.debug("GStreamer not available, video recording will be disabled", exc_info = e)
+    gst = None
+
 # Custom actions
 SCREENSHOT = "screenshot"
 
@@ -61,6 +68,17 @@ actions={
          SCREENSHOT : "Take LCD screenshot"
          }
 
+'''
+Maximum number of raw frames waiting to be encoded. If the encoder falls
+further behind than this, the oldest frames are dropped
+'''
+RING_SIZE = 100
+
+'''
+GStreamer encoders that may be used for video, in order of preference
+'''
+ENCODERS = [ "ffenc_mpeg4", "jpegenc" ]
+
 
 ''' 
 This simple plugin takes a screenshot of the LCD
@@ -72,6 +90,16 @@ def create(gconf_key, gconf_client, screen):
 def show_preferences(parent, driver, gconf_client, gconf_key):
     LCDShotPreferences(parent, driver, gconf_client, gconf_key)
     
+def get_encoder_name():
+    """
+    Get the name of the GStreamer element that will be used to encode video,
+    or None if video recording is not possible
+    """
+    if gst is not None:
+        for encoder in ENCODERS:
+            if gst.element_factory_find(encoder) is not None:
+                return encoder
+    
 class LCDShotPreferences():
     def __init__(self, parent, driver, gconf_client, gconf_key):
         self.gconf_client = gconf_client
@@ -94,20 +122,20 @@ class LCDShotPreferences():
         bg_img = g15gconf.get_string_or_default(self.gconf_client, "%s/folder" % self.gconf_key, os.path.expanduser("~/Desktop"))
         chooser_button.set_current_folder(bg_img)
 
-        # Reset the value of the mode setting to 'still' if mencoder is not installed
-        mencoder_is_installed = g15os.is_program_in_path('mencoder')
-        if not mencoder_is_installed:
+        # Reset the value of the mode setting to 'still' if no encoder is available
+        can_encode = get_encoder_name() is not None
+        if not can_encode:
             gconf_client.set_string("%s/mode" % self.gconf_key, "still")
 
         # Initialize the mode combobox content
         modes = widget_tree.get_object("ModeModel")
         modes.clear()
         modes.append(('still','Still', True))
-        modes.append(('video','Video', mencoder_is_installed))
+        modes.append(('video','Video', can_encode))
 
-        # Display a warning message to the user if mencoder is not installed
+        # Display a warning message to the user if no encoder is available
         warning = widget_tree.get_object("NoVideoMessage")
-        warning.set_visible(not mencoder_is_installed)
+        warning.set_visible(not can_encode)
 
         g15uigconf.configure_combo_from_gconf(self.gconf_client, "%s/mode" % self.gconf_key, "Mode", "still", widget_tree)
         mode = widget_tree.get_object("Mode")
@@ -130,6 +158,201 @@ class LCDShotPreferences():
         self.gconf_client.set_string(self.gconf_key + "/folder", widget.get_filename())
         
             
+class G15FrameEncoder(Thread):
+    """
+    Encodes raw frames of the LCD to a video file using a GStreamer appsrc
+    pipeline. Frames are added from the screen's paint path by add_frame(),
+    which just copies the surface data into a bounded ring buffer. This
+    thread then feeds the ring buffer to the encoder, so encoding never
+    holds up painting. Frames are timestamped when captured, and videorate
+    turns them into a constant frame rate.
+    
+    Keyword arguments:
+    path        -- file to write video to
+    width       -- width of frames
+    height      -- height of frames
+    fps         -- frame rate of the video
+    on_complete -- function called with this encoder when encoding finishes
+    """
+    
+    def __init__(self, path, width, height, fps, on_complete):
+        Thread.__init__(self)
+        self.setName("LCDScreenshotEncode")
+        self.setDaemon(True)
+        self.path = path
+        self.error = None
+        self.encoded = 0
+        self.dropped = 0
+        self._width = width
+        self._height = height
+        self._interval = 1.0 / fps
+        self._on_complete = on_complete
+        self._frames = deque(maxlen = RING_SIZE)
+        self._pending = None
+        self._condition = Condition()
+        self._stopping = False
+        self._stop_time = None
+        self._last_capture = 0
+        self._build_pipeline(fps)
+        
+    def add_frame(self, surface):
+        """
+        Add a frame to the ring buffer. This is called from the screen's paint
+        path with the draw lock held, so only the raw data is copied. A frame 
+        arriving sooner than the frame rate of the video allows is held back
+        until it is due, and is replaced if another arrives before then. This
+        means the last frame painted is always recorded, even if the page is
+        not painted again.
+        
+        Keyword arguments:
+        surface        -- surface just painted to the LCD
+        """
+        if surface.get_width() != self._width or surface.get_height() != self._height:
+            return
+        now = time.time()
+        surface.flush()
+        data = str(surface.get_data())
+        self._condition.acquire()
+        try:
+            if self._stopping:
+                return
+            if now - self._last_capture < self._interval:
+                self._pending = ( now, data )
+            else:
+                self._pending = None
+                self._add(now, data)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        
+    def stop(self):
+        """
+        Stop accepting frames. Those already in the ring buffer (and any frame
+        held back) are still encoded, then the file is finished.
+        """
+        self._condition.acquire()
+        try:
+            if not self._stopping:
+                self._stopping = True
+                self._stop_time = time.time()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        
+    def run(self):
+        start_time = None
+        data = None
+        try:
+            if self._pipeline.set_state(gst.STATE_PLAYING) == gst.STATE_CHANGE_FAILURE:
+                raise Exception("Could not start the encoder")
+            while True:
+                self._condition.acquire()
+                try:
+                    frame = self._next_frame()
+                finally:
+                    self._condition.release()
+                if frame is None:
+                    break
+                frame_time, data = frame
+                    
+                if start_time is None:
+                    start_time = frame_time
+                self._push(data, frame_time - start_time)
+                self.encoded += 1
+            
+            # Repeat the last frame so the video lasts until recording stopped  
+            if data is not None:
+                self._push(data, max(0, self._stop_time - start_time))
+            self._src.emit("end-of-stream")
+            message = self._pipeline.get_bus().timed_pop_filtered(gst.CLOCK_TIME_NONE, gst.MESSAGE_EOS | gst.MESSAGE_ERROR)
+            if message is not None and message.type == gst.MESSAGE_ERROR:
+                err, debug = message.parse_error()
+                raise Exception("%s (%s)" % (err.message, debug))
+        except Exception as e:
+            logger.error("Video encoding failed.", exc_info = e)
+            self.error = e
+        finally:
+            self._condition.acquire()
+            try:
+                self._stopping = True
+                self._frames.clear()
+                self._pending = None
+            finally:
+                self._condition.release()
+            self._pipeline.set_state(gst.STATE_NULL)
+            self._on_complete(self)
+            
+    def _add(self, frame_time, data):
+        if len(self._frames) == RING_SIZE:
+            self.dropped += 1
+        self._frames.append(( frame_time, data ))
+        self._last_capture = frame_time
+        
+    def _next_frame(self):
+        """
+        Wait for the next frame to encode, moving any held back frame into the
+        ring buffer when it is due. Returns None when recording has stopped and
+        there are no more frames. Must be called with the condition held.
+        """
+        while len(self._frames) == 0:
+            if self._pending is not None:
+                delay = self._last_capture + self._interval - time.time()
+                if delay <= 0 or self._stopping:
+                    frame_time, data = self._pending
+                    self._pending = None
+                    self._add(frame_time, data)
+                    self._last_capture = max(frame_time, time.time())
+                    break
+                self._condition.wait(delay)
+            elif self._stopping:
+                return None
+            else:
+                self._condition.wait()
+        return self._frames.popleft()
+            
+    def _push(self, data, offset):
+        buf = gst.Buffer(data)
+        buf.timestamp = long(offset * gst.SECOND)
+        ret = self._src.emit("push-buffer", buf)
+        if ret != gst.FLOW_OK:
+            raise Exception("Encoder did not accept frame (%s)" % ret)
+        
+    def _build_pipeline(self, fps):
+        encoder_name = get_encoder_name()
+        if encoder_name is None:
+            raise Exception("No video encoder available")
+        
+        # Raw frames exactly as they are in the cairo surface
+        self._src = gst.element_factory_make("appsrc")
+        self._src.set_property("caps", gst.Caps("video/x-raw-rgb,"
+                                                "bpp = (int) 32, depth = (int) 24,"
+                                                "endianness = (int) BIG_ENDIAN,"
+                                                "red_mask = (int) %i, "
+                                                "green_mask = (int) %i, "
+                                                "blue_mask = (int) %i, "
+                                                "width = (int) %d, "
+                                                "height = (int) %d, "
+                                                "framerate = (fraction) 0/1"
+                                                % (struct.unpack('=i', '\x00\xFF\x00\x00')[0],
+                                                   struct.unpack('=i', '\x00\x00\xFF\x00')[0],
+                                                   struct.unpack('=i', '\x00\x00\x00\xFF')[0],
+                                                   self._width, self._height)))
+        self._src.set_property("format", gst.FORMAT_TIME)
+        self._src.set_property("block", True)
+        
+        rate = gst.element_factory_make("videorate")
+        rate_filter = gst.element_factory_make("capsfilter")
+        rate_filter.set_property("caps", gst.Caps("video/x-raw-yuv, framerate = (fraction) %d/1" % int(1.0 / self._interval)))
+        color_space = gst.element_factory_make("ffmpegcolorspace")
+        encoder = gst.element_factory_make(encoder_name)
+        mux = gst.element_factory_make("avimux")
+        sink = gst.element_factory_make("filesink")
+        sink.set_property("location", self.path)
+        
+        self._pipeline = gst.Pipeline("lcdshot")
+        self._pipeline.add(self._src, color_space, rate, rate_filter, encoder, mux, sink)
+        gst.element_link_many(self._src, color_space, rate, rate_filter, encoder, mux, sink)
+            
 class G15LCDShot():
     
     def __init__(self, screen, gconf_client, gconf_key):
@@ -137,12 +360,15 @@ class G15LCDShot():
         self._gconf_client = gconf_client
         self._gconf_key = gconf_key
         self._recording = False
+        self._encoder = None
 
     def activate(self):
         self._screen.key_handler.action_listeners.append(self) 
     
     def deactivate(self):
         self._screen.key_handler.action_listeners.remove(self)
+        if self._recording:
+            self._stop_recording()
         
     def destroy(self):
         pass
@@ -159,57 +385,52 @@ class G15LCDShot():
                 else:
                     self._start_recording()
                     
-    def _encode(self):
-        cmd = ["mencoder", "-really-quiet", "mf://%s.tmp/*.jpeg" % self._record_to, "-mf", \
-                         "w=%d:h=%d:fps=%d:type=jpg" % (self._screen.device.lcd_size[0],self._screen.device.lcd_size[1],self._record_fps), "-ovc", "lavc", \
-                         "-lavcopts", "vcodec=mpeg4", "-oac", "copy", "-o", self._record_to]
-        try:
-            ret = subprocess.call(cmd)
-            if ret == 0:
-                g15notify.notify(_("LCD Screenshot"), _("Video encoding complete. Result at %s" % self._record_to), "dialog-info", timeout = 0)
-                shutil.rmtree("%s.tmp" % self._record_to, True)
-            else:
-                logger.error("Video encoding failed with status %d", ret)
-                g15notify.notify(_("LCD Screenshot"), _("Video encoding failed."), "dialog-error", timeout = 0)
-        except Exception as e:
-                logger.error("Video encoding failed.", exc_info = e)
-                g15notify.notify(_("LCD Screenshot"), _("Video encoding failed. Do you have mencoder installed?"), "dialog-error", timeout = 0)
+    def _encoded(self, encoder):
+        # Called on the encoder thread, the frame listeners and recording state
+        # are only changed on the gobject thread
+        if g15scheduler.run_on_gobject(self._encoded, encoder):
+            return
+        if encoder is self._encoder and self._recording:
+            # Encoding stopped by itself, so it must have failed
+            self._remove_listener()
+            self._recording = False
+        if encoder.dropped > 0:
+            logger.warning("%d frames were dropped because the encoder could not keep up", encoder.dropped)
+        if encoder.error is None:
+            g15notify.notify(_("LCD Screenshot"), _("Video encoding complete. Result at %s" % encoder.path), "dialog-info", timeout = 0)
+        else:
+            g15notify.notify(_("LCD Screenshot"), _("Video encoding failed. %s") % str(encoder.error), "dialog-error", timeout = 0)
+                    
+    def _remove_listener(self):
+        if self._encoder.add_frame in self._screen.frame_listeners:
+            self._screen.frame_listeners.remove(self._encoder.add_frame)
                     
     def _stop_recording(self):
         self._recording = False
+        self._remove_listener()
+        self._encoder.stop()
         g15notify.notify(_("LCD Screenshot"), _("Video recording stopped. Now encoding"), "dialog-info", timeout = 0)
-        t = Thread(target = self._encode);
-        t.setName("LCDScreenshotEncode")
-        t.start()
                     
     def _start_recording(self):
-        self._record_fps = g15gconf.get_int_or_default(self._gconf_client, "%s/fps" % self._gconf_key, 10)
+        record_fps = max(1, g15gconf.get_int_or_default(self._gconf_client, "%s/fps" % self._gconf_key, 10))
         path = self._find_next_free_filename("avi", _("Gnome15_Video"))
-        g15notify.notify(_("LCD Screenshot"), _("Started recording video"), "dialog-info")
-        g15os.mkdir_p("%s.tmp" % path)
-        self._frame_no = 1
+        try:
+            self._encoder = G15FrameEncoder(path, self._screen.width, self._screen.height, record_fps, self._encoded)
+        except Exception as e:
+            logger.error("Failed to start recording.", exc_info = e)
+            self._screen.error_on_keyboard_display(_("Failed to start recording to %s. %s") % (path, str(e)))
+            return
         self._recording = True
-        self._record_to = path
-        self._frame()
-        
-    def _frame(self):
-        if self._recording:
-            try:
-                self._screen.draw_lock.acquire()
-                try:
-                    path = os.path.join("%s.tmp" % self._record_to, "%012d.jpeg" % self._frame_no)
-                    pixbuf = g15cairo.surface_to_pixbuf(self._screen.old_surface)
-                finally:
-                    self._screen.draw_lock.release()
-                    
-                pixbuf.save(path, "jpeg", {"quality":"100"})
-                self._frame_no += 1
-            except Exception as e:
-                logger.error("Failed to save screenshot.", exc_info = e)
-                self._screen.error_on_keyboard_display(_("Failed to save screenshot to %s. %s") % (dir, str(e)))
-                self._recording = False
-            
-            self._recording_timer = gobject.timeout_add(1000 / self._record_fps, self._frame)
+        self._screen.frame_listeners.append(self._encoder.add_frame)
+        try:
+            self._encoder.start()
+        except Exception as e:
+            logger.error("Failed to start recording.", exc_info = e)
+            self._recording = False
+            self._remove_listener()
+            self._screen.error_on_keyboard_display(_("Failed to start recording to %s. %s") % (path, str(e)))
+            return
+        g15notify.notify(_("LCD Screenshot"), _("Started recording video"), "dialog-info")
             
     def _find_next_free_filename(self, ext, title):
         dir_path = g15gconf.get_string_or_default(self._gconf_client, "%s/folder" % \
@@ -34,8 +34,6 @@ import gnome15.g15globals as g15globals
 import gtk
 import os
 import gst
-import cairo
-import array
 import gobject
 import gio
 import mimetypes
@@ -247,6 +245,7 @@ class G15MediaPlayerPage(g15theme.G15Page):
         self._lock = Lock()
         self._plugin = plugin
         self._surface = None
+        self._frame_pending = False
         self._hide_timer = None
         self._screen = screen
         self._full_screen = self._screen.driver.get_size()
@@ -275,14 +274,16 @@ class G15MediaPlayerPage(g15theme.G15Page):
 
         # Create our custom sink that is connected to the LCD
         logger.info("Creating videosink that is connected to the LCD")
-        self._video_sink = lcdsink.CairoSurfaceThumbnailSink()
+        target_size = self._get_target_size()
+        self._video_bin = lcdsink.LCDVideoBin(target_size[0], target_size[1], self._screen.max_fps)
+        self._video_sink = self._video_bin.sink
         logger.info("Connecting to video sink")
         self._video_sink.connect('thumbnail', self._redraw_cb)
         
         # Now create the actual pipeline
         self._pipeline = gst.Pipeline("mypipeline")
         logger.info("Building pipeline")
-        self._source.build_pipeline(self._video_src, self._video_sink, self._pipeline)
+        self._source.build_pipeline(self._video_src, self._video_bin, self._pipeline)
         logger.info("Built pipeline")
         self._connect_signals()
     
@@ -389,23 +390,22 @@ class G15MediaPlayerPage(g15theme.G15Page):
             self._show_sidebar()
                 
     def _redraw_cb(self, unused_thsink, timestamp):
+        """
+        Called on the streaming thread for every rendered frame. Only one
+        frame update is queued at a time, any frames that arrive while one
+        is pending are dropped in favour of the latest.
+        """
+        if not self._plugin.active or self._frame_pending:
+            return
+        self._frame_pending = True
+        g15screen.run_on_redraw(self._update_frame)
+            
+    def _update_frame(self):
+        self._frame_pending = False
         if not self._plugin.active:
             return
-        buf = self._video_sink.data
-        width = self._video_sink.width
-        height = self._video_sink.height
-        b = array.array("b")
-        b.fromstring(buf)
-        self._surface = cairo.ImageSurface.create_for_data(b,
-            # We don't use FORMAT_ARGB32 because Cairo uses premultiplied
-            # alpha, and gstreamer does not.  Discarding the alpha channel
-            # is not ideal, but the alternative would be to compute the
-            # conversion in python (slow!).
-            cairo.FORMAT_RGB24,
-            width,
-            height,
-            width * 4)
-        
+        self._video_bin.set_max_fps(self._screen.max_fps)
+        self._surface = self._video_sink.get_surface()
         if self.is_visible():
             self.redraw()
         else:
@@ -447,10 +447,14 @@ class G15MediaPlayerPage(g15theme.G15Page):
         secs = int(secs)
         return hours,mins,secs
         
+    def _get_target_size(self):
+        size = self._screen.driver.get_size()
+        return ( float(size[0]), float(size[0]) * (float(self._aspect[1]) ) / float(self._aspect[0]) )
+        
     def _paint_video_image(self, canvas):
         size = self._screen.driver.get_size()
         if self._surface != None:
-            target_size = ( float(size[0]), float(size[0]) * (float(self._aspect[1]) ) / float(self._aspect[0]) )
+            target_size = self._get_target_size()
             sx = float(target_size[0]) / float(self._surface.get_width())
             sy = float(target_size[1]) / float(self._surface.get_height())
             canvas.save()
@@ -485,6 +489,8 @@ class G15MediaPlayerPage(g15theme.G15Page):
             self._aspect = self._full_screen
         else:
             self._aspect = (16, 9)
+        target_size = self._get_target_size()
+        self._video_bin.set_size(target_size[0], target_size[1])
         if self._sidebar_offset != 0:
             self._show_sidebar()
             self._hide_sidebar(3.0)
@@ -576,19 +582,9 @@ class G15VideoFileSource(G15MediaSource):
     
     def build_pipeline(self, video_src, video_sink, pipeline):
         
-        # Create the pipeline elements
+        # Create the pipeline elements. The video sink scales and converts
+        # the decoded video itself
         self._decodebin = gst.element_factory_make("decodebin2")
-        self._autoconvert = gst.element_factory_make("autoconvert")
-        
-        # As a precaution add videio capability filter
-        # in the video processing pipeline.
-        videocap = gst.Caps("video/x-raw-yuv")
-        
-        self._filter = gst.element_factory_make("capsfilter")
-        self._filter.set_property("caps", videocap)
-        
-        # Converts the video from one colorspace to another
-        self._color_space = gst.element_factory_make("ffmpegcolorspace")
 
         self._audioconvert = gst.element_factory_make("audioconvert")
         self._audiosink = gst.element_factory_make("autoaudiosink")
@@ -599,20 +595,15 @@ class G15VideoFileSource(G15MediaSource):
     
         pipeline.add(video_src,
                      self._decodebin,
-                     self._autoconvert,
                      self._audioconvert,
                      self._queue1,
                      self._queue2,
-                     self._filter,
-                     self._color_space,
                      self._audiosink,
                      video_sink)
         
         # Link everything we can link now
         gst.element_link_many(video_src, self._decodebin)
-        gst.element_link_many(self._queue1, self._autoconvert,
-                              self._filter, self._color_space,
-                              video_sink)
+        gst.element_link_many(self._queue1, video_sink)
         gst.element_link_many(self._queue2, self._audioconvert,
                               self._audiosink)
         
@@ -653,7 +644,6 @@ class G15AudioFileSource(G15MediaSource):
     def build_pipeline(self, video_src, video_sink, pipeline):
         self._decodebin = gst.element_factory_make("decodebin2")
         self._visualiser = gst.element_factory_make(self._visualisation)
-        self._color_space = gst.element_factory_make("ffmpegcolorspace")
         self._audioconvert = gst.element_factory_make("audioconvert")
         self._audiosink = gst.element_factory_make("autoaudiosink")
         self._tee = gst.element_factory_make('tee', "tee")
@@ -667,14 +657,13 @@ class G15AudioFileSource(G15MediaSource):
                      self._audiosink,
                      self._queue2,
                      self._visualiser,
-                     self._color_space,
                      video_sink)
         gst.element_link_many(video_src, self._decodebin)
         gst.element_link_many(self._audioconvert, self._tee)
         self._tee.link(self._queue1)
         self._queue1.link(self._audiosink)
         self._tee.link(self._queue2)
-        gst.element_link_many(self._queue2, self._visualiser,self._color_space, video_sink)
+        gst.element_link_many(self._queue2, self._visualiser, video_sink)
         
     def connect_signals(self):
         if not self._decodebin is None:
@@ -702,14 +691,12 @@ class G15PulseSource(G15MediaSource):
     
     def build_pipeline(self, video_src, video_sink, pipeline):
         self._visualiser = gst.element_factory_make(self._visualisation)
-        self._color_space = gst.element_factory_make("ffmpegcolorspace")
         self._audioconvert = gst.element_factory_make("audioconvert")
         pipeline.add(video_src,
                      self._audioconvert,
                      self._visualiser,
-                     self._color_space,
                      video_sink)
-        gst.element_link_many(video_src, self._audioconvert, self._visualiser,self._color_space, video_sink)
+        gst.element_link_many(video_src, self._audioconvert, self._visualiser, video_sink)
     
 class G15RemovableSource(G15VideoFileSource):
     
@@ -742,32 +729,19 @@ class G15WebCamSource(G15MediaSource):
         return src
     
     def build_pipeline(self, video_src, video_sink, pipeline):
-        # Create the pipeline elements
+        # Create the pipeline elements. The video sink scales and converts
+        # the decoded video itself
         self._decodebin = gst.element_factory_make("decodebin2")
-        self._autoconvert = gst.element_factory_make("autoconvert")
-        
-        videocap = gst.Caps("video/x-raw-yuv")
-        self._filter = gst.element_factory_make("capsfilter")
-        self._filter.set_property("caps", videocap)
-        
-        # Converts the video from one colorspace to another
-        self._color_space = gst.element_factory_make("ffmpegcolorspace")
-        
         self._queue1 = gst.element_factory_make("queue")
         
         pipeline.add(video_src,
                      self._decodebin,
-                     self._autoconvert,
                      self._queue1,
-                     self._filter,
-                     self._color_space,
                      video_sink)
         
         # Link everything we can link now
         gst.element_link_many(video_src, self._decodebin)
-        gst.element_link_many(self._queue1, self._autoconvert,
-                              self._filter, self._color_space,
-                              video_sink)
+        gst.element_link_many(self._queue1, video_sink)
         
     def connect_signals(self):
         if not self._decodebin is None:
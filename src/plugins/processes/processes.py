@@ -18,12 +18,16 @@ import gnome15.g15locale as g15locale
 _ = g15locale.get_translation("processes", modfile = __file__).ugettext
 
 import gnome15.util.g15scheduler as g15scheduler
+import gnome15.util.g15gconf as g15gconf
+import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15cairo as g15cairo
 import gnome15.util.g15icontools as g15icontools
 import gnome15.g15theme as g15theme
 import gnome15.g15driver as g15driver
 import gnome15.g15plugin as g15plugin
+import gnome15.g15top as g15top
 import os
+import gtk
 import dbus
 import time
 import gobject
@@ -48,7 +52,7 @@ killed. through a menu on the LCD.")
 author="Brett Smith <tanktarta@blueyonder.co.uk>"
 copyright=_("Copyright (C)2010 Brett Smith")
 site="http://www.russo79.com/gnome15"
-has_preferences=False
+has_preferences=True
 unsupported_models = [ g15driver.MODEL_G110, g15driver.MODEL_G11, g15driver.MODEL_G930, g15driver.MODEL_G35 ]
 reserved_keys = [ g15driver.G_KEY_SETTINGS ]
 actions={ 
@@ -63,6 +67,15 @@ actions={
 def create(gconf_key, gconf_client, screen):
     return G15Processes(gconf_client, gconf_key, screen)
 
+def show_preferences(parent, driver, gconf_client, gconf_key):
+    widget_tree = gtk.Builder()
+    widget_tree.add_from_file(os.path.join(os.path.dirname(__file__), "processes.ui"))
+    dialog = widget_tree.get_object("ProcessesDialog")
+    dialog.set_transient_for(parent)
+    g15uigconf.configure_combo_from_gconf(gconf_client, gconf_key + "/sort", "SortCombo", "pid", widget_tree)
+    dialog.run()
+    dialog.hide()
+
 class ProcessMenuItem(g15theme.MenuItem):
     """
     MenuItem for individual processes
@@ -73,6 +86,7 @@ class ProcessMenuItem(g15theme.MenuItem):
         self.icon = None
         self.process_id = process_id
         self.process_name = process_name
+        self.process = None
         self.plugin = plugin
     
     def get_default_theme_dir(self):
@@ -117,6 +131,7 @@ class G15Processes(g15plugin.G15MenuPlugin):
         self._mode = "applications"
         self._timer = None
         self._matches = []
+        self._process_table = g15top.ProcessTable()
         g15plugin.G15MenuPlugin.activate(self)
         self.screen.key_handler.action_listeners.append(self)
         if self.bamf_matcher is not None:        
@@ -259,11 +274,12 @@ class G15Processes(g15plugin.G15MenuPlugin):
     def _reload_menu(self):
         g15scheduler.schedule("ReloadProcesses", 0, self._do_reload_menu)
         
-    def _get_menu_item(self, pid):
+    def _get_menu_item(self, pid, add = True):
         item = self.menu.get_child_by_id("process-%s" % pid)
         if item == None:
             item = ProcessMenuItem("process-%s" % pid, self, pid, None)
-            self.menu.add_child(item)
+            if add:
+                self.menu.add_child(item)
         return item
     
     def _get_bamf_application_object(self, window):
@@ -301,7 +317,8 @@ class G15Processes(g15plugin.G15MenuPlugin):
         if not self.active:
             return
         
-        this_items = {}        
+        this_items = {}
+        process_items = None
         if self._mode == "applications":
             if self.bamf_matcher != None:            
                 for window in self.bamf_matcher.RunningApplications():
@@ -325,33 +342,36 @@ class G15Processes(g15plugin.G15MenuPlugin):
                             item.icon = g15cairo.pixbuf_to_surface(pixbuf)
                                 
         else:
-            for process_id in gtop.proclist():
-                process_id = "%d" %  process_id
-                try :
-                    pid = int(process_id)
-                    proc_state = gtop.proc_state(pid)
-                    proc_args = gtop.proc_args(pid)
-                    if self._mode == "all" or ( self._mode != "all" and proc_state.uid == os.getuid()):                      
-                        item = self._get_menu_item(pid)
+            # Only processes that are new since the last refresh are read, existing menu items are kept for the rest
+            sort = g15gconf.get_string_or_default(self.gconf_client, self.gconf_key + "/sort", "pid")
+            sort = sort if sort in [ "cpu", "rss" ] else None
+            self._process_table.refresh(stats = sort is not None)
+            uid = os.getuid()
+            process_items = []
+            for process in self._process_table.get_processes(sort):
+                if self._mode == "all" or process.uid == uid:
+                    item = self._get_menu_item(process.pid, add = False)
+                    if item.process is not process:
+                        item.process = process
                         item.icon = None
-                        item.process_name = self._get_process_name(proc_args, proc_state.cmd)
-                        this_items[item.id] = item
-                except Exception as e:
-                    logger.debug("Process may have disappeared", exc_info = e)
-                    # In case the process disappears
-                    pass
+                        item.process_name = self._get_process_name(process.args, process.cmd)
+                    process_items.append(item)
  
-        # Remove any missing items
-        for item in self.menu.get_children():
-            if not item.id in this_items:
-                self.menu.remove_child(item)
-        
-        # Make sure selected still exists
-        if self.menu.selected != None and self.menu.get_child_by_id(self.menu.selected.id) is None:
-            if len(self.menu.get_child_count()) > 0:
-                self.menu.selected  = self.menu.get_children()[0]
-            else:
-                self.menu.selected = None
+        if process_items is not None:
+            # Replace the children in one go, this also keeps the selection
+            self.menu.set_children(process_items)
+        else:
+            # Remove any missing items
+            for item in self.menu.get_children():
+                if not item.id in this_items:
+                    self.menu.remove_child(item)
+            
+            # Make sure selected still exists
+            if self.menu.selected != None and self.menu.get_child_by_id(self.menu.selected.id) is None:
+                if self.menu.get_child_count() > 0:
+                    self.menu.selected  = self.menu.get_children()[0]
+                else:
+                    self.menu.selected = None
 
         self.page.mark_dirty()
         self.screen.redraw(self.page)
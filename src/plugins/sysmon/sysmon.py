@@ -87,7 +87,7 @@ class Net():
         self.last_net_list = None
         self.last_time = 0
         
-    def new_data(self, this_net_list):
+    def new_data(self, this_net_list, rates = None):
         now = time.time() 
             
         '''
@@ -97,7 +97,10 @@ class Net():
         self.recv_bps = 0.0
         self.send_bps = 0.0
 
-        if self.last_net_list != None:
+        if rates is not None:
+            # Rates already calculated by the shared g15top sample
+            self.recv_bps, self.send_bps = self._get_rates(rates)
+        elif self.last_net_list != None:
             time_taken = now - self.last_time        
             if self.net_no == 0:
                 this_total = self._get_net_total(this_net_list)
@@ -127,6 +130,11 @@ class Net():
         self.last_net_list = this_net_list 
         self.last_time = now
     
+    def _get_rates(self, rates):
+        if self.net_no == 0:
+            return self._get_net_total(rates)
+        return self._get_net(rates[self.name])
+    
     def _get_net(self, card):
         totals = (card[0], card[1])
         return totals  
@@ -149,9 +157,12 @@ class CPU():
         self.times = None
         self.last_times = None
         
-    def new_times(self, time_list):
+    def new_times(self, time_list, pc = None):
 
-        if self.last_times is not None:
+        if pc is not None:
+            # Percentage already calculated by the shared g15top sample
+            self.pc = pc
+        elif self.last_times is not None:
             working_list = list(time_list)
                     
             ''' Work out the number of time units the CPU has spent on each task type since the last
@@ -240,6 +251,7 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         self.cached = 0
         self.free = 0
         self.used = 0
+        self.used_pc = 0.0
         self.cached_history = [0] * GRAPH_SIZE
         self.used_history =  [0] * GRAPH_SIZE 
         
@@ -290,8 +302,9 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         '''
         CPU
         '''
+        cpu_times = gtop.cpu()
         for c in self.cpu_data:            
-            c.new_times(self._get_time_list(c))
+            c.new_times(self._get_time_list(c, cpu_times), self._get_cpu_pc(c, cpu_times))
         
         '''
         Net
@@ -299,8 +312,9 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         
         # Current net status   
         this_net_list, self.net_list = self._get_net_stats()
+        rates = self._get_net_rates(this_net_list)
         for n in self.net_data:
-            n.new_data(this_net_list)
+            n.new_data(this_net_list, rates)
         
         '''
         Memory
@@ -312,6 +326,7 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         self.used = self.total - self.free
         self.cached = float(mem.cached)
         self.noncached = self.total - self.free - self.cached
+        self.used_pc = getattr(mem, "used_pc", self.used * 100.0 / self.total)
         self.used_history.append(self.used + self.cached)
         
         while len(self.used_history) > GRAPH_SIZE:
@@ -364,7 +379,7 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         properties["mem_cached_gb" ] = "%.1f" % ( self.cached / 1024 / 1024 / 1024 )
         properties["mem_noncached_gb"] = "%.1f" % ( self.noncached / 1024  / 1024 / 1024 )
         
-        properties["mem_used_pc"] = int(self.used * 100.0 / self.total)
+        properties["mem_used_pc"] = int(self.used_pc)
         properties["mem_cached_pc"] = int(self.cached * 100.0 / self.total)
         properties["mem_noncached_pc"] = int(self.noncached * 100.0 / self.total)
         
@@ -450,10 +465,11 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         return ifs, nets
 
     
-    def _get_time_list(self, cpu):
+    def _get_time_list(self, cpu, cpu_times):
         '''
         Returns a 4 element list containing the amount of time the CPU has 
-        spent performing the different types of work
+        spent performing the different types of work, taken from the
+        statistics for all CPUs read once per refresh
         
         0 user
         1 nice
@@ -462,11 +478,33 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         
         Values are in USER_HZ or Jiffies
         ''' 
-        if cpu.number == -1:
-            cpu_times = gtop.cpu()
-        else:
-            cpu_times = gtop.cpu().cpus[cpu.number]
+        if cpu.number != -1:
+            cpu_times = cpu_times.cpus[cpu.number]
         return [cpu_times.user, cpu_times.nice, cpu_times.sys, cpu_times.idle]
     
+    def _get_cpu_pc(self, cpu, cpu_times):
+        '''
+        Returns the percentage of time the CPU was busy as calculated by
+        g15top, or None when the python-gtop bindings are in use and the
+        plugin must calculate it from the time list itself
+        '''
+        if cpu.number != -1:
+            cpu_times = cpu_times.cpus[cpu.number]
+        return getattr(cpu_times, "pc", None)
+    
+    def _get_net_rates(self, net_list):
+        '''
+        Returns a dictionary of [ recv_bps, send_bps ] for each network 
+        interface as calculated by g15top, or None when the python-gtop 
+        bindings are in use and the plugin must calculate the rates itself
+        '''
+        rates = { }
+        for net in net_list:
+            netload = gtop.netload(net)
+            if not hasattr(netload, "rate_in"):
+                return None
+            rates[net] = [ netload.rate_in, netload.rate_out ]
+        return rates
+    
     def _get_mem_info(self):
         return gtop.mem()
@@ -1,6 +1,5 @@
 # $Id: __init__.py 3 2008-01-29 18:39:09Z msthornton $
 
-import re
 import time
 
 class Tailer(object):
@@ -10,15 +9,20 @@ class Tailer(object):
     """
     line_terminators = ('\r\n', '\n', '\r')
 
-    def __init__(self, file, read_size=1024, end=False):
+    def __init__(self, file, read_size=1024, end=False, tail_read_size=65536):
         self.read_size = read_size
+        self.tail_read_size = tail_read_size
         self.file = file
         self.start_pos = self.file.tell()
         if end:
             self.seek_end()
     
     def splitlines(self, data):
-        return re.split('|'.join(self.line_terminators), data)
+        lines = data.splitlines()
+        if data[-1:] in self.line_terminators:
+            # splitlines() does not return the empty line after a final terminator
+            lines.append('')
+        return lines
 
     def seek_end(self):
         self.seek(0, 2)
@@ -114,15 +118,59 @@ class Tailer(object):
     def tail(self, lines=10):
         """\
         Return the last lines of the file.
+
+        The file is scanned backwards a block at a time (aligned to
+        tail_read_size) using rfind, so the cost depends on the size of the
+        lines returned rather than the size of the file.
         """
         self.seek_end()
         end_pos = self.file.tell()
+        if lines < 1 or end_pos == 0:
+            return []
 
-        for i in xrange(lines):
-            if not self.seek_line():
-                break
-
-        data = self.file.read(end_pos - self.file.tell() - 1)
+        # Ignore the line terminator at the very end of the file
+        self.seek(max(0, end_pos - 2))
+        last = self.file.read(2)
+        if last.endswith('\r\n'):
+            trailing = 2
+        elif last[-1:] in self.line_terminators:
+            trailing = 1
+        else:
+            trailing = 0
+
+        pos = end_pos
+        data = ''
+        # Where to search back from, as an offset from the end of data
+        limit_offset = trailing
+        start = None
+        found = 0
+        while start is None:
+            if pos > 0:
+                read_size = pos % self.tail_read_size or self.tail_read_size
+                pos -= read_size
+                self.seek(pos)
+                data = self.file.read(read_size) + data
+
+            limit = len(data) - limit_offset
+            while True:
+                i = max(data.rfind('\n', 0, limit), data.rfind('\r', 0, limit))
+                if i < 0 or ( i == 0 and pos > 0 ):
+                    # Need more data, either no terminator was found or a
+                    # '\n' at the start of the block might be part of '\r\n'
+                    if pos == 0:
+                        start = 0
+                    break
+                found += 1
+                if found == lines:
+                    start = i + 1
+                    break
+                if data[i] == '\n' and i > 0 and data[i - 1] == '\r':
+                    i -= 1
+                limit = i
+            limit_offset = len(data) - limit
+
+        self.seek(end_pos)
+        data = data[start:len(data) - trailing]
         if data:
             return self.splitlines(data)
         else:
@@ -237,6 +285,58 @@ def _test():
     import doctest
     doctest.testmod()
 
+def _legacy_tail(file, lines=10):
+    """\
+    Return the last lines of the file by seeking back a line at a time,
+    scanning one character at a time, as tail() used to.
+    """
+    tailer = Tailer(file)
+    tailer.seek_end()
+    end_pos = tailer.file.tell()
+    for i in xrange(lines):
+        if not tailer.seek_line():
+            break
+    data = tailer.file.read(end_pos - tailer.file.tell() - 1)
+    return data.splitlines() if data else []
+
+def _benchmark(size_mb, filepath=None):
+    """\
+    Time reading the last lines of a synthetic log file of the given size.
+    """
+    import os
+    import tempfile
+
+    remove = filepath is None
+    if filepath is None:
+        fd, filepath = tempfile.mkstemp(prefix='tailer-bench-', suffix='.log')
+        f = os.fdopen(fd, 'wb')
+    else:
+        f = open(filepath, 'wb')
+    try:
+        block = ''.join(['Jan  1 00:00:00 host program[%d]: synthetic log line number %d\n' % (i, i) for i in xrange(16384)])
+        written = 0
+        while written < size_mb * 1024 * 1024:
+            f.write(block)
+            written += len(block)
+        f.close()
+        print 'Generated %s (%d MiB)' % (filepath, written / 1024 / 1024)
+
+        for lines in (10, 1000, 10000):
+            for name, fn in (('legacy', _legacy_tail), ('blockwise', tail)):
+                fo = open(filepath, 'rb')
+                try:
+                    started = time.time()
+                    result = fn(fo, lines)
+                    taken = time.time() - started
+                finally:
+                    fo.close()
+                print '%-10s %6d lines in %8.2fms (%d returned)' % (name, lines, taken * 1000.0, len(result))
+    finally:
+        if not f.closed:
+            f.close()
+        if remove:
+            os.remove(filepath)
+
 def _main(filepath, options):
     tailer = Tailer(open(filepath, 'rb'))
 
@@ -286,10 +386,15 @@ def main():
     parser.add_option('', '--test', dest='test', default=False, action='store_true',
                       help='Run some basic tests')
 
+    parser.add_option('', '--benchmark', dest='benchmark', default=0, metavar='MB', type='int',
+                      help='time tailing a generated log file of MB megabytes, written to filename if given')
+
     (options, args) = parser.parse_args()
 
     if options.test:
         _test()
+    elif options.benchmark > 0:
+        _benchmark(options.benchmark, args[0] if len(args) > 0 else None)
     elif not len(args) == 1:
         parser.print_help()
         sys.exit(1)
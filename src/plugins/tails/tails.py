@@ -31,8 +31,10 @@ import os
 import gtk
 import gconf
 import logging
+import pyinotify
 import xdg.Mime as mime
-from threading import Thread
+from collections import deque
+from threading import Lock
 logger = logging.getLogger(__name__)
 
 # Plugin details - All of these must be provided
@@ -41,8 +43,6 @@ name = _("Tails")
 description = _("Monitor multiple files, updating when they change. Just \
 like the <b>tail</b> command.\n\n\
 \
-Warning: When monitoring large files that grow quickly, this plugin may \
-cause massive memory usage.\n\n\
 Uses the pytailer library (http://code.google.com/p/pytailer/), licensed \
 under the LGPL. See %s and %s for more details." % ( os.path.join(__file__, "LICENSE" ), os.path.join(__file__, "README" ) ) )
 author = "Brett Smith <tanktarta@blueyonder.co.uk>"
@@ -50,6 +50,16 @@ copyright = _("Copyright (C)2011 Brett Smith, Michael Thornton")
 site = "http://www.russo79.com/gnome15"
 has_preferences = True
 unsupported_models = [ g15driver.MODEL_G110, g15driver.MODEL_G11, g15driver.MODEL_G930, g15driver.MODEL_G35 ]
+# Amount of data read from a file at a time
+READ_SIZE = 65536
+
+# Longest line kept, anything before this is discarded
+MAX_LINE_LENGTH = 4096
+
+# Directory events that may affect a monitored file
+WATCH_MASK = pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | \
+             pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM
+
 actions={ 
          g15driver.PREVIOUS_SELECTION : _("Previous line"), 
          g15driver.NEXT_SELECTION : _("Next line"),
@@ -175,47 +185,213 @@ class G15TailMenuItem(g15theme.MenuItem):
         subprocess.Popen(['xdg-open', self.file])
         return True
         
-class G15TailThread(Thread):
+class G15TailFile():
+    """
+    Follows a single file on behalf of a page. New data is read by the
+    watcher thread, split into lines and held in a buffer that never holds
+    more lines than the page displays. The lines are handed over to the page
+    at most once per redraw, however quickly they arrive.
+    """
     def __init__(self, page):
-        Thread.__init__(self)
         self.page = page
+        self.path = os.path.realpath(page.file_path)
         self.fd = None
-        self.line_seq = 0
-        self.setDaemon(True)
-        self.setName("Monitor%s" % self.page.file_path)
+        self.position = 0
+        self._partial = ""
+        self._pending = deque(maxlen = max(1, page.plugin.lines))
+        self._lock = Lock()
+        self._flush_scheduled = False
         self._stopped = False
         
-    def stop_monitoring(self):
+    def open(self, tail_lines = 0):
+        """
+        Open the file, queueing the last lines of it if requested. Reading
+        then continues from the end of the file (or the start of it if it
+        is being opened following rotation)
+        
+        Keyword arguments:
+        tail_lines        -- number of existing lines to show 
+        """
+        try:
+            self.fd = open(self.path, "rb")
+        except IOError as e:
+            logger.debug("Could not open %s", self.path, exc_info = e)
+            self.fd = None
+            return
+        self._partial = ""
+        self.position = 0
+        if tail_lines > 0:
+            lines = tailer.tail(self.fd, tail_lines)
+            # tail() leaves the file where it stopped reading, anything written
+            # since is picked up by the read below
+            self.position = self.fd.tell()
+            if len(lines) > 0 and not self._ends_with_terminator():
+                self._partial = lines.pop()[-MAX_LINE_LENGTH:]
+            self._queue_lines(lines)
+        self.read()
+        
+    def _ends_with_terminator(self):
+        self.fd.seek(self.position - 1)
+        last = self.fd.read(1)
+        self.fd.seek(self.position)
+        return last in ( "\r", "\n" )
+            
+    def stop(self):
         self._stopped = True
+        self.close()
+    
+    def reopen(self):
+        """
+        Called when a new file appears at the monitored path, i.e. after
+        log rotation. Whatever remains in the old file is read first,
+        including any final line that was not terminated.
+        """
+        self.read()
+        self.close()
+        self.open()
+        
+    def close(self):
+        """
+        Close the file, queueing any final line that was not terminated so
+        it is not lost when the file is rotated or deleted
+        """
+        self._flush_partial()
         if self.fd is not None:
             self.fd.close()
+            self.fd = None
+        
+    def read(self):
+        """
+        Read everything that has been appended since the last read. If the
+        file has shrunk it has been truncated, so reading starts over from
+        the beginning.
+        """
+        if self.fd is None:
+            return
+        if os.fstat(self.fd.fileno()).st_size < self.position:
+            logger.debug("%s was truncated", self.path)
+            self._flush_partial()
+            self.fd.seek(0)
+            self.position = 0
+        while True:
+            data = self.fd.read(READ_SIZE)
+            if not data:
+                break
+            self.position += len(data)
+            lines = ( self._partial + data ).splitlines()
+            if data[-1] in "\r\n":
+                self._partial = ""
+            else:
+                self._partial = lines.pop()[-MAX_LINE_LENGTH:]
+            self._queue_lines(lines)
+            
+    def _flush_partial(self):
+        if len(self._partial) > 0:
+            lines = [ self._partial ]
+            self._partial = ""
+            self._queue_lines(lines)
+            
+    def _queue_lines(self, lines):
+        self._lock.acquire()
+        try:
+            self._pending.extend(lines)
+            if len(self._pending) > 0 and not self._flush_scheduled and not self._stopped:
+                self._flush_scheduled = True
+                g15screen.run_on_redraw(self._flush)
+        finally:
+            self._lock.release()
+            
+    def _flush(self):
+        self._lock.acquire()
+        try:
+            lines = list(self._pending)
+            self._pending.clear()
+            self._flush_scheduled = False
+        finally:
+            self._lock.release()
+        if not self._stopped:
+            self.page._add_lines(lines)
+        
+class G15TailWatcher(pyinotify.ProcessEvent):
+    """
+    Watches the directories containing all of the monitored files using a
+    single inotify thread. Watching the directory rather than the file means
+    files that are rotated, deleted or do not exist yet are picked up when
+    they are (re)created.
+    """
+    def __init__(self):
+        pyinotify.ProcessEvent.__init__(self)
+        self._files = {}
+        self._dirs = {}
+        self._lock = Lock()
+        self._watch_manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(self._watch_manager, self)
+        self._notifier.name = "TailsPyInotify"
+        self._notifier.setDaemon(True)
+        self._notifier.start()
+        
+    def stop(self):
+        self._lock.acquire()
+        try:
+            for tail_file in self._files.values():
+                tail_file.stop()
+            self._files = {}
+            self._dirs = {}
+        finally:
+            self._lock.release()
+        self._notifier.stop()
         
-    def run(self):
-        for line in tailer.tail(open(self.page.file_path), self.page.plugin.lines):
-            g15screen.run_on_redraw(self._add_line, line)
-        self.fd = open(self.page.file_path)
+    def add(self, page):
+        tail_file = G15TailFile(page)
+        dir_path = os.path.dirname(tail_file.path)
+        self._lock.acquire()
         try:
-            for line in tailer.follow(self.fd):
-                if self._stopped:
-                    break
-                g15screen.run_on_redraw(self._add_line, line)
-                if self._stopped:
-                    break
-        except ValueError as e:
-            logger.debug("Error while reading", exc_info = e)
-            if not self._stopped:
-                raise e
-        self.page.redraw()
+            if dir_path in self._dirs:
+                self._dirs[dir_path][1] += 1
+            else:
+                wdd = self._watch_manager.add_watch(dir_path, WATCH_MASK)
+                if wdd.get(dir_path, -1) < 0:
+                    logger.warning("Could not watch %s", dir_path)
+                else:
+                    self._dirs[dir_path] = [ wdd[dir_path], 1 ]
+            self._files[tail_file.path] = tail_file
+            tail_file.open(page.plugin.lines)
+        finally:
+            self._lock.release()
+        return tail_file
             
-    def _add_line(self, line):
-        line = line.strip()
-        if len(line) > 0 and not self._stopped:
-            line  = g15markup.html_escape(line)
-            while self.page._menu.get_child_count() > self.page.plugin.lines:
-                self.page._menu.remove_child_at(0)
-            self.page._menu.add_child(G15TailMenuItem("Line-%d" % self.line_seq, line, self.page.file_path))
-            self.page._menu.select_last_item()
-            self.line_seq += 1
+    def remove(self, tail_file):
+        dir_path = os.path.dirname(tail_file.path)
+        self._lock.acquire()
+        try:
+            tail_file.stop()
+            if self._files.get(tail_file.path) == tail_file:
+                del self._files[tail_file.path]
+            if dir_path in self._dirs:
+                self._dirs[dir_path][1] -= 1
+                if self._dirs[dir_path][1] == 0:
+                    self._watch_manager.rm_watch(self._dirs[dir_path][0], quiet = True)
+                    del self._dirs[dir_path]
+        finally:
+            self._lock.release()
+        
+    def process_default(self, event):
+        self._lock.acquire()
+        try:
+            tail_file = self._files.get(event.pathname)
+            if tail_file is None:
+                return
+            if event.mask & ( pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO ):
+                tail_file.reopen()
+            elif event.mask & ( pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM ):
+                tail_file.read()
+                tail_file.close()
+            else:
+                tail_file.read()
+        except (IOError, OSError) as e:
+            logger.debug("Error while reading %s", event.pathname, exc_info = e)
+        finally:
+            self._lock.release()
         
 class G15TailPage(g15theme.G15Page):
     
@@ -228,8 +404,9 @@ class G15TailPage(g15theme.G15Page):
         self._icon_embedded = None
         self.plugin = plugin
         self.file_path = file_path
-        self.thread =  None
+        self.tail_file = None
         self.index = -1
+        self._line_seq = 0
         self._menu = g15theme.Menu("menu")
         g15theme.G15Page.__init__(self, os.path.basename(file_path), self._screen,
                                      thumbnail_painter=self._paint_thumbnail,
@@ -270,19 +447,44 @@ class G15TailPage(g15theme.G15Page):
                 self._icon_embedded = None
         
         self._stop()
+        self._menu.remove_all_children()
+        self._update_status()
+        self.tail_file = self.plugin._watcher.add(self)
+            
+    def _update_status(self):
         if os.path.exists(self.file_path):
             self._subtitle =  time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(self.file_path)))
             self._message = ""
-            self.thread = G15TailThread(self)
-            self.thread.start()
         else:
             self._subtitle = ""
             self._message = "File does not exist"
             
     def _stop(self):
-        if self.thread is not None:
-            self.thread.stop_monitoring()
-            self.thread = None
+        if self.tail_file is not None:
+            self.plugin._watcher.remove(self.tail_file)
+            self.tail_file = None
+            
+    def _add_lines(self, lines):
+        """
+        Add a batch of new lines to the menu, discarding the oldest so no
+        more than the configured number of lines are shown, then redraw once.
+        Must be called on the redraw thread.
+        
+        Keyword arguments:
+        lines        -- lines to add
+        """
+        items = []
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0:
+                items.append(G15TailMenuItem("Line-%d" % self._line_seq, g15markup.html_escape(line), self.file_path))
+                self._line_seq += 1
+        self._update_status()
+        if len(items) > 0:
+            children = self._menu.get_children() + items
+            self._menu.set_children(children[-self.plugin.lines:])
+            self._menu.select_last_item()
+        self.redraw()
             
     def _get_theme_properties(self):
         properties = {}
@@ -305,7 +507,8 @@ class G15Tails():
         self._gconf_client = gconf_client
 
     def activate(self):
-        self._pages = {}       
+        self._pages = {}
+        self._watcher = G15TailWatcher()
         self._lines_changed_handle = self._gconf_client.notify_add(self._gconf_key + "/lines", self._lines_changed)
         self._files_changed_handle = self._gconf_client.notify_add(self._gconf_key + "/files", self._files_changed)
         self._load_files()
@@ -316,6 +519,7 @@ class G15Tails():
         for page in self._pages:
             self._screen.del_page(self._pages[page])
         self._pages = {}
+        self._watcher.stop()
     
     '''
     Private
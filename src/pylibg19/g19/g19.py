@@ -25,6 +25,12 @@ import logging
 import array
 logger = logging.getLogger(__name__)
 
+try:
+    import gnome15.util.g15pixels as g15pixels
+except ImportError as e:
+    logger.debug("g15pixels not available, using per-pixel conversion", exc_info = e)
+    g15pixels = None
+
 class G19(object):
     '''Simple access to Logitech G19 features.
 
@@ -65,6 +71,9 @@ class G19(object):
         if img.size != (320, 240):
             img = img.resize((320, 240), Img.CUBIC)
             access = img.load()
+        if g15pixels is not None:
+            data = g15pixels.image_tobytes(img.convert("RGBA"), "raw", g15pixels.PIL_ARGB32_MODE)
+            return list(bytearray(g15pixels.argb32_to_rgb565(data, 320, 240, column_major = True)))
         data = []
         for x in range(320):
             for y in range(240):